@@ -0,0 +1,113 @@
+"""Бенчмарк асинхронного слоя БД: апдейтов в секунду при N одновременных пользователях.
+
+Каждый "апдейт" повторяет работу обработчика browse_profiles с базой:
+проверка бана, поиск кандидата, подсчет и загрузка фотографий.
+Сравниваются два режима:
+  * sync  - прямые вызовы менеджеров из корутины (блокируют event loop);
+  * async - те же вызовы через Database.run (пул потоков + пул соединений).
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_async_db.py --users 50
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from common import reset_database
+import bot
+from bot import Database, UserManager, MatchManager
+
+CITIES = ["Киев", "Харьков", "Одесса", "Днепр", "Львов", "Запорожье"]
+
+
+def seed(population: int):
+    reset_database()
+    for user_id in range(1, population + 1):
+        city = random.choice(CITIES)
+        UserManager.create_user({
+            'user_id': user_id,
+            'username': f"user{user_id}",
+            'name': f"User {user_id}",
+            'age': random.randint(18, 45),
+            'gender': random.choice(['male', 'female']),
+            'current_city': city,
+            'search_city': city,
+            'search_radius': 50,
+            'dating_goal': 'friendship',
+            'bio': "Синтетический пользователь для бенчмарка",
+        })
+        UserManager.add_photo(user_id, f"photo-{user_id}", True)
+
+
+def browse_once_sync(user_id: int):
+    if UserManager.is_user_banned(user_id):
+        return
+    candidates = MatchManager.find_candidates(user_id)
+    if candidates:
+        bot.format_profile_text(candidates[0])
+        UserManager.get_user_photos(candidates[0]['user_id'])
+
+
+async def browse_once_async(user_id: int):
+    if await Database.run(UserManager.is_user_banned, user_id):
+        return
+    candidates = await Database.run(MatchManager.find_candidates, user_id)
+    if candidates:
+        await Database.run(bot.format_profile_text, candidates[0])
+        await Database.run(UserManager.get_user_photos, candidates[0]['user_id'])
+
+
+async def run_mode(mode: str, users: int, updates_per_user: int, population: int):
+    """Возвращает (апдейтов/сек, максимальная задержка event loop в мс)"""
+    max_lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        # Насколько опаздывает таймер - столько event loop был заблокирован
+        nonlocal max_lag
+        while not done.is_set():
+            expected = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - expected)
+
+    async def session(user_id: int):
+        for _ in range(updates_per_user):
+            if mode == "sync":
+                browse_once_sync(user_id)
+                await asyncio.sleep(0)
+            else:
+                await browse_once_async(user_id)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(session(random.randint(1, population)) for _ in range(users)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    return users * updates_per_user / elapsed, max_lag * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--updates", type=int, default=20, help="апдейтов на пользователя")
+    parser.add_argument("--population", type=int, default=5000, help="пользователей в базе")
+    args = parser.parse_args()
+
+    print(f"Заполнение базы: {args.population} пользователей...")
+    seed(args.population)
+
+    for mode in ("sync", "async"):
+        rate, lag = asyncio.run(run_mode(mode, args.users, args.updates, args.population))
+        print(f"{mode:>5}: {rate:8.1f} апдейтов/сек ({args.users} пользователей), "
+              f"макс. блокировка event loop {lag:.1f} мс")
+        Database.shutdown_executor()
+
+    print("Пул:", Database.pool_stats())
+    Database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
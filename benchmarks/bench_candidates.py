@@ -0,0 +1,151 @@
+"""Микробенчмарк MatchManager.find_candidates на аудитории разного размера.
+
+Для каждого размера базы (по умолчанию 10k и 100k, 1M - через --scales)
+скрипт заполняет базу генератором population.py (перекос по городам, доля
+мужчин, экспоненциальное число лайков и просмотров) и замеряет пополнение
+ленты - find_candidate_ids(viewer, FEED_BATCH_SIZE) - для всех форм запроса:
+  * all_ukraine - поиск по всей Украине, без условий по городу;
+  * radius      - город из справочника (ID) плюс радиус по координатам;
+  * city_id     - только ID городов (анкеты без координат);
+  * ilike       - старые анкеты без ID: current_city / search_city ILIKE.
+Каждая форма проверяется в двух режимах отсева просмотренных: подзапросы
+NOT IN к likes и viewed_profiles и фильтр в памяти (SEEN_FILTER_ENABLED).
+
+Результаты можно сохранить (--save) и сравнить с прошлым прогоном
+(--baseline): при росте p50 больше чем в --tolerance раз скрипт завершается
+с кодом 1, так что его можно запускать перед выкладкой.
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_candidates.py --save base.json
+    BENCH_DATABASE_URL=... python benchmarks/bench_candidates.py --scales 1000000 --views 20 --viewers 20
+"""
+import argparse
+import json
+import sys
+import time
+
+from population import populate
+import bot
+from bot import Database, MatchManager, FEED_BATCH_SIZE
+
+# Условие выбора зрителей и правка анкет, приводящая их к нужной форме запроса.
+# Остаток от деления user_id разводит формы по непересекающимся группам
+VARIANTS = {
+    "all_ukraine": ("search_all_ukraine", None),
+    "radius": ("NOT search_all_ukraine AND search_lat IS NOT NULL AND user_id %% 3 = 0", None),
+    "city_id": (
+        "NOT search_all_ukraine AND user_id %% 3 = 1",
+        "UPDATE users SET search_lat = NULL, search_lon = NULL WHERE user_id = ANY(%s)",
+    ),
+    "ilike": (
+        "NOT search_all_ukraine AND user_id %% 3 = 2",
+        """UPDATE users SET search_city_id = NULL, current_city_id = NULL,
+                            search_lat = NULL, search_lon = NULL
+           WHERE user_id = ANY(%s)""",
+    ),
+}
+MODES = {"not_in": False, "seen_filter": True}
+
+
+def pick_viewers(viewers: int) -> dict:
+    """Выбирает зрителей для каждой формы запроса и приводит их анкеты к этой форме"""
+    picked = {}
+    for variant, (condition, prepare) in VARIANTS.items():
+        rows = Database.execute_query(
+            f"""SELECT user_id FROM users
+                WHERE is_active = TRUE AND is_banned = FALSE AND {condition}
+                ORDER BY random() LIMIT %s""",
+            (viewers,), "all"
+        ) or []
+        picked[variant] = [row['user_id'] for row in rows]
+        if prepare and picked[variant]:
+            Database.execute_query(prepare, (picked[variant],))
+    return picked
+
+
+def percentile(samples: list, share: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def measure(viewer_ids: list, repeat: int, limit: int) -> dict:
+    # Первый вызов строит фильтр просмотренных и прогревает кэш анкет - не считаем
+    for viewer in viewer_ids:
+        MatchManager.find_candidate_ids(viewer, limit)
+    timings, rows = [], []
+    for _ in range(repeat):
+        for viewer in viewer_ids:
+            started = time.perf_counter()
+            found = MatchManager.find_candidate_ids(viewer, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+            rows.append(len(found))
+    return {
+        "calls": len(timings),
+        "p50": round(percentile(timings, 0.5), 2),
+        "p95": round(percentile(timings, 0.95), 2),
+        "max": round(max(timings), 2),
+        "rows": round(sum(rows) / len(rows), 1),
+    }
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        # Доли миллисекунды - шум, их не сравниваем
+        if before and result["p50"] > max(before["p50"] * tolerance, before["p50"] + 1):
+            regressions.append(f"{key}: p50 {before['p50']} -> {result['p50']} мс")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10000,100000", help="размеры базы через запятую")
+    parser.add_argument("--likes", type=float, default=20, help="лайков на пользователя в среднем")
+    parser.add_argument("--views", type=float, default=60, help="просмотров на пользователя в среднем")
+    parser.add_argument("--male-share", type=float, default=0.6, help="доля мужчин")
+    parser.add_argument("--viewers", type=int, default=50, help="зрителей на каждую форму запроса")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов на зрителя")
+    parser.add_argument("--limit", type=int, default=FEED_BATCH_SIZE, help="кандидатов за вызов")
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="допустимый рост p50, раз")
+    args = parser.parse_args()
+
+    results = {}
+    for users in (int(scale) for scale in args.scales.split(",")):
+        print(f"\nЗаполнение базы: {users} пользователей...")
+        print("  ", populate(users, args.likes, args.views, male_share=args.male_share))
+        viewers = pick_viewers(args.viewers)
+
+        print(f"{'форма':<12}{'отсев':<13}{'вызовов':>8}{'p50 мс':>9}{'p95 мс':>9}{'max мс':>9}{'строк':>7}")
+        for variant, viewer_ids in viewers.items():
+            for mode, enabled in MODES.items():
+                if not viewer_ids:
+                    continue
+                bot.SEEN_FILTER_ENABLED = enabled
+                result = measure(viewer_ids, args.repeat, args.limit)
+                results[f"{users}/{variant}/{mode}"] = result
+                print(f"{variant:<12}{mode:<13}{result['calls']:>8}{result['p50']:>9.1f}"
+                      f"{result['p95']:>9.1f}{result['max']:>9.1f}{result['rows']:>7}")
+        bot.SeenFilter.save_all()
+
+    Database.close_pool()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nЗамедление относительно", args.baseline)
+            print("\n".join("  " + line for line in regressions))
+            sys.exit(1)
+        print(f"\nБез замедлений относительно {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Сравнение старого и нового условия поиска по радиусу на синтетических данных.
+
+Старое условие считает 6371 * acos(...) для каждой строки users.
+Новое (geo_radius_filter) сначала отсекает строки прямоугольником по
+индексу idx_users_location и считает гаверсинусы только для оставшихся.
+Для каждого радиуса (10/25/50/100 км) выводятся план, время и число строк.
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_geo.py --users 1000000
+"""
+import argparse
+import time
+
+from common import reset_database
+from bot import Database, geo_radius_filter
+
+# Крупные города с долей населения - пользователи скапливаются вокруг них
+CLUSTERS = [
+    (50.4501, 30.5234, 0.30),  # Киев
+    (49.9935, 36.2304, 0.12),  # Харьков
+    (46.4825, 30.7233, 0.10),  # Одесса
+    (48.4647, 35.0462, 0.09),  # Днепр
+    (49.8397, 24.0297, 0.08),  # Львов
+    (47.8388, 35.1396, 0.06),  # Запорожье
+]
+
+OLD_RADIUS_SQL = """
+    u.current_lat IS NOT NULL AND u.current_lon IS NOT NULL
+    AND (
+        6371 * acos(
+            cos(radians(%s)) * cos(radians(u.current_lat)) *
+            cos(radians(u.current_lon) - radians(%s)) +
+            sin(radians(%s)) * sin(radians(u.current_lat))
+        )
+    ) <= %s
+"""
+
+
+def seed(users: int):
+    reset_database()
+    with Database.get_connection() as conn:
+        with conn.cursor() as cur:
+            remaining = users
+            for lat, lon, share in CLUSTERS:
+                count = int(users * share)
+                remaining -= count
+                # Нормальное распределение ~0.3° вокруг центра города
+                cur.execute(
+                    """
+                    INSERT INTO users (user_id, name, age, gender, current_city, current_lat, current_lon,
+                                       search_city, dating_goal, bio)
+                    SELECT g, 'u' || g, 18 + (g %% 30), CASE WHEN g %% 2 = 0 THEN 'male' ELSE 'female' END,
+                           'city', %s + 0.3 * sqrt(-2 * ln(1 - random())) * cos(2 * pi() * random()),
+                           %s + 0.3 * sqrt(-2 * ln(1 - random())) * cos(2 * pi() * random()),
+                           'city', 'friendship', 'bench user'
+                    FROM generate_series(
+                        (SELECT COALESCE(MAX(user_id), 0) + 1 FROM users),
+                        (SELECT COALESCE(MAX(user_id), 0) FROM users) + %s
+                    ) g
+                    """,
+                    (lat, lon, count),
+                )
+            # Остальные равномерно по территории Украины
+            cur.execute(
+                """
+                INSERT INTO users (user_id, name, age, gender, current_city, current_lat, current_lon,
+                                   search_city, dating_goal, bio)
+                SELECT g, 'u' || g, 18 + (g %% 30), 'male', 'village',
+                       44.4 + random() * 7.9, 22.1 + random() * 18.1, 'village', 'friendship', 'bench user'
+                FROM generate_series(
+                    (SELECT COALESCE(MAX(user_id), 0) + 1 FROM users),
+                    (SELECT COALESCE(MAX(user_id), 0) FROM users) + %s
+                ) g
+                """,
+                (max(remaining, 0),),
+            )
+        conn.commit()
+        # VACUUM нельзя выполнять внутри транзакции
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE users")
+        conn.autocommit = False
+
+
+def explain(sql: str, params: list):
+    with Database.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+            plan = [row["QUERY PLAN"] for row in cur.fetchall()]
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            count = cur.fetchone()["count"]
+            elapsed = (time.perf_counter() - started) * 1000
+    return plan, count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200000, help="пользователей в базе")
+    parser.add_argument("--plans", action="store_true", help="печатать планы целиком")
+    args = parser.parse_args()
+
+    print(f"Заполнение базы: {args.users} пользователей...")
+    seed(args.users)
+
+    lat, lon = CLUSTERS[0][:2]
+    base = "SELECT COUNT(*) AS count FROM users u WHERE u.is_active = TRUE AND u.is_banned = FALSE AND "
+    for radius in (10, 25, 50, 100):
+        old_plan, old_count, old_ms = explain(base + "(" + OLD_RADIUS_SQL + ")", [lat, lon, lat, radius])
+        new_sql, new_params = geo_radius_filter(lat, lon, radius)
+        new_plan, new_count, new_ms = explain(base + "(" + new_sql + ")", new_params)
+
+        print(f"\n=== Радиус {radius} км ===")
+        print(f"  старый: {old_ms:8.1f} мс, строк {old_count}, план: {old_plan[0].strip()}")
+        print(f"  новый:  {new_ms:8.1f} мс, строк {new_count}, план: {new_plan[0].strip()}")
+        if args.plans:
+            print("\n".join(["  -- старый --"] + old_plan + ["  -- новый --"] + new_plan))
+
+    Database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Общая подготовка окружения для бенчмарков.
+
+Бенчмарки работают только с отдельной тестовой базой из BENCH_DATABASE_URL:
+reset_database() удаляет все таблицы бота и заново применяет миграции.
+"""
+import os
+import sys
+
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL", "")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+if not os.environ["DATABASE_URL"]:
+    sys.exit("Укажите BENCH_DATABASE_URL (тестовая база, таблицы будут пересозданы)")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bot import Database  # noqa: E402
+
+
+def reset_database():
+    """Удаляет все таблицы схемы public и создает схему заново миграциями"""
+    with Database.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
+            tables = [row['tablename'] for row in cur.fetchall()]
+            if tables:
+                cur.execute("DROP TABLE IF EXISTS " + ", ".join(f'"{t}"' for t in tables) + " CASCADE")
+    Database.init_database()
@@ -0,0 +1,377 @@
+"""Сквозной нагрузочный тест: настоящие обработчики бота против заглушки Bot API.
+
+Скрипт заполняет тестовую базу синтетической аудиторией (population.py),
+поднимает в том же процессе заглушку Telegram (fake_bot_api.py) и приложение
+бота из build_application, а затем проигрывает сценарии пользователей с
+заданной параллельностью:
+  * новички - /start, капча, имя, возраст, пол, города, радиус, цель, о себе,
+    фото, "Закончить", после чего листают анкеты как остальные;
+  * пользователи из базы - "Смотреть анкеты", затем лайк (30%), пропуск (65%)
+    или жалоба (5%) на показанную анкету и снова к следующей.
+Каждый шаг ждет ответа бота (сообщения в чат), как живой пользователь.
+
+Отчет: обновлений в секунду, p50/p95/p99 времени обработчиков и шагов
+(от отправки обновления до ответа в чат), запросов к БД на обновление по типам
+шагов и самые частые запросы, вызовы Bot API по методам.
+
+Лимиты отправки по умолчанию сняты, чтобы мерить сам бот; реальные лимиты
+Telegram: SEND_CHAT_RATE=1 SEND_GLOBAL_RATE=30. Заглушка слушает адрес из
+TELEGRAM_API_URL.
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/e2e_load.py --users 20000 --sessions 50
+"""
+import os
+
+os.environ.setdefault("TELEGRAM_API_URL", "http://127.0.0.1:8081")
+os.environ.setdefault("FLOOD_ENABLED", "false")
+os.environ.setdefault("SEND_CHAT_RATE", "1000")
+os.environ.setdefault("SEND_CHAT_BURST", "1000")
+os.environ.setdefault("SEND_GLOBAL_RATE", "100000")
+os.environ.setdefault("METRICS_ENABLED", "false")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import contextvars  # noqa: E402
+import itertools  # noqa: E402
+import logging  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+from collections import Counter, defaultdict  # noqa: E402
+from urllib.parse import urlsplit  # noqa: E402
+
+import psycopg2.extras  # noqa: E402
+from telegram import Update  # noqa: E402
+
+from population import populate  # noqa: E402
+import bot  # noqa: E402
+from bot import Database, Metrics, DATING_GOALS  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+CAPTCHA_RE = re.compile(r"(\d+) ([+-]) (\d+) = \?")
+NEWCOMER_CITIES = ["Киев", "Харьков", "Одесса", "Днепр", "Львов"]
+
+
+def percentile(samples: list, share: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class QueryCounter:
+    """Считает запросы к БД по типу шага, который их вызвал.
+
+    Тип шага живет в contextvar задачи обработки обновления, а запросы выполняются
+    в потоках Database.run - поэтому метка передается в поток через threading.local.
+    Запросы вне обработчиков (фоновая запись просмотров и т.п.) идут в "фон".
+    """
+
+    def __init__(self):
+        self.step = contextvars.ContextVar("step", default=None)
+        self.by_step = Counter()
+        self.by_query = Counter()
+        self._thread = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self):
+        counter = self
+        original_run = Database.run
+        original_execute = psycopg2.extras.RealDictCursor.execute
+
+        async def counted_run(func, *args, **kwargs):
+            step = counter.step.get()
+
+            def call():
+                counter._thread.step = step
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    counter._thread.step = None
+            call.__qualname__ = func.__qualname__
+            return await original_run(call)
+
+        def counted_execute(cursor, query, vars=None):
+            text = query.decode("utf-8", "replace")[:300] if isinstance(query, bytes) else str(query)
+            with counter._lock:
+                counter.by_step[getattr(counter._thread, "step", None) or "фон"] += 1
+                counter.by_query[Metrics.query_label(text)] += 1
+            return original_execute(cursor, query, vars)
+
+        Database.run = staticmethod(counted_run)
+        psycopg2.extras.RealDictCursor.execute = counted_execute
+
+
+class LoadTest:
+    def __init__(self, application, api: FakeBotApi, queries: QueryCounter, timeout: float, think: float):
+        self.application = application
+        self.api = api
+        self.queries = queries
+        self.timeout = timeout
+        self.think = think
+        self.update_ids = itertools.count(1)
+        self.step_of_update = {}
+        self.updates = Counter()
+        self.step_seconds = defaultdict(list)
+        self.handler_seconds = defaultdict(list)
+        self.timeouts = Counter()
+        self.outcomes = Counter()
+
+    def install(self):
+        original = self.application.process_update
+
+        async def process_update(update):
+            token = self.queries.step.set(self.step_of_update.pop(update.update_id, "other"))
+            try:
+                return await original(update)
+            finally:
+                self.queries.step.reset(token)
+
+        self.application.process_update = process_update
+        Metrics.instrument(self.application, observe=lambda name, seconds: self.handler_seconds[name].append(seconds))
+
+    # --- обновления ---
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        message = {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+        text = fields.get("text", "")
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def _callback(self, user_id: int, data: str, message_id: int) -> dict:
+        return {"callback_query": {
+            "id": f"{user_id}:{next(self.update_ids)}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id or 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 0, "is_bot": True, "first_name": "bot"},
+                "text": "...",
+            },
+        }}
+
+    async def step(self, step: str, user_id: int, payload: dict, expect):
+        """Отправляет обновление и ждет ответа в чат, для которого expect(call) истинно"""
+        if self.think:
+            await asyncio.sleep(random.expovariate(1 / self.think))
+        update_id = next(self.update_ids)
+        self.step_of_update[update_id] = step
+        self.updates[step] += 1
+        started = time.perf_counter()
+        await self.application.update_queue.put(Update.de_json({"update_id": update_id, **payload},
+                                                               self.application.bot))
+        call = await self.api.expect(user_id, expect, self.timeout)
+        if call is None:
+            self.timeouts[step] += 1
+            return None
+        self.step_seconds[step].append(time.perf_counter() - started)
+        return call
+
+    # --- сценарии ---
+
+    async def register(self, user_id: int) -> int:
+        """Регистрация новичка. Возвращает message_id меню или 0, если не удалось"""
+        text = lambda call: True  # noqa: E731
+        buttons = lambda prefix: lambda call: any(b.startswith(prefix) for b in call.buttons)  # noqa: E731
+
+        call = await self.step("start", user_id, self._message(user_id, text="/start"),
+                               lambda call: CAPTCHA_RE.search(call.text))
+        if call is None:
+            return 0
+        a, op, b = CAPTCHA_RE.search(call.text).groups()
+        answer = int(a) + int(b) if op == "+" else int(a) - int(b)
+        city = random.choice(NEWCOMER_CITIES)
+        script = [
+            ("captcha", self._message(user_id, text=str(answer)), text),
+            ("name", self._message(user_id, text=f"Новичок {user_id}"), text),
+            ("age", self._message(user_id, text=str(random.randint(18, 45))), buttons("gender_")),
+        ]
+        for step, payload, expect in script:
+            call = await self.step(step, user_id, payload, expect)
+            if call is None:
+                return 0
+        callbacks = [
+            ("gender", random.choice(["gender_male", "gender_female"]), text),
+        ]
+        for step, data, expect in callbacks:
+            call = await self.step(step, user_id, self._callback(user_id, data, call.message_id), expect)
+            if call is None:
+                return 0
+        for step, value, expect in [("current_city", city, text), ("search_city", city, buttons("radius_"))]:
+            call = await self.step(step, user_id, self._message(user_id, text=value), expect)
+            if call is None:
+                return 0
+        for step, data, expect in [
+            ("radius", random.choice(["radius_10", "radius_25", "radius_50", "radius_100"]), buttons("goal_")),
+            ("goal", f"goal_{random.choice(list(DATING_GOALS))}", text),
+        ]:
+            call = await self.step(step, user_id, self._callback(user_id, data, call.message_id), expect)
+            if call is None:
+                return 0
+        call = await self.step("bio", user_id, self._message(user_id, text="Люблю горы, кофе и длинные прогулки"),
+                               text)
+        if call is None:
+            return 0
+        photo = [{"file_id": f"bench-photo-{user_id}", "file_unique_id": f"u{user_id}", "width": 800, "height": 800}]
+        call = await self.step("photo", user_id, self._message(user_id, photo=photo), buttons("finish_photos"))
+        if call is None:
+            return 0
+        call = await self.step("finish_photos", user_id, self._callback(user_id, "finish_photos", call.message_id),
+                               buttons("browse"))
+        self.outcomes["registered" if call else "registration_failed"] += 1
+        return call.message_id if call else 0
+
+    async def browse(self, user_id: int, steps: int, message_id: int):
+        """Листает анкеты: смотреть -> лайк/пропуск/жалоба -> ..."""
+        is_card = lambda call: any(b.startswith("like_") for b in call.buttons)  # noqa: E731
+        is_card_or_end = lambda call: is_card(call) or "закончились" in call.text  # noqa: E731
+        done = 0
+        call = await self.step("browse", user_id, self._callback(user_id, "browse", message_id), is_card_or_end)
+        while call is not None and done < steps:
+            done += 1
+            if not is_card(call):
+                self.outcomes["feed_exhausted"] += 1
+                return
+            target = next(b for b in call.buttons if b.startswith("like_")).split("_")[1]
+            roll = random.random()
+            if roll < 0.30:
+                call = await self.step("like", user_id, self._callback(user_id, f"like_{target}", call.message_id),
+                                       lambda c: "browse" in c.buttons)
+                if call is not None:
+                    call = await self.step("browse", user_id,
+                                           self._callback(user_id, "browse", call.message_id), is_card_or_end)
+            elif roll < 0.95:
+                # Пропуск сразу показывает следующую анкету
+                call = await self.step("skip", user_id, self._callback(user_id, f"skip_{target}", call.message_id),
+                                       is_card_or_end)
+            else:
+                call = await self.step(
+                    "complaint", user_id, self._callback(user_id, f"complaint_{target}", call.message_id),
+                    lambda c: c.method == "answerCallbackQuery" or any(b.startswith("complain_") for b in c.buttons)
+                )
+                if call is not None and call.method != "answerCallbackQuery":
+                    call = await self.step(
+                        "complain_reason", user_id,
+                        self._callback(user_id, f"complain_spam_{target}", call.message_id),
+                        lambda c: "browse" in c.buttons
+                    )
+                if call is not None:
+                    # После жалобы (или отказа по лимиту) - к следующей анкете
+                    call = await self.step("browse", user_id,
+                                           self._callback(user_id, "browse", call.message_id or message_id),
+                                           is_card_or_end)
+
+    async def session(self, user_id: int, newcomer: bool, steps: int):
+        message_id = 1
+        if newcomer:
+            message_id = await self.register(user_id)
+            if not message_id:
+                return
+        await self.browse(user_id, steps, message_id)
+
+
+async def run(args):
+    url = urlsplit(os.environ["TELEGRAM_API_URL"])
+    api = FakeBotApi(url.hostname, url.port or 80, latency=args.api_latency)
+    await api.start()
+
+    queries = QueryCounter()
+    queries.install()
+    bot.UserRegistry.load()
+    application = bot.build_application(bot.PostgresPersistence(), update_queue_size=10000)
+    test = LoadTest(application, api, queries, args.timeout, args.think)
+    test.install()
+
+    newcomers = int(args.sessions * args.newcomers)
+    existing = random.sample(range(1, args.users + 1), args.sessions - newcomers)
+    plan = [(user_id, False) for user_id in existing]
+    # Новички - ID больше всех существующих (в том числе зарегистрированных прошлым запуском)
+    last_id = Database.execute_query("SELECT COALESCE(MAX(user_id), 0) AS last_id FROM users", fetch="one")
+    plan += [(last_id['last_id'] + 1 + n, True) for n in range(newcomers)]
+    random.shuffle(plan)
+
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(test.session(user_id, newcomer, args.steps) for user_id, newcomer in plan))
+        elapsed = time.perf_counter() - started
+        await application.stop()
+        await bot.drain_outbound(application)
+    await api.stop()
+    report(test, queries, api, elapsed)
+
+
+def report(test: LoadTest, queries: QueryCounter, api: FakeBotApi, elapsed: float):
+    total_updates = sum(test.updates.values())
+    print(f"\n{total_updates} обновлений за {elapsed:.1f} сек: {total_updates / elapsed:.0f} обновлений/сек")
+    print("исходы:", dict(test.outcomes), "| таймауты:", dict(test.timeouts) or "нет")
+
+    def table(title: str, samples: dict):
+        print(f"\n{title:<24}{'n':>7}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+        for name, values in sorted(samples.items(), key=lambda item: -len(item[1])):
+            print(f"{name:<24}{len(values):>7}" + "".join(
+                f"{percentile(values, share) * 1000:>9.1f}" for share in (0.5, 0.95, 0.99)
+            ))
+
+    table("обработчик", test.handler_seconds)
+    table("шаг (до ответа в чат)", test.step_seconds)
+
+    print(f"\nзапросов к БД: {sum(queries.by_step.values())}, "
+          f"на обновление: {sum(v for k, v in queries.by_step.items() if k != 'фон') / max(1, total_updates):.2f}")
+    for step, count in sorted(test.updates.items(), key=lambda item: -item[1]):
+        print(f"  {step:<22}{queries.by_step[step] / count:>6.2f} на обновление")
+    if queries.by_step["фон"]:
+        print(f"  {'фон':<22}{queries.by_step['фон']:>6} всего")
+    print("частые запросы:")
+    for label, count in queries.by_query.most_common(10):
+        print(f"  {label:<30}{count:>8}")
+    print("\nвызовы Bot API:", dict(api.calls.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="пользователей в базе")
+    parser.add_argument("--likes", type=float, default=20, help="лайков на пользователя в среднем")
+    parser.add_argument("--views", type=float, default=60, help="просмотров на пользователя в среднем")
+    parser.add_argument("--sessions", type=int, default=50, help="одновременных сессий")
+    parser.add_argument("--steps", type=int, default=20, help="действий с анкетами за сессию")
+    parser.add_argument("--newcomers", type=float, default=0.2, help="доля сессий с регистрацией")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза пользователя между шагами, сек")
+    parser.add_argument("--timeout", type=float, default=10.0, help="ожидание ответа бота, сек")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа заглушки Bot API, сек")
+    parser.add_argument("--skip-populate", action="store_true", help="использовать уже заполненную базу")
+    args = parser.parse_args()
+    # Строка в лог на каждый запрос к заглушке заметно тормозит сам бенчмарк
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if not args.skip_populate:
+        print(f"Заполнение базы: {args.users} пользователей...")
+        print("  ", populate(args.users, args.likes, args.views))
+    try:
+        asyncio.run(run(args))
+    finally:
+        bot.ViewBuffer.stop()
+        bot.SeenFilter.save_all()
+        Database.shutdown_executor()
+        Database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
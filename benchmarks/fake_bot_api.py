@@ -0,0 +1,225 @@
+"""Заглушка Telegram Bot API для нагрузочных тестов.
+
+Принимает запросы python-telegram-bot (бот запускается с TELEGRAM_API_URL,
+указывающим сюда), отвечает правдоподобными объектами Message и записывает
+каждый вызов: сколько раз вызван метод, и по чатам - что бот отправил, чтобы
+сценарии пользователей могли дождаться ответа. Задержку настоящего API можно
+имитировать параметром latency.
+
+Ответы на нажатия (answerCallbackQuery) не содержат chat_id; если id нажатия
+имеет вид "<chat_id>:<n>", всплывающее сообщение тоже попадает в очередь чата.
+
+    python benchmarks/fake_bot_api.py --port 8081   # отдельно, для ручной проверки
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 100500, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Методы, которые показывают пользователю новое содержимое - на них ждут сценарии
+VISIBLE_METHODS = ("sendMessage", "sendPhoto", "sendMediaGroup", "editMessageText")
+
+
+class RecordedCall:
+    __slots__ = ("method", "params", "message_id", "at")
+
+    def __init__(self, method: str, params: dict, message_id: int = None):
+        self.method = method
+        self.params = params
+        self.message_id = message_id
+        self.at = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        if self.method == "sendMediaGroup":
+            media = self.params.get("media") or []
+            return media[0].get("caption", "") if media else ""
+        return self.params.get("text") or self.params.get("caption") or ""
+
+    @property
+    def buttons(self) -> list:
+        """callback_data всех кнопок сообщения"""
+        markup = self.params.get("reply_markup") or {}
+        return [
+            button["callback_data"]
+            for row in markup.get("inline_keyboard", [])
+            for button in row if "callback_data" in button
+        ]
+
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1000)
+        self._chats = defaultdict(asyncio.Queue)
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        """Очередь видимых вызовов, адресованных чату"""
+        return self._chats[chat_id]
+
+    async def expect(self, chat_id: int, predicate, timeout: float = 10.0):
+        """Ждет вызов в чат, для которого predicate(call) истинно. Остальные пропускает"""
+        inbox = self._chats[chat_id]
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                call = await asyncio.wait_for(inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if predicate(call):
+                return call
+
+    # --- HTTP ---
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                path = request_line.decode("latin-1").split()[1]
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                params = self._parse(headers.get("content-type", ""), body)
+                result = await self._call(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(content_type: str, body: bytes) -> dict:
+        if content_type.startswith("application/json"):
+            raw = json.loads(body or b"{}")
+        elif content_type.startswith("multipart/form-data"):
+            boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+            raw = {}
+            for part in body.split(b"--" + boundary):
+                head, _, value = part.partition(b"\r\n\r\n")
+                if b'name="' not in head:
+                    continue
+                name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                raw[name] = value.rstrip(b"\r\n").decode("utf-8", "replace")
+        else:
+            raw = dict(parse_qsl(body.decode("utf-8")))
+        # Сложные параметры (reply_markup, media) PTB передает строкой JSON
+        params = {}
+        for key, value in raw.items():
+            if isinstance(value, str) and value[:1] in ("{", "["):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _message(self, chat_id, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def _call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        result = self._result(method, chat_id, params)
+
+        if method in VISIBLE_METHODS and chat_id is not None:
+            message_id = result[-1]["message_id"] if isinstance(result, list) and result else (
+                result["message_id"] if isinstance(result, dict) else None
+            )
+            self._chats[int(chat_id)].put_nowait(RecordedCall(method, params, message_id))
+        elif method == "answerCallbackQuery" and params.get("text"):
+            chat, _, _ = str(params.get("callback_query_id", "")).partition(":")
+            if chat.lstrip("-").isdigit():
+                self._chats[int(chat)].put_nowait(RecordedCall(method, params))
+        return result
+
+    def _result(self, method: str, chat_id, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = [{"file_id": str(params.get("photo")), "file_unique_id": "u", "width": 1, "height": 1}]
+            return self._message(chat_id, photo=photo, caption=params.get("caption", ""))
+        if method == "sendMediaGroup":
+            return [
+                self._message(chat_id, photo=[{"file_id": str(item.get("media")), "file_unique_id": "u",
+                                               "width": 1, "height": 1}])
+                for item in params.get("media") or []
+            ]
+        if method == "editMessageText":
+            return self._message(chat_id, text=params.get("text", ""))
+        return True
+
+async def serve(port: int, latency: float):
+    api = FakeBotApi(port=port, latency=latency)
+    await api.start()
+    print(f"Заглушка Bot API: {api.url} (TELEGRAM_API_URL={api.url})")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(dict(api.calls))
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.port, args.latency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Проверка лайков под конкурентной нагрузкой: встречные лайки в один момент.
+
+Для каждой пары пользователей два потока одновременно (через barrier) ставят
+друг другу лайк. Каждая пара должна дать ровно один матч, и хотя бы одна
+из сторон должна узнать о нем. Для сравнения тот же сценарий прогоняется
+со старым алгоритмом из трех запросов: он может потерять матч, если оба
+лайка вставлены до того, как какая-либо из проверок увидит встречный.
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/like_race.py --pairs 200
+"""
+import argparse
+import sys
+import threading
+import time
+
+from common import reset_database
+from bot import Database, MatchManager
+
+
+def legacy_add_like(from_user: int, to_user: int) -> bool:
+    """Прежняя реализация: вставка лайка, проверка взаимности и вставка матча отдельными запросами"""
+    Database.execute_query(
+        "INSERT INTO likes (from_user, to_user) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+        (from_user, to_user)
+    )
+    mutual = Database.execute_query(
+        "SELECT 1 FROM likes WHERE from_user = %s AND to_user = %s",
+        (to_user, from_user), "one"
+    )
+    if mutual:
+        user1, user2 = sorted([from_user, to_user])
+        Database.execute_query(
+            "INSERT INTO matches (user1, user2) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (user1, user2)
+        )
+        return True
+    return False
+
+
+def run(add_like, pairs: int):
+    """Возвращает (матчей в БД, пар, о матче в которых не узнал никто, секунд)"""
+    Database.execute_query("TRUNCATE likes, matches")
+    notified = [False] * pairs
+
+    def worker(pair: int, from_user: int, to_user: int, barrier: threading.Barrier):
+        barrier.wait()
+        if add_like(from_user, to_user):
+            notified[pair] = True
+
+    started = time.perf_counter()
+    for batch_start in range(0, pairs, 4):
+        threads = []
+        for pair in range(batch_start, min(batch_start + 4, pairs)):
+            a, b = 2 * pair + 1, 2 * pair + 2
+            barrier = threading.Barrier(2)
+            threads.append(threading.Thread(target=worker, args=(pair, a, b, barrier)))
+            threads.append(threading.Thread(target=worker, args=(pair, b, a, barrier)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    matches = Database.execute_query("SELECT COUNT(*) AS count FROM matches", fetch="one")['count']
+    return matches, notified.count(False), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=200, help="пар пользователей")
+    args = parser.parse_args()
+
+    reset_database()
+
+    legacy = run(legacy_add_like, args.pairs)
+    atomic = run(MatchManager.add_like, args.pairs)
+    for name, (matches, missed, elapsed) in (("старый", legacy), ("register_like", atomic)):
+        print(f"{name:>14}: матчей {matches}/{args.pairs}, без уведомления {missed}, {elapsed:.2f} сек")
+
+    Database.close_pool()
+    matches, missed, _ = atomic
+    if matches != args.pairs or missed:
+        print("ОШИБКА: register_like потерял матчи")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
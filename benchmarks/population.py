@@ -0,0 +1,228 @@
+"""Генератор синтетической аудитории для бенчмарков.
+
+Заполняет users, user_photos, likes, matches и viewed_profiles силами самого
+Postgres (generate_series), поэтому миллион анкет создается за минуты.
+Распределения приближены к реальным:
+  * города из data/ua_cities.csv с весом по закону Ципфа - крупные города
+    собирают большую часть аудитории, координаты разбросаны вокруг центра;
+  * 80% ищут в своем городе, 10% в другом, 10% по всей Украине;
+  * возраст ~ N(27, 6) в пределах 18-60, доля мужчин задается (по умолчанию 50%),
+    1-5 фото, 3% скрытых и 1% заблокированных;
+  * число лайков и просмотров на пользователя - экспоненциальное (немного очень
+    активных, много почти неактивных), 70% адресатов из того же города;
+  * просмотры за последние 60 дней, часть уже истекла (can_view_again в прошлом).
+
+ВНИМАНИЕ: скрипт пересоздает таблицы, указывайте отдельную тестовую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/population.py --users 100000
+"""
+import argparse
+import csv
+import time
+
+from common import reset_database
+from bot import Database, DATING_GOALS, CITIES_FILE
+
+
+# Адресаты лайков и просмотров: 70% из города пользователя, остальные - любые.
+# Случайные числа считаются в подзапросе по generate_series - по одному набору на строку
+TARGETS_SQL = """
+    SELECT cu.user_id AS source,
+           CASE WHEN p.local
+                THEN (SELECT b.user_id FROM bench_city_users b
+                      WHERE b.city_id = cu.city_id AND b.rn = p.pick_rn)
+                ELSE p.any_user
+           END AS target
+    FROM bench_city_users cu
+    CROSS JOIN LATERAL (
+        SELECT random() < 0.7 AS local,
+               1 + floor(random() * cu.city_size)::bigint AS pick_rn,
+               1 + floor(random() * %s)::bigint AS any_user
+        FROM generate_series(1, cu.{count_column})
+    ) p
+"""
+
+
+def load_cities():
+    with open(CITIES_FILE, encoding="utf-8") as f:
+        return [
+            (int(row["id"]), row["name_ru"], float(row["lat"]), float(row["lon"]))
+            for row in csv.DictReader(f)
+        ]
+
+
+def populate(users: int, likes_per_user: float = 20, views_per_user: float = 60,
+             seed: float = 0.42, reset: bool = True, male_share: float = 0.5) -> dict:
+    """Заполняет базу и возвращает число созданных строк по таблицам"""
+    if reset:
+        reset_database()
+    cities = load_cities()
+    # Порядок в справочнике - по убыванию населения, вес города ~ 1 / ранг^1.1
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(cities))]
+    total = sum(weights)
+    cumulative, acc = [], 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+    cumulative[-1] = 1.0
+
+    counts = {}
+    with Database.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT setseed(%s)", (seed,))
+            cur.execute(
+                "CREATE TEMP TABLE bench_cities (id INT, name TEXT, lat FLOAT, lon FLOAT, cum FLOAT) ON COMMIT DROP"
+            )
+            cur.executemany(
+                "INSERT INTO bench_cities VALUES (%s, %s, %s, %s, %s)",
+                [(*city, cum) for city, cum in zip(cities, cumulative)],
+            )
+
+            started = time.perf_counter()
+            cur.execute(
+                """
+                INSERT INTO users (user_id, username, name, age, gender,
+                                   current_city, current_city_id, current_lat, current_lon,
+                                   search_city, search_city_id, search_lat, search_lon,
+                                   search_radius, search_all_ukraine, dating_goal, bio,
+                                   is_active, is_banned, last_active)
+                SELECT s.g, 'user' || s.g, 'User ' || s.g,
+                       LEAST(60, GREATEST(18, round(27 + 6 * sqrt(-2 * ln(1 - s.r_age)) * cos(2 * pi() * s.r_age2))))::int,
+                       CASE WHEN s.r_gender < %s THEN 'male' ELSE 'female' END,
+                       c.name, c.id, c.lat + (s.r_lat - 0.5) * 0.2, c.lon + (s.r_lon - 0.5) * 0.3,
+                       CASE WHEN s.r_search < 0.1 THEN 'вся украина' ELSE sc.name END,
+                       CASE WHEN s.r_search < 0.1 THEN NULL ELSE sc.id END,
+                       CASE WHEN s.r_search < 0.1 THEN NULL ELSE sc.lat END,
+                       CASE WHEN s.r_search < 0.1 THEN NULL ELSE sc.lon END,
+                       CASE WHEN s.r_search < 0.1 THEN 0 ELSE (ARRAY[10, 25, 50, 100])[1 + floor(s.r_radius * 4)::int] END,
+                       s.r_search < 0.1,
+                       (%s::text[])[1 + floor(s.r_goal * %s)::int],
+                       'Синтетическая анкета для бенчмарка',
+                       s.r_state >= 0.03, s.r_state < 0.01,
+                       CURRENT_TIMESTAMP - s.r_active * INTERVAL '30 days'
+                FROM (
+                    SELECT g, random() AS r_city, random() AS r_other, random() AS r_search,
+                           random() AS r_age, random() AS r_age2, random() AS r_gender,
+                           random() AS r_lat, random() AS r_lon, random() AS r_radius,
+                           random() AS r_goal, random() AS r_state, random() AS r_active
+                    FROM generate_series(1, %s) g
+                ) s
+                CROSS JOIN LATERAL (
+                    SELECT * FROM bench_cities WHERE cum >= s.r_city ORDER BY cum LIMIT 1
+                ) c
+                CROSS JOIN LATERAL (
+                    -- 10%% ищут в другом (случайном по весу) городе, остальные - в своем
+                    SELECT * FROM bench_cities
+                    WHERE cum >= CASE WHEN s.r_search < 0.2 THEN s.r_other ELSE s.r_city END
+                    ORDER BY cum LIMIT 1
+                ) sc
+                """,
+                (male_share, list(DATING_GOALS), len(DATING_GOALS), users),
+            )
+            counts["users"] = cur.rowcount
+
+            cur.execute(
+                """
+                INSERT INTO user_photos (user_id, photo_id, is_main)
+                SELECT u.user_id, 'photo-' || u.user_id || '-' || n, n = 1
+                FROM (SELECT user_id, LEAST(5, 1 + floor(-ln(1 - random()) * 1.2)::int) AS photo_count
+                      FROM users) u
+                CROSS JOIN LATERAL generate_series(1, u.photo_count) n
+                """
+            )
+            counts["user_photos"] = cur.rowcount
+
+            # Пользователи по городам с порядковым номером - для выбора случайного соседа,
+            # и сколько лайков и просмотров сделает каждый
+            cur.execute(
+                """
+                CREATE TEMP TABLE bench_city_users ON COMMIT DROP AS
+                SELECT current_city_id AS city_id, user_id,
+                       row_number() OVER (PARTITION BY current_city_id ORDER BY user_id) AS rn,
+                       count(*) OVER (PARTITION BY current_city_id) AS city_size,
+                       floor(-ln(1 - random()) * %s)::int AS likes_count,
+                       floor(-ln(1 - random()) * %s)::int AS views_count
+                FROM users
+                """,
+                (likes_per_user, views_per_user),
+            )
+            cur.execute("CREATE INDEX ON bench_city_users (city_id, rn)")
+            cur.execute("CREATE INDEX ON bench_city_users (user_id)")
+            cur.execute("ANALYZE bench_city_users")
+
+            cur.execute(
+                f"""
+                INSERT INTO likes (from_user, to_user, created_at)
+                SELECT source, target, CURRENT_TIMESTAMP - random() * INTERVAL '60 days'
+                FROM ({TARGETS_SQL.format(count_column="likes_count")}) t
+                WHERE target IS NOT NULL AND target <> source
+                ON CONFLICT DO NOTHING
+                """,
+                (users,),
+            )
+            counts["likes"] = cur.rowcount
+
+            cur.execute(
+                """
+                INSERT INTO matches (user1, user2, created_at)
+                SELECT LEAST(l1.from_user, l1.to_user), GREATEST(l1.from_user, l1.to_user),
+                       GREATEST(l1.created_at, l2.created_at)
+                FROM likes l1
+                JOIN likes l2 ON l2.from_user = l1.to_user AND l2.to_user = l1.from_user
+                WHERE l1.from_user < l1.to_user
+                ON CONFLICT DO NOTHING
+                """
+            )
+            counts["matches"] = cur.rowcount
+
+            # Просмотры: 1-3 раза, срок повторного показа как в record_views (7/30/180 дней)
+            cur.execute(
+                f"""
+                INSERT INTO viewed_profiles (viewer_user, viewed_user, first_view, can_view_again, view_count)
+                SELECT source, target, seen_at,
+                       seen_at + CASE view_count WHEN 1 THEN INTERVAL '7 days'
+                                                 WHEN 2 THEN INTERVAL '30 days'
+                                                 ELSE INTERVAL '180 days' END,
+                       view_count
+                FROM (
+                    SELECT source, target,
+                           CURRENT_TIMESTAMP - random() * INTERVAL '60 days' AS seen_at,
+                           1 + floor(-ln(1 - random()) * 0.5)::int AS view_count
+                    FROM ({TARGETS_SQL.format(count_column="views_count")}) t
+                    WHERE target IS NOT NULL AND target <> source
+                ) v
+                ON CONFLICT DO NOTHING
+                """,
+                (users,),
+            )
+            counts["viewed_profiles"] = cur.rowcount
+        conn.commit()
+
+        # VACUUM нельзя выполнять внутри транзакции
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE users, user_photos, likes, matches, viewed_profiles")
+        conn.autocommit = False
+
+    counts["seconds"] = round(time.perf_counter() - started, 1)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="пользователей в базе")
+    parser.add_argument("--likes", type=float, default=20, help="лайков на пользователя в среднем")
+    parser.add_argument("--views", type=float, default=60, help="просмотров на пользователя в среднем")
+    parser.add_argument("--male-share", type=float, default=0.5, help="доля мужчин")
+    parser.add_argument("--seed", type=float, default=0.42, help="зерно random() в Postgres (-1..1)")
+    args = parser.parse_args()
+
+    print(f"Заполнение базы: {args.users} пользователей...")
+    counts = populate(args.users, args.likes, args.views, args.seed, male_share=args.male_share)
+    for table, count in counts.items():
+        print(f"  {table}: {count}")
+    Database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Имитация Telegram для webhook режима: POST обновлений на локальный сервер бота.
+
+Обновления берутся из файла (JSON на строку, как их присылает Telegram) или
+генерируются: текстовые сообщения от --users пользователей. Скрипт показывает
+статусы ответов, скорость приема и задержку ответа сервера.
+
+    BOT_MODE=webhook WEBHOOK_PORT=8443 python bot.py
+    python benchmarks/webhook_replay.py --url http://127.0.0.1:8443/telegram --updates 5000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import time
+from collections import Counter
+
+import httpx
+
+
+def synthetic_updates(users: int, count: int):
+    texts = ["/start", "привет", "Київ", "25", "/cancel"]
+    now = int(time.time())
+    for update_id in range(1, count + 1):
+        user_id = random.randint(1, users)
+        text = random.choice(texts)
+        message = {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            # Без entity CommandHandler не узнает команду
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        yield {"update_id": update_id, "message": message}
+
+
+def recorded_updates(path: str, count: int):
+    with open(path, encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    for line in itertools.islice(itertools.cycle(lines), count):
+        yield json.loads(line)
+
+
+async def replay(url: str, updates, concurrency: int, secret: str = None):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses = Counter()
+    latencies = []
+    queue = asyncio.Queue(concurrency * 2)
+
+    async def sender(client: httpx.AsyncClient):
+        while True:
+            update = await queue.get()
+            if update is None:
+                return
+            # Как и Telegram, повторяем доставку, пока сервер отвечает 503
+            while True:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] += 1
+                if status != 503:
+                    break
+                await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+
+    started = time.perf_counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        senders = [asyncio.create_task(sender(client)) for _ in range(concurrency)]
+        for update in updates:
+            await queue.put(update)
+        for _ in senders:
+            await queue.put(None)
+        await asyncio.gather(*senders)
+    return statuses, latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", help="значение WEBHOOK_SECRET бота")
+    parser.add_argument("--file", help="JSONL с записанными обновлениями")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100, help="пользователей в сгенерированных обновлениях")
+    parser.add_argument("--concurrency", type=int, default=40, help="одновременных соединений, как max_connections")
+    args = parser.parse_args()
+
+    if args.file:
+        updates = recorded_updates(args.file, args.updates)
+    else:
+        updates = synthetic_updates(args.users, args.updates)
+
+    statuses, latencies, elapsed = asyncio.run(replay(args.url, updates, args.concurrency, args.secret))
+    latencies.sort()
+    print(f"отправлено {args.updates} обновлений за {elapsed:.2f} сек ({args.updates / elapsed:.0f}/сек)")
+    print("статусы:", dict(statuses))
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"задержка: p50 {statistics.median(latencies) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,944 +1,1697 @@
-def create_browse_keyboard(target_id: int):
-    keyboard = [
-        [
-            InlineKeyboardButton("❤️", callback_data=f"like_{target_id}"),
-            InlineKeyboardButton("👎", callback_data=f"skip_{target_id}")
-        ],
-        [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f"complaint_{target_id}")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+import os
+import atexit
+import logging
+import logging.handlers
+import psycopg2
+import psycopg2.extras
+from datetime import datetime, timedelta
+from typing import Callable, Optional, List, Dict, Tuple, NamedTuple
+import bisect
+import csv
+import math
+import random
+import string
+import asyncio
+import re
+import json
+import threading
+import time
+import functools
+import hashlib
+import heapq
+import hmac
+import multiprocessing
+import queue
+import select
+import signal
+import struct
+from array import array
+from collections import Counter, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import httpx
 
-def format_profile_text(user_data) -> str:
-    photos = UserManager.get_user_photos(user_data['user_id'])
-    photo_count = len(photos) if photos else 0
-    
-    search_location = "🌍 Вся Украина" if user_data.get('search_all_ukraine') or user_data['search_city'].lower() == 'вся украина' else f"📍 {user_data['search_city']} ({user_data['search_radius']} км)"
-    
-    return f"""👤 {user_data['name']}, {user_data['age']} лет
-🚻 {GENDERS.get(user_data['gender'], user_data['gender'])}
-📍 {user_data['current_city']}
-🔍 Ищет: {search_location}
-💕 Цель: {DATING_GOALS.get(user_data['dating_goal'], user_data['dating_goal'])}
-📸 Фото: {photo_count}
+try:
+    import redis
+except ImportError:  # redis нужен только для общего кэша анкет
+    redis = None
 
-📝 О себе:
-{user_data['bio']}"""
+from telegram import (
+    Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, 
+    ReplyKeyboardRemove, InputMediaPhoto
+)
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ContextTypes, filters, ConversationHandler, BaseUpdateProcessor,
+    BasePersistence, PersistenceInput, Updater
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 
-# Команда /start
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    
-    if UserManager.is_user_banned(user_id):
-        await update.message.reply_text("❌ Ваш аккаунт заблокирован.")
-        return ConversationHandler.END
-    
-    if UserManager.user_exists(user_id):
-        await update.message.reply_text(
-            "Добро пожаловать обратно! Выберите действие:",
-            reply_markup=create_main_menu()
-        )
-        return ConversationHandler.END
-    
-    # Проверка капчи
-    if not CaptchaManager.is_verified(user_id):
-        question, answer = CaptchaManager.generate_captcha()
-        context.user_data['captcha_answer'] = answer
-        
-        await update.message.reply_text(
-            f"🤖 Подтвердите, что вы человек.\n\nРешите пример: {question}",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        return CAPTCHA
-    
-    await update.message.reply_text(
-        "Привет! Давайте создадим вашу анкету для знакомств.\n\nКак вас зовут?",
-        reply_markup=ReplyKeyboardRemove()
+# Загрузка переменных окружения
+load_dotenv()
+
+# Конфигурация
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой сервер Bot API (или заглушка в бенчмарках)
+DATABASE_URL = os.getenv("DATABASE_URL")
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # polling или webhook
+ADMIN_IDS = [8096476392]
+
+# Режим webhook: обновления принимает встроенный HTTP сервер
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес для setWebhook; пусто - webhook настроен снаружи
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # при переполнении отвечаем 503
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # соединений от Telegram
+
+# Несколько процессов-воркеров, пользователи распределяются по user_id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_WORKER_QUEUE_SIZE = int(os.getenv("BOT_WORKER_QUEUE_SIZE", "1000"))  # обновлений в очереди воркера
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))  # сек
+PERSISTENCE_CONVERSATION_TTL = float(os.getenv("PERSISTENCE_CONVERSATION_TTL", "7"))  # дней, брошенные диалоги не загружаем
+
+# Защита от флуда: класс действия -> токенов в секунду / максимум подряд
+FLOOD_ENABLED = os.getenv("FLOOD_ENABLED", "true").lower() == "true"
+FLOOD_LIMITS = {
+    action: tuple(float(part) for part in limit.split("/"))
+    for action, limit in (
+        # Значения из FLOOD_LIMITS дополняют встроенные, а не заменяют весь набор
+        item.strip().split("=") for item in (
+            "browse=1/5,like=1/5,complaint=0.1/4,registration=1/10,default=2/10,"
+            + os.getenv("FLOOD_LIMITS", "")
+        ).split(",") if item.strip()
     )
-    return NAME
+}
+FLOOD_MAX_DELAY = float(os.getenv("FLOOD_MAX_DELAY", "1"))  # сек, дольше ждать не будем - отбрасываем
+FLOOD_NOTICE_INTERVAL = float(os.getenv("FLOOD_NOTICE_INTERVAL", "10"))  # сек между предупреждениями
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "50000"))  # пользователей с состоянием в памяти
 
-# Обработка капчи
-async def handle_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_answer = update.message.text.strip()
-    correct_answer = context.user_data.get('captcha_answer', '')
-    user_id = update.effective_user.id
-    
-    if user_answer == correct_answer:
-        CaptchaManager.verify_user(user_id)
-        await update.message.reply_text(
-            "✅ Отлично! Теперь давайте создадим вашу анкету.\n\nКак вас зовут?"
-        )
-        return NAME
-    else:
-        attempts = CaptchaManager.increment_attempts(user_id)
-        
-        if attempts >= 3:
-            await update.message.reply_text(
-                "❌ Слишком много неверных попыток. Попробуйте позже командой /start"
-            )
-            return ConversationHandler.END
-        
-        question, answer = CaptchaManager.generate_captcha()
-        context.user_data['captcha_answer'] = answer
-        
-        await update.message.reply_text(
-            f"❌ Неверно. Попытка {attempts}/3\n\nПопробуйте еще раз: {question}"
-        )
-        return CAPTCHA
+# Очередь исходящих сообщений (лимиты Telegram: ~30 сообщений/сек на бота, ~1/сек в чат)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # сообщений/сек на всех воркеров
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # сообщений/сек в один чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))  # сколько можно отправить в чат подряд
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "16"))  # одновременных запросов к Bot API
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))  # повторов при сетевых ошибках
+SEND_DRAIN_TIMEOUT = float(os.getenv("SEND_DRAIN_TIMEOUT", "10"))  # сек на досылку при остановке
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "30"))  # сек, окно сводки жалоб
+ADMIN_DIGEST_THRESHOLD = int(os.getenv("ADMIN_DIGEST_THRESHOLD", "3"))  # жалоб за окно, после которых шлем сводку
 
-# Регистрация - имя
-async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    name = update.message.text.strip()
-    if len(name) < 2 or len(name) > 50:
-        await update.message.reply_text("Имя должно быть от 2 до 50 символов. Попробуйте еще раз:")
-        return NAME
-    
-    context.user_data['name'] = name
-    await update.message.reply_text("Сколько вам лет? (от 16 до 100)")
-    return AGE
+# Пул соединений с БД
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # ожидание свободного соединения, сек
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))  # закрывать простаивающие дольше, сек
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))  # пересоздавать старые соединения, сек
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # пинговать простоявшие дольше, сек
 
-# Регистрация - возраст
-async def get_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        age = int(update.message.text)
-        if 16 <= age <= 100:
-            context.user_data['age'] = age
-            
-            keyboard = [
-                [InlineKeyboardButton("👨 Мужчина", callback_data="gender_male")],
-                [InlineKeyboardButton("👩 Женщина", callback_data="gender_female")]
-            ]
-            
-            await update.message.reply_text(
-                "Выберите ваш пол:", 
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return GENDER
-        else:
-            await update.message.reply_text("Возраст должен быть от 16 до 100 лет:")
-            return AGE
-    except ValueError:
-        await update.message.reply_text("Введите возраст числом:")
-        return AGE
+# Асинхронный доступ к БД
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+DB_MAX_PENDING = int(os.getenv("DB_MAX_PENDING", "200"))  # максимум запросов в работе и очереди
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
 
-# Регистрация - пол
-async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Лента кандидатов
+FEED_BATCH_SIZE = int(os.getenv("FEED_BATCH_SIZE", "50"))
+FEED_REFILL_THRESHOLD = int(os.getenv("FEED_REFILL_THRESHOLD", "10"))
+FEED_MAX_VIEWERS = int(os.getenv("FEED_MAX_VIEWERS", "10000"))
+FEED_PREFETCH = os.getenv("FEED_PREFETCH", "true").lower() == "true"  # грузить следующую анкету заранее
+FEED_PREFETCH_TTL = float(os.getenv("FEED_PREFETCH_TTL", "120"))  # сек, дольше заготовка считается устаревшей
+
+# Кэш анкет
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))  # сек
+PROFILE_CACHE_REDIS_URL = os.getenv("PROFILE_CACHE_REDIS_URL")  # общий кэш для нескольких процессов
+
+# Отложенная запись просмотров анкет
+VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", "0"))  # сек, 0 - писать каждый просмотр сразу
+VIEW_BUFFER_MAX = int(os.getenv("VIEW_BUFFER_MAX", "5000"))  # сбрасывать досрочно при таком числе записей
+
+# Фильтр просмотренных анкет в памяти (вместо NOT IN по likes и viewed_profiles)
+SEEN_FILTER_ENABLED = os.getenv("SEEN_FILTER_ENABLED", "true").lower() == "true"
+SEEN_FILTER_MAX_VIEWERS = int(os.getenv("SEEN_FILTER_MAX_VIEWERS", "10000"))
+SEEN_FILTER_CAPACITY = int(os.getenv("SEEN_FILTER_CAPACITY", "1024"))  # ID в одном фильтре Блума
+SEEN_FILTER_ERROR_RATE = float(os.getenv("SEEN_FILTER_ERROR_RATE", "0.01"))
+SEEN_BUCKET_DAYS = int(os.getenv("SEEN_BUCKET_DAYS", "7"))  # шаг слоев с истечением
+SEEN_SAVE_EVERY = int(os.getenv("SEEN_SAVE_EVERY", "50"))  # сохранять в БД после стольких изменений
+
+# Капча
+CAPTCHA_TTL = float(os.getenv("CAPTCHA_TTL", "300"))  # сек на ответ
+CAPTCHA_MAX_ATTEMPTS = int(os.getenv("CAPTCHA_MAX_ATTEMPTS", "3"))  # ошибок за окно до блокировки
+CAPTCHA_LOCKOUT_WINDOW = float(os.getenv("CAPTCHA_LOCKOUT_WINDOW", "900"))  # сек, скользящее окно ошибок
+CAPTCHA_MAX_PENDING = int(os.getenv("CAPTCHA_MAX_PENDING", "100000"))  # записей в памяти на каждый вид
+
+# Метрики (формат Prometheus)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 - без HTTP; воркер N слушает METRICS_PORT + N
+METRICS_FILE = os.getenv("METRICS_FILE")  # периодическая выгрузка в файл (для node_exporter textfile)
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "15"))  # сек
+
+# Журнал медленных запросов
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))  # порог в мс, 0 - выключен
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"  # EXPLAIN ANALYZE первого случая
+SLOW_QUERY_MAX_PLANS = int(os.getenv("SLOW_QUERY_MAX_PLANS", "1000"))  # форм запросов с сохраненным планом
+
+# Логирование
+LOG_DIR = os.getenv("LOG_DIR", ".")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))  # ротация по размеру, 0 - без ротации
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")  # ротация по времени вместо размера: midnight, H, D...
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))  # сколько старых файлов хранить
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # записей в очереди, лишние отбрасываются
+USER_LOG_FORMAT = os.getenv("USER_LOG_FORMAT", "text").lower()  # text или json (JSON lines)
+
+# Справочник населенных пунктов
+CITIES_FILE = os.getenv(
+    "CITIES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ua_cities.csv")
+)
+
+if not TELEGRAM_TOKEN or not DATABASE_URL:
+    raise ValueError("TELEGRAM_TOKEN и DATABASE_URL должны быть установлены в .env файле")
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE должен быть polling или webhook")
+
+if USER_LOG_FORMAT not in ("text", "json"):
+    raise ValueError("USER_LOG_FORMAT должен быть text или json")
+
+# Настройка логирования
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует поток"""
     
-    gender = "male" if query.data == "gender_male" else "female"
-    context.user_data['gender'] = gender
+    dropped = 0
     
-    await query.edit_message_text("В каком городе вы находитесь сейчас? (напишите название)")
-    return CURRENT_CITY
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
 
-# Регистрация - текущий город
-async def get_current_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    city = update.message.text.strip()
-    if len(city) < 2:
-        await update.message.reply_text("Введите корректное название города:")
-        return CURRENT_CITY
+class JsonLinesFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, уровень, текст и поля из extra"""
     
-    context.user_data['current_city'] = city
-    # Здесь можно добавить геокодинг для получения координат
+    FIELDS = ("action", "user_id", "target_id", "field", "value", "reason", "complaints")
     
-    await update.message.reply_text("В каком городе вы хотите искать знакомства? (или напишите 'вся украина')")
-    return SEARCH_CITY
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
-# Регистрация - город поиска
-async def get_search_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    city = update.message.text.strip()
-    if len(city) < 2:
-        await update.message.reply_text("Введите корректное название города:")
-        return SEARCH_CITY
+class LogPipeline:
+    """Запись логов в фоновом потоке.
+
+    Обработчики (в том числе event loop) только кладут запись в очередь;
+    файлы и консоль пишет QueueListener. Файлы ротируются по размеру
+    (LOG_MAX_BYTES) или по времени (LOG_ROTATE_WHEN), хранится LOG_BACKUP_COUNT копий.
+    """
     
-    context.user_data['search_city'] = city
+    _listener: Optional[logging.handlers.QueueListener] = None
+    _queue_handler: Optional[DroppingQueueHandler] = None
     
-    if city.lower() == 'вся украина':
-        context.user_data['search_radius'] = 0
-        context.user_data['search_all_ukraine'] = True
+    @staticmethod
+    def _file_handler(filename: str) -> logging.Handler:
+        path = os.path.join(LOG_DIR, filename)
+        if LOG_ROTATE_WHEN:
+            return logging.handlers.TimedRotatingFileHandler(
+                path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True
+            )
+        if LOG_MAX_BYTES > 0:
+            return logging.handlers.RotatingFileHandler(
+                path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True
+            )
+        return logging.FileHandler(path, encoding="utf-8", delay=True)
+    
+    @staticmethod
+    def setup(suffix: str = ""):
+        """Настраивает (или перенастраивает) логирование. suffix добавляется к именам
+        файлов: у процессов-воркеров свои файлы, иначе они мешали бы друг другу ротировать"""
+        LogPipeline.stop()
         
-        # Переходим сразу к целям знакомства
-        keyboard = []
-        for key, value in DATING_GOALS.items():
-            keyboard.append([InlineKeyboardButton(value, callback_data=f"goal_{key}")])
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        bot_file = LogPipeline._file_handler(f"bot{suffix}.log")
+        console = logging.StreamHandler()
+        for handler in (bot_file, console):
+            handler.setFormatter(formatter)
         
-        await update.message.reply_text(
-            "Выберите цель знакомства:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return DATING_GOAL
-    else:
-        context.user_data['search_all_ukraine'] = False
-        keyboard = [
-            [InlineKeyboardButton("10 км", callback_data="radius_10")],
-            [InlineKeyboardButton("25 км", callback_data="radius_25")],
-            [InlineKeyboardButton("50 км", callback_data="radius_50")],
-            [InlineKeyboardButton("100 км", callback_data="radius_100")]
-        ]
+        # Действия пользователей - в отдельный файл (и, как раньше, в общий лог)
+        user_file = LogPipeline._file_handler(f"user_actions{suffix}.{'jsonl' if USER_LOG_FORMAT == 'json' else 'log'}")
+        user_file.addFilter(logging.Filter('user_actions'))
+        if USER_LOG_FORMAT == "json":
+            user_file.setFormatter(JsonLinesFormatter())
+        else:
+            user_file.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
         
-        await update.message.reply_text(
-            "Выберите радиус поиска:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        LogPipeline._queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        root.addHandler(LogPipeline._queue_handler)
+        
+        LogPipeline._listener = logging.handlers.QueueListener(
+            LogPipeline._queue_handler.queue, bot_file, console, user_file, respect_handler_level=True
         )
-        return SEARCH_RADIUS
-
-# Регистрация - радиус поиска
-async def get_search_radius(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+        LogPipeline._listener.start()
     
-    radius = int(query.data.split("_")[1])
-    context.user_data['search_radius'] = radius
-    
-    keyboard = []
-    for key, value in DATING_GOALS.items():
-        keyboard.append([InlineKeyboardButton(value, callback_data=f"goal_{key}")])
+    @staticmethod
+    def stop():
+        """Дописывает накопленные записи и закрывает файлы"""
+        listener, LogPipeline._listener = LogPipeline._listener, None
+        if LogPipeline._queue_handler is not None:
+            logging.getLogger().removeHandler(LogPipeline._queue_handler)
+            LogPipeline._queue_handler = None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
     
-    await query.edit_message_text(
-        "Выберите цель знакомства:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    return DATING_GOAL
+    @staticmethod
+    def get_stats() -> dict:
+        handler = LogPipeline._queue_handler
+        return {
+            "queued": handler.queue.qsize() if handler else 0,
+            "dropped": DroppingQueueHandler.dropped,
+        }
 
-# Регистрация - цель знакомства
-async def get_dating_goal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    goal = query.data.split("_")[1]
-    context.user_data['dating_goal'] = goal
-    
-    await query.edit_message_text("Напишите немного о себе (до 500 символов):")
-    return BIO
+LogPipeline.setup()
+atexit.register(LogPipeline.stop)
+logger = logging.getLogger(__name__)
 
-# Регистрация - био
-async def get_bio(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bio = update.message.text.strip()[:500]
-    if len(bio) < 10:
-        await update.message.reply_text("Описание должно быть минимум 10 символов. Расскажите о себе подробнее:")
-        return BIO
-    
-    context.user_data['bio'] = bio
-    await update.message.reply_text(
-        "Теперь загрузите ваши фотографии (от 1 до 5 фото). Отправьте первое фото:"
-    )
-    context.user_data['photos'] = []
-    return PHOTO
+# Дополнительные логи для действий пользователей
+user_logger = logging.getLogger('user_actions')
+user_logger.setLevel(logging.INFO)
 
-# Регистрация - фотографии
-async def get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.photo:
-        await update.message.reply_text("Пожалуйста, отправьте фотографию:")
-        return PHOTO
-    
-    photo_id = update.message.photo[-1].file_id
-    photos = context.user_data.get('photos', [])
-    photos.append(photo_id)
-    context.user_data['photos'] = photos
-    
-    if len(photos) < 5:
-        keyboard = [
-            [InlineKeyboardButton("✅ Закончить", callback_data="finish_photos")]
-        ]
-        await update.message.reply_text(
-            f"Фото {len(photos)}/5 загружено. Загрузите еще одно фото или нажмите 'Закончить':",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+# Состояния для регистрации
+(NAME, AGE, GENDER, CURRENT_CITY, SEARCH_CITY, SEARCH_RADIUS, 
+ DATING_GOAL, BIO, PHOTO, CAPTCHA) = range(10)
+
+# Состояния для редактирования
+(EDIT_NAME, EDIT_AGE, EDIT_BIO, EDIT_PHOTOS, EDIT_CURRENT_CITY, 
+ EDIT_SEARCH_CITY, EDIT_SEARCH_RADIUS, EDIT_DATING_GOAL) = range(100, 108)
+
+# Константы
+DATING_GOALS = {
+    'relationship': 'Отношения',
+    'friendship': 'Дружба', 
+    'online_chat': 'Общение онлайн',
+    'short_romance': 'Короткий роман',
+    'gaming': 'Совместный гейминг'
+}
+
+GENDERS = {
+    'male': 'Мужчина',
+    'female': 'Женщина'
+}
+
+EARTH_RADIUS_KM = 6371.0
+
+class PoolExhaustedError(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул соединений с PostgreSQL"""
+
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10, timeout: float = 5.0,
+                 max_idle: float = 300.0, max_lifetime: float = 3600.0, healthcheck_idle: float = 30.0):
+        self.dsn = dsn
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.healthcheck_idle = healthcheck_idle
+
+        # Свободные соединения: (conn, last_used)
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.stats = {
+            'checkouts': 0,
+            'created': 0,
+            'closed': 0,
+            'recycled': 0,
+            'healthcheck_failures': 0,
+            'exhausted': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.RealDictCursor)
+        self._created_at[id(conn)] = time.monotonic()
+        self.stats['created'] += 1
+        return conn
+
+    def _close(self, conn):
+        self._created_at.pop(id(conn), None)
+        self.stats['closed'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def open(self):
+        """Открывает минимальное количество соединений"""
+        with self._cond:
+            while self._size < self.min_size:
+                self._size += 1
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._size -= 1
+                    raise
+                self._idle.append((conn, time.monotonic()))
+
+    def close(self):
+        """Закрывает пул и все свободные соединения"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+            self._cond.notify_all()
+
+    def _reap_idle(self, now: float):
+        """Закрывает соединения, простаивающие дольше max_idle (сверх min_size)"""
+        while self._idle and self._size > self.min_size:
+            conn, last_used = self._idle[0]
+            if now - last_used < self.max_idle:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self.stats['recycled'] += 1
+            self._close(conn)
+
+    def _is_healthy(self, conn, last_used: float, now: float) -> bool:
+        if conn.closed:
+            return False
+        if now - self._created_at.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.healthcheck_idle:
+            # Соединение долго простаивало - могло быть закрыто сервером
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def getconn(self):
+        """Выдает соединение из пула, ожидая освобождения не дольше timeout"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolExhaustedError("Пул соединений закрыт")
+
+                    now = time.monotonic()
+                    self._reap_idle(now)
+
+                    if self._idle:
+                        # LIFO: самые "горячие" соединения выдаются первыми
+                        conn, last_used = self._idle.pop()
+                        break
+
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+
+                    if not waited:
+                        waited = True
+                        self.stats['exhausted'] += 1
+                        logger.debug(f"Пул соединений исчерпан ({self._size}/{self.max_size}), ожидание")
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise PoolExhaustedError(
+                            f"Нет свободных соединений в пуле за {self.timeout} сек"
+                        )
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                # Открываем новое соединение вне блокировки
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, last_used, time.monotonic()):
+                self.stats['healthcheck_failures'] += 1
+                with self._cond:
+                    self._size -= 1
+                    self._close(conn)
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self.stats['checkouts'] += 1
+                self.stats['wait_time_total'] += time.monotonic() - started
+            return conn
+
+    def putconn(self, conn, discard: bool = False):
+        """Возвращает соединение в пул"""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока: commit при успехе, rollback при ошибке"""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                **self.stats,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            }
+
+# Миграции схемы БД: (версия, описание, команды).
+# Команды должны быть идемпотентными. Обычные команды миграции выполняются в одной
+# транзакции, команды с CONCURRENTLY - после нее, вне транзакции, не блокируя запись в таблицы.
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            current_city TEXT NOT NULL,
+            current_lat FLOAT,
+            current_lon FLOAT,
+            search_city TEXT NOT NULL,
+            search_lat FLOAT,
+            search_lon FLOAT,
+            search_radius INTEGER DEFAULT 50,
+            search_all_ukraine BOOLEAN DEFAULT FALSE,
+            dating_goal TEXT NOT NULL,
+            bio TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            is_banned BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            name_changes INTEGER DEFAULT 0,
+            last_name_change TIMESTAMP,
+            age_changes INTEGER DEFAULT 0,
+            last_age_change TIMESTAMP,
+            location_changes_today INTEGER DEFAULT 0,
+            location_changes_month INTEGER DEFAULT 0,
+            last_location_change TIMESTAMP
         )
-        return PHOTO
-    else:
-        return await finish_registration(update, context)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_photos (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            photo_id TEXT NOT NULL,
+            is_main BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS likes (
+            from_user BIGINT NOT NULL,
+            to_user BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (from_user, to_user)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS matches (
+            user1 BIGINT NOT NULL,
+            user2 BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user1, user2)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS viewed_profiles (
+            viewer_user BIGINT NOT NULL,
+            viewed_user BIGINT NOT NULL,
+            first_view TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            can_view_again TIMESTAMP,
+            view_count INTEGER DEFAULT 1,
+            PRIMARY KEY (viewer_user, viewed_user)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS complaints (
+            id SERIAL PRIMARY KEY,
+            from_user BIGINT NOT NULL,
+            against_user BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            resolved_at TIMESTAMP,
+            resolved_by BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS captcha_attempts (
+            user_id BIGINT PRIMARY KEY,
+            attempts INTEGER DEFAULT 0,
+            last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_verified BOOLEAN DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_limits (
+            user_id BIGINT PRIMARY KEY,
+            complaints_today INTEGER DEFAULT 0,
+            last_complaint_date DATE DEFAULT CURRENT_DATE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_location ON users(current_lat, current_lon)",
+        "CREATE INDEX IF NOT EXISTS idx_users_search ON users(search_lat, search_lon)",
+        "CREATE INDEX IF NOT EXISTS idx_likes_from_user ON likes(from_user)",
+        "CREATE INDEX IF NOT EXISTS idx_likes_to_user ON likes(to_user)",
+        "CREATE INDEX IF NOT EXISTS idx_matches_users ON matches(user1, user2)",
+        "CREATE INDEX IF NOT EXISTS idx_viewed_profiles ON viewed_profiles(viewer_user)",
+        "CREATE INDEX IF NOT EXISTS idx_complaints_against ON complaints(against_user)",
+    ]),
+    (2, "ID городов из справочника", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS current_city_id INTEGER",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS search_city_id INTEGER",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_current_city_id ON users(current_city_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_search_city_id ON users(search_city_id)",
+    ]),
+    (3, "Атомарная регистрация лайка и матча", [
+        """
+        CREATE OR REPLACE FUNCTION register_like(p_from BIGINT, p_to BIGINT) RETURNS BOOLEAN AS $$
+        DECLARE
+            v_mutual BOOLEAN;
+        BEGIN
+            -- Встречные лайки одной пары выполняются по очереди: второй дождется
+            -- коммита первого и увидит его лайк, поэтому матч не потеряется
+            PERFORM pg_advisory_xact_lock(
+                hashtextextended(LEAST(p_from, p_to)::TEXT || ':' || GREATEST(p_from, p_to)::TEXT, 0)
+            );
+            
+            INSERT INTO likes (from_user, to_user) VALUES (p_from, p_to) ON CONFLICT DO NOTHING;
+            
+            SELECT EXISTS (
+                SELECT 1 FROM likes WHERE from_user = p_to AND to_user = p_from
+            ) INTO v_mutual;
+            
+            IF v_mutual THEN
+                INSERT INTO matches (user1, user2)
+                VALUES (LEAST(p_from, p_to), GREATEST(p_from, p_to))
+                ON CONFLICT DO NOTHING;
+            END IF;
+            
+            RETURN v_mutual;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+    ]),
+    (4, "Сохраненные фильтры просмотренных анкет", [
+        """
+        CREATE TABLE IF NOT EXISTS seen_filters (
+            viewer_user BIGINT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            saved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (5, "Состояние диалогов бота", [
+        """
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            user_id BIGINT,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        )
+        """,
+    ]),
+    (6, "Очистка неудачных попыток капчи (теперь хранятся в памяти)", [
+        "DELETE FROM captcha_attempts WHERE is_verified = FALSE",
+    ]),
+    (7, "Планы медленных запросов", [
+        """
+        CREATE TABLE IF NOT EXISTS slow_query_plans (
+            fingerprint TEXT PRIMARY KEY,
+            query TEXT NOT NULL,
+            params TEXT,
+            duration_ms REAL NOT NULL,
+            plan TEXT NOT NULL,
+            captured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (8, "Новый формат фильтров просмотренных (старые пересоберутся из БД)", [
+        "DELETE FROM seen_filters",
+    ]),
+]
 
-# Завершение добавления фото
-async def finish_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    return await finish_registration(update, context)
+class SchemaMigrations:
+    """Версионные миграции схемы БД"""
+    
+    # Ключ advisory-блокировки: при одновременном запуске нескольких экземпляров
+    # миграции применяет только один, остальные ждут
+    LOCK_KEY = 5_240_917_001
+    
+    @staticmethod
+    def latest_version() -> int:
+        return max(version for version, _, _ in MIGRATIONS)
+    
+    @staticmethod
+    def _current_version(cur) -> int:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS exists")
+        if not cur.fetchone()['exists']:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+        return cur.fetchone()['version']
+    
+    @staticmethod
+    def _run_concurrently(cur, command: str):
+        """CREATE INDEX CONCURRENTLY; при ошибке удаляет оставшийся невалидный индекс"""
+        try:
+            cur.execute(command)
+        except Exception:
+            match = re.search(r"INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", command, re.IGNORECASE)
+            if match:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+            raise
+    
+    @staticmethod
+    def apply() -> int:
+        """Применяет недостающие миграции, возвращает их количество"""
+        pool = Database.get_pool()
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                # Быстрый путь: схема уже актуальна
+                if SchemaMigrations._current_version(cur) >= SchemaMigrations.latest_version():
+                    return 0
+                
+                cur.execute("SELECT pg_advisory_lock(%s)", (SchemaMigrations.LOCK_KEY,))
+                try:
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                            version INTEGER PRIMARY KEY,
+                            description TEXT NOT NULL,
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    """)
+                    # Пока ждали блокировку, миграции мог применить другой экземпляр
+                    current = SchemaMigrations._current_version(cur)
+                    applied = 0
+                    
+                    for version, description, commands in sorted(MIGRATIONS):
+                        if version <= current:
+                            continue
+                        
+                        started = time.monotonic()
+                        transactional = [c for c in commands if 'CONCURRENTLY' not in c.upper()]
+                        concurrent = [c for c in commands if 'CONCURRENTLY' in c.upper()]
+                        
+                        cur.execute("BEGIN")
+                        try:
+                            for command in transactional:
+                                cur.execute(command)
+                            cur.execute("COMMIT")
+                        except Exception:
+                            cur.execute("ROLLBACK")
+                            raise
+                        
+                        for command in concurrent:
+                            SchemaMigrations._run_concurrently(cur, command)
+                        
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description)
+                        )
+                        applied += 1
+                        logger.info(
+                            f"Миграция {version} ({description}) применена за {time.monotonic() - started:.2f} сек"
+                        )
+                    
+                    return applied
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (SchemaMigrations.LOCK_KEY,))
+        finally:
+            try:
+                conn.autocommit = False
+            except Exception:
+                pass
+            pool.putconn(conn, discard=bool(conn.closed))
 
-# Завершение регистрации
-async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_data = {
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username,
-        **context.user_data
-    }
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (как histogram в Prometheus)"""
     
-    if UserManager.create_user(user_data):
-        # Сохраняем фотографии
-        for i, photo_id in enumerate(context.user_data.get('photos', [])):
-            UserManager.add_photo(user_data['user_id'], photo_id, i == 0)  # Первое фото - главное
-        
-        message_text = "Профиль успешно создан! Добро пожаловать в бот знакомств."
-        
-        if hasattr(update, 'callback_query') and update.callback_query:
-            await update.callback_query.edit_message_text(
-                message_text,
-                reply_markup=create_main_menu()
-            )
-        else:
-            await update.message.reply_text(
-                message_text,
-                reply_markup=create_main_menu()
-            )
-    else:
-        await update.message.reply_text("Ошибка создания профиля. Попробуйте еще раз с /start")
+    __slots__ = ("counts", "sum", "count")
     
-    return ConversationHandler.END
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.sum += value
+        self.count += 1
 
-# Просмотр анкет
-async def browse_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if query:
-        await query.answer()
-        user_id = query.from_user.id
-    else:
-        user_id = update.effective_user.id
+class Metrics:
+    """Метрики горячего пути в формате Prometheus.
     
-    if UserManager.is_user_banned(user_id):
-        text = "Ваш аккаунт заблокирован."
-        if query:
-            await query.edit_message_text(text)
-        else:
-            await update.message.reply_text(text)
-        return
+    Включаются METRICS_ENABLED: время обработчиков (обертки ставятся только при
+    включенных метриках), вызовов Database.run и отдельных запросов с числом строк,
+    плюс показатели пула, очередей и кэшей из их get_stats() на момент выгрузки.
+    Отдаются по HTTP на METRICS_PORT (+ номер воркера) и/или пишутся в METRICS_FILE.
+    Когда метрики выключены, в горячем пути остается только проверка флага.
+    """
     
-    candidates = MatchManager.find_candidates(user_id)
+    HELP = {
+        "bot_handler_seconds": "Время выполнения обработчика",
+        "bot_handler_errors_total": "Исключения в обработчиках",
+        "bot_db_call_seconds": "Время вызова через Database.run, включая ожидание в очереди",
+        "bot_db_query_seconds": "Время выполнения SQL запроса",
+        "bot_db_query_rows_total": "Строк, возвращенных или измененных запросами",
+        "bot_db_query_errors_total": "Ошибки SQL запросов",
+    }
     
-    if not candidates:
-        text = "Анкеты закончились! Попробуйте позже или измените параметры поиска."
-        keyboard = create_main_menu()
-        if query:
-            await query.edit_message_text(text, reply_markup=keyboard)
-        else:
-            await update.message.reply_text(text, reply_markup=keyboard)
-        return
+    _lock = threading.Lock()
+    _histograms: Dict[Tuple[str, str, str], Histogram] = {}  # (метрика, метка, значение)
+    _counters: Dict[Tuple[str, str, str], float] = {}
+    _query_labels: Dict[str, str] = {}
+    _application: Optional[Application] = None
+    _server: Optional[asyncio.AbstractServer] = None
+    _dump_task: Optional[asyncio.Task] = None
     
-    candidate = candidates[0]
-    text = format_profile_text(candidate)
-    keyboard = create_browse_keyboard(candidate['user_id'])
+    @staticmethod
+    def observe(name: str, label: str, value: str, seconds: float):
+        key = (name, label, value)
+        with Metrics._lock:
+            histogram = Metrics._histograms.get(key)
+            if histogram is None:
+                histogram = Metrics._histograms[key] = Histogram()
+            histogram.observe(seconds)
     
-    # Получаем фотографии пользователя
-    photos = UserManager.get_user_photos(candidate['user_id'])
+    @staticmethod
+    def inc(name: str, label: str, value: str, amount: float = 1):
+        key = (name, label, value)
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + amount
     
-    if query:
-        await query.message.delete()
+    @staticmethod
+    def query_label(query: str) -> str:
+        """Короткое имя запроса для метки: команда и первая таблица ("select users")"""
+        label = Metrics._query_labels.get(query)
+        if label is None:
+            words = query.split(None, 1)
+            verb = words[0].lower() if words else "?"
+            table = re.search(r"\b(?:FROM|INTO|UPDATE)\s+([A-Za-z_][A-Za-z0-9_]*)", query, re.IGNORECASE)
+            label = f"{verb} {table.group(1).lower()}" if table else verb
+            # Запросы почти всегда - строковые константы, но на всякий случай ограничиваем кэш
+            if len(Metrics._query_labels) < 1000:
+                Metrics._query_labels[query] = label
+        return label
     
-    if photos:
-        try:
-            if len(photos) == 1:
-                # Одно фото
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=photos[0]['photo_id'],
-                    caption=text,
-                    reply_markup=keyboard
-                )
-            else:
-                # Несколько фото - отправляем медиа-группу
-                media = []
-                for i, photo in enumerate(photos[:5]):  # Максимум 5 фото в группе
-                    if i == 0:
-                        media.append(InputMediaPhoto(photo['photo_id'], caption=text))
-                    else:
-                        media.append(InputMediaPhoto(photo['photo_id']))
-                
-                await context.bot.send_media_group(chat_id=user_id, media=media)
-                await context.bot.send_message(user_id, "Выберите действие:", reply_markup=keyboard)
-        except Exception as e:
-            logger.error(f"Ошибка отправки фото: {e}")
-            await context.bot.send_message(user_id, text, reply_markup=keyboard)
-    else:
-        await context.bot.send_message(user_id, text, reply_markup=keyboard)
-
-# Обработка лайка
-async def handle_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+    @staticmethod
+    def observe_query(query: str, started: float, rows: Optional[int], failed: bool = False):
+        label = Metrics.query_label(query)
+        Metrics.observe("bot_db_query_seconds", "query", label, time.monotonic() - started)
+        if failed:
+            Metrics.inc("bot_db_query_errors_total", "query", label)
+        elif rows:
+            Metrics.inc("bot_db_query_rows_total", "query", label, rows)
     
-    user_id = query.from_user.id
-    target_id = int(query.data.split('_')[1])
+    @staticmethod
+    def instrument(application: Application, observe: Optional[Callable[[str, float], None]] = None):
+        """Оборачивает обработчики приложения (в том числе внутри ConversationHandler).
+        observe(имя обработчика, секунды) - куда отдавать время, по умолчанию в гистограмму"""
+        if observe is None:
+            def observe(name: str, seconds: float):
+                Metrics.observe("bot_handler_seconds", "handler", name, seconds)
+        
+        def wrap(handler):
+            if isinstance(handler, ConversationHandler):
+                for nested in handler.entry_points + handler.fallbacks:
+                    wrap(nested)
+                for handlers in handler.states.values():
+                    for nested in handlers:
+                        wrap(nested)
+                return
+            callback = handler.callback
+            if getattr(callback, "_metrics_wrapped", False):
+                return
+            name = callback.__name__
+            
+            @functools.wraps(callback)
+            async def timed(update, context):
+                started = time.monotonic()
+                try:
+                    return await callback(update, context)
+                except Exception:
+                    Metrics.inc("bot_handler_errors_total", "handler", name)
+                    raise
+                finally:
+                    observe(name, time.monotonic() - started)
+            
+            timed._metrics_wrapped = True
+            handler.callback = timed
+        
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                wrap(handler)
+        Metrics._application = application
     
-    # Отмечаем как просмотренный
-    MatchManager.mark_viewed(user_id, target_id)
+    @staticmethod
+    def _gauges() -> List[Tuple[str, dict]]:
+        """Текущие показатели подсистем: (префикс метрик, словарь из get_stats)"""
+        sources = [
+            ("db_pool", Database.pool_stats()),
+            ("profile_cache", ProfileCache.get_stats()),
+            ("outbound", OutboundQueue.get_stats()),
+            ("flood", FloodGuard.get_stats()),
+            ("view_buffer", ViewBuffer.get_stats()),
+            ("seen_filter", SeenFilter.get_stats()),
+            ("captcha", CaptchaManager.get_stats()),
+            ("feed", CandidateFeed.stats),
+            ("admin_alerts", AdminNotifier.stats),
+            ("slow_query", SlowQueryLog.get_stats()),
+            ("log", LogPipeline.get_stats()),
+        ]
+        if Database._pending is not None:
+            sources.append(("db", {"pending": DB_MAX_PENDING - Database._pending._value}))
+        application = Metrics._application
+        if application is not None:
+            sources.append(("updates", {
+                "queued": application.update_queue.qsize(),
+                "processing": getattr(application.update_processor, "pending", 0),
+            }))
+            if isinstance(application.persistence, PostgresPersistence):
+                sources.append(("persistence", application.persistence.stats))
+        return sources
     
-    # Ставим лайк
-    is_match = MatchManager.add_like(user_id, target_id)
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
     
-    if is_match:
-        target_user = UserManager.get_user(target_id)
-        current_user = UserManager.get_user(user_id)
+    @staticmethod
+    def render() -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        with Metrics._lock:
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count) for key, h in Metrics._histograms.items()
+            )
+            counters = sorted(Metrics._counters.items())
         
-        # Логируем матч
-        user_logger.info(f"Match created between users {user_id} and {target_id}")
+        described = set()
         
-        # Уведомляем о матче
-        await query.message.delete()
-        await context.bot.send_message(
-            user_id,
-            f"🎉 Взаимная симпатия с {target_user['name']}!\n\n"
-            f"Контакт: @{target_user['username'] or 'скрыт'}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-            ])
-        )
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {Metrics.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
         
-        # Уведомляем второго пользователя
+        for (name, label, value), counts, total, count in histograms:
+            describe(name, "histogram")
+            labels = f'{label}="{Metrics._escape(value)}"'
+            cumulative = 0
+            for bound, bucket in zip(Histogram.BOUNDS, counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        
+        for (name, label, value), amount in counters:
+            describe(name, "counter")
+            lines.append(f'{name}{{{label}="{Metrics._escape(value)}"}} {amount}')
+        
+        for prefix, stats in Metrics._gauges():
+            for key, value in sorted(stats.items()):
+                name = f"bot_{prefix}_{key}"
+                if isinstance(value, dict):
+                    describe(name, "gauge")
+                    for sub_key, sub_value in sorted(value.items(), key=lambda item: str(item[0])):
+                        lines.append(f'{name}{{key="{Metrics._escape(str(sub_key))}"}} {sub_value}')
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    describe(name, "gauge")
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         try:
-            await context.bot.send_message(
-                target_id,
-                f"🎉 Взаимная симпатия с {current_user['name']}!\n\n"
-                f"Контакт: @{current_user['username'] or 'скрыт'}",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("👀 Посмотреть профиль", callback_data="browse")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-                ])
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", Metrics.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"not found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
             )
+            await writer.drain()
         except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {target_id}: {e}")
-    else:
-        await query.message.delete()
-        await context.bot.send_message(
-            user_id,
-            "❤️ Лайк отправлен!",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")]
-            ])
-        )
-
-# Обработка пропуска
-async def handle_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+            logger.debug(f"Ошибка запроса метрик: {e}")
+        finally:
+            writer.close()
     
-    user_id = query.from_user.id
-    target_id = int(query.data.split('_')[1])
-    
-    # Отмечаем как просмотренный
-    MatchManager.mark_viewed(user_id, target_id)
+    @staticmethod
+    def _dump(path: str, text: str):
+        # Пишем во временный файл и подменяем, чтобы сборщик не прочитал половину
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
     
-    # Показываем следующую анкету
-    await query.message.delete()
-    await browse_profiles(update, context)
-
-# Показ матчей
-async def show_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+    @staticmethod
+    async def _dump_loop(path: str):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(METRICS_DUMP_INTERVAL)
+            try:
+                # Показатели подсистем меняет цикл событий, поэтому собираем их здесь
+                # (это быстро), а в поток уходит только запись файла
+                await loop.run_in_executor(None, Metrics._dump, path, Metrics.render())
+            except Exception as e:
+                logger.error(f"Ошибка записи метрик в {path}: {e}")
     
-    matches = MatchManager.get_matches(query.from_user.id)
+    @staticmethod
+    def _file_path(worker_index: int) -> str:
+        return METRICS_FILE if BOT_WORKERS <= 1 else f"{METRICS_FILE}.{worker_index}"
     
-    if not matches:
-        await query.edit_message_text(
-            "У вас пока нет матчей. Ставьте больше лайков!",
-            reply_markup=create_main_menu()
-        )
-        return
-    
-    text = "❤️ Ваши матчи:\n\n"
-    for match in matches[:10]:
-        username = f"@{match['username']}" if match['username'] else "контакт скрыт"
-        text += f"• {match['name']}, {match['age']} — {username}\n"
-    
-    await query.edit_message_text(text, reply_markup=create_main_menu())
-
-# Показ профиля
-async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    user = UserManager.get_user(query.from_user.id)
-    if not user:
-        await query.edit_message_text("Профиль не найден")
-        return
+    @staticmethod
+    async def start(worker_index: int = 0):
+        if METRICS_PORT and Metrics._server is None:
+            port = METRICS_PORT + worker_index
+            Metrics._server = await asyncio.start_server(Metrics._handle, METRICS_LISTEN, port)
+            logger.info(f"Метрики: http://{METRICS_LISTEN}:{port}/metrics")
+        if METRICS_FILE and Metrics._dump_task is None:
+            Metrics._dump_task = asyncio.get_running_loop().create_task(
+                Metrics._dump_loop(Metrics._file_path(worker_index))
+            )
     
-    text = format_profile_text(user)
-    await query.edit_message_text(text, reply_markup=create_main_menu())
-
-# Главное меню
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        "Главное меню:",
-        reply_markup=create_main_menu()
-    )
+    @staticmethod
+    async def stop(worker_index: int = 0):
+        if Metrics._server is not None:
+            Metrics._server.close()
+            await Metrics._server.wait_closed()
+            Metrics._server = None
+        if Metrics._dump_task is not None:
+            Metrics._dump_task.cancel()
+            Metrics._dump_task = None
+            try:
+                Metrics._dump(Metrics._file_path(worker_index), Metrics.render())
+            except Exception as e:
+                logger.error(f"Ошибка записи метрик: {e}")
 
-# Жалоба на пользователя
-async def handle_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+class SlowQueryLog:
+    """Журнал медленных запросов.
     
-    target_id = int(query.data.split('_')[1])
-    user_id = query.from_user.id
+    Запрос дольше SLOW_QUERY_MS пишется в лог с нормализованным текстом (литералы
+    и списки параметров свернуты, поэтому разные ветки find_candidates дают разные
+    формы), отпечатком формы, отпечатком параметров и длительностью. При
+    SLOW_QUERY_EXPLAIN для первого медленного запроса каждой формы в отдельном
+    потоке снимается EXPLAIN (ANALYZE, BUFFERS) - в транзакции с откатом - и
+    сохраняется в slow_query_plans.
+    """
     
-    can_complain, message = ComplaintManager.can_file_complaint(user_id)
-    if not can_complain:
-        await query.answer(message, show_alert=True)
-        return
+    _lock = threading.Lock()
+    _normalized: Dict[str, Tuple[str, str]] = {}  # запрос -> (нормализованный текст, отпечаток)
+    _shapes: Dict[str, dict] = {}  # отпечаток -> {query, count, total_ms, max_ms}
+    _explained: Optional[set] = None  # формы, для которых план уже снят (загружается из БД)
+    _scheduled: set = set()  # формы, поставленные в очередь на EXPLAIN этим процессом
+    _executor: Optional[ThreadPoolExecutor] = None
     
-    keyboard = [
-        [InlineKeyboardButton("🔞 Неподходящий контент", callback_data=f"complain_inappropriate_{target_id}")],
-        [InlineKeyboardButton("🤖 Бот/фейк", callback_data=f"complain_fake_{target_id}")],
-        [InlineKeyboardButton("😠 Оскорбления", callback_data=f"complain_abuse_{target_id}")],
-        [InlineKeyboardButton("💰 Спам/реклама", callback_data=f"complain_spam_{target_id}")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="browse")]
+    _LITERALS = [
+        (re.compile(r"'(?:[^']|'')*'"), "?"),
+        (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+        (re.compile(r"(?:%s|\?)(?:\s*,\s*(?:%s|\?))+"), "..."),
+        (re.compile(r"\s+"), " "),
     ]
     
-    await query.edit_message_text(
-        "Выберите причину жалобы:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-
-# Обработка жалобы
-async def process_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+    @staticmethod
+    def normalize(query: str) -> Tuple[str, str]:
+        """Нормализованный текст запроса и короткий отпечаток его формы"""
+        cached = SlowQueryLog._normalized.get(query)
+        if cached is not None:
+            return cached
+        normalized = query
+        for pattern, replacement in SlowQueryLog._LITERALS:
+            normalized = pattern.sub(replacement, normalized)
+        normalized = normalized.strip()
+        result = (normalized, hashlib.sha1(normalized.encode()).hexdigest()[:12])
+        if len(SlowQueryLog._normalized) < 1000:
+            SlowQueryLog._normalized[query] = result
+        return result
     
-    data_parts = query.data.split('_')
-    reason = data_parts[1]
-    target_id = int(data_parts[2])
-    user_id = query.from_user.id
+    @staticmethod
+    def params_fingerprint(params) -> str:
+        """Типы параметров и хэш значений: видно вариант вызова, но не сами данные"""
+        if not params:
+            return "()"
+        
+        def shape(value) -> str:
+            if isinstance(value, (list, tuple)):
+                return f"{type(value).__name__}[{len(value)}]"
+            return type(value).__name__
+        
+        values = params.values() if isinstance(params, dict) else params
+        digest = hashlib.sha1(repr(params).encode()).hexdigest()[:8]
+        return f"({', '.join(shape(value) for value in values)}) #{digest}"
     
-    reason_text = {
-        'inappropriate': 'Неподходящий контент',
-        'fake': 'Бот/фейк аккаунт',
-        'abuse': 'Оскорбления',
-        'spam': 'Спам/реклама'
-    }.get(reason, reason)
+    @staticmethod
+    def check(query: str, params, started: float, explain: bool = True):
+        """Вызывается после каждого запроса; записывает его, если он дольше порога"""
+        duration_ms = (time.monotonic() - started) * 1000
+        if duration_ms < SLOW_QUERY_MS:
+            return
+        # Сбой журнала не должен превращать успешный запрос в ошибку
+        try:
+            SlowQueryLog._record(query, params, duration_ms, explain)
+        except Exception as e:
+            logger.error(f"Ошибка журнала медленных запросов: {e}")
     
-    was_banned = ComplaintManager.file_complaint(user_id, target_id, reason_text)
+    @staticmethod
+    def _record(query: str, params, duration_ms: float, explain: bool):
+        normalized, fingerprint = SlowQueryLog.normalize(query)
+        with SlowQueryLog._lock:
+            shape = SlowQueryLog._shapes.get(fingerprint)
+            if shape is None:
+                shape = SlowQueryLog._shapes[fingerprint] = {
+                    "query": normalized, "count": 0, "total_ms": 0.0, "max_ms": 0.0
+                }
+            shape["count"] += 1
+            shape["total_ms"] += duration_ms
+            shape["max_ms"] = max(shape["max_ms"], duration_ms)
+        
+        logger.warning(
+            f"Медленный запрос {fingerprint}: {duration_ms:.0f} мс, "
+            f"параметры {SlowQueryLog.params_fingerprint(params)}: {normalized[:500]}"
+        )
+        if explain and SLOW_QUERY_EXPLAIN and normalized.split(" ", 1)[0].upper() in ("SELECT", "WITH"):
+            SlowQueryLog._schedule_explain(fingerprint, normalized, query, params, duration_ms)
     
-    # Уведомляем админов
-    target_user = UserManager.get_user(target_id)
-    complainer = UserManager.get_user(user_id)
+    @staticmethod
+    def _schedule_explain(fingerprint: str, normalized: str, query: str, params, duration_ms: float):
+        with SlowQueryLog._lock:
+            # _scheduled ведется и до загрузки сохраненных форм из БД,
+            # иначе одна форма успевает встать в очередь несколько раз
+            if fingerprint in SlowQueryLog._scheduled or len(SlowQueryLog._scheduled) >= SLOW_QUERY_MAX_PLANS:
+                return
+            if SlowQueryLog._explained is not None and fingerprint in SlowQueryLog._explained:
+                return
+            SlowQueryLog._scheduled.add(fingerprint)
+            if SlowQueryLog._executor is None:
+                SlowQueryLog._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        SlowQueryLog._executor.submit(SlowQueryLog._explain, fingerprint, normalized, query, params, duration_ms)
     
-    admin_message = f"🚨 ЖАЛОБА\n\n"
-    admin_message += f"От: {complainer['name']} (@{complainer['username']}, ID: {user_id})\n"
-    admin_message += f"На: {target_user['name']} (@{target_user['username']}, ID: {target_id})\n"
-    admin_message += f"Причина: {reason_text}\n"
-    if was_banned:
-        admin_message += f"⚠️ ПОЛЬЗОВАТЕЛЬ АВТОМАТИЧЕСКИ ЗАБЛОКИРОВАН (много жалоб)"
+    @staticmethod
+    def _explain(fingerprint: str, normalized: str, query: str, params, duration_ms: float):
+        """EXPLAIN ANALYZE выполняет запрос еще раз, поэтому вне пула потоков обработчиков
+        и в транзакции, которая откатывается"""
+        try:
+            with Database.get_connection() as conn:
+                with conn.cursor() as cur:
+                    if SlowQueryLog._explained is None:
+                        # Первое обращение: формы с уже сохраненными планами не снимаем повторно
+                        cur.execute("SELECT fingerprint FROM slow_query_plans")
+                        known = {row['fingerprint'] for row in cur.fetchall()}
+                        with SlowQueryLog._lock:
+                            SlowQueryLog._explained = known
+                    with SlowQueryLog._lock:
+                        if fingerprint in SlowQueryLog._explained:
+                            return
+                        SlowQueryLog._explained.add(fingerprint)
+                    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                    plan = "\n".join(row['QUERY PLAN'] for row in cur.fetchall())
+                    conn.rollback()
+                    cur.execute(
+                        """INSERT INTO slow_query_plans (fingerprint, query, params, duration_ms, plan)
+                           VALUES (%s, %s, %s, %s, %s) ON CONFLICT (fingerprint) DO NOTHING""",
+                        (fingerprint, normalized, SlowQueryLog.params_fingerprint(params), duration_ms, plan)
+                    )
+            logger.info(f"План медленного запроса {fingerprint} сохранен в slow_query_plans")
+        except Exception as e:
+            logger.error(f"Не удалось снять план запроса {fingerprint}: {e}")
     
-    keyboard = [
-        [InlineKeyboardButton("Связаться", url=f"tg://user?id={target_id}")],
-        [InlineKeyboardButton("Заблокировать", callback_data=f"admin_ban_{target_id}")]
-    ]
+    @staticmethod
+    def get_stats() -> dict:
+        with SlowQueryLog._lock:
+            return {
+                "slow_queries": sum(shape["count"] for shape in SlowQueryLog._shapes.values()),
+                "shapes": len(SlowQueryLog._shapes),
+            }
     
-    for admin_id in ADMIN_IDS:
+    @staticmethod
+    def top(limit: int = 5) -> List[Tuple[str, dict]]:
+        """Формы запросов с наибольшим суммарным временем"""
+        with SlowQueryLog._lock:
+            shapes = [(fingerprint, dict(shape)) for fingerprint, shape in SlowQueryLog._shapes.items()]
+        return sorted(shapes, key=lambda item: -item[1]["total_ms"])[:limit]
+
+class Database:
+    """Класс для работы с базой данных"""
+
+    _pool: Optional[ConnectionPool] = None
+    _pool_lock = threading.Lock()
+    _executor: Optional[ThreadPoolExecutor] = None
+    _pending: Optional[asyncio.Semaphore] = None
+
+    @staticmethod
+    def get_pool() -> ConnectionPool:
+        if Database._pool is None:
+            with Database._pool_lock:
+                if Database._pool is None:
+                    pool = ConnectionPool(
+                        DATABASE_URL,
+                        min_size=DB_POOL_MIN_SIZE,
+                        max_size=DB_POOL_MAX_SIZE,
+                        timeout=DB_POOL_TIMEOUT,
+                        max_idle=DB_POOL_MAX_IDLE,
+                        max_lifetime=DB_POOL_MAX_LIFETIME,
+                        healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE,
+                    )
+                    pool.open()
+                    Database._pool = pool
+        return Database._pool
+
+    @staticmethod
+    def close_pool():
+        with Database._pool_lock:
+            if Database._pool is not None:
+                Database._pool.close()
+                Database._pool = None
+
+    @staticmethod
+    def pool_stats() -> dict:
+        return Database._pool.get_stats() if Database._pool else {}
+
+    @staticmethod
+    def get_connection():
+        """Соединение из пула (использовать как контекстный менеджер)"""
+        return Database.get_pool().connection()
+
+    @staticmethod
+    def get_executor() -> ThreadPoolExecutor:
+        if Database._executor is None:
+            with Database._pool_lock:
+                if Database._executor is None:
+                    Database._executor = ThreadPoolExecutor(
+                        max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+                    )
+        return Database._executor
+
+    @staticmethod
+    def shutdown_executor():
+        with Database._pool_lock:
+            if Database._executor is not None:
+                Database._executor.shutdown(wait=True)
+                Database._executor = None
+            Database._pending = None
+
+    @staticmethod
+    async def run(func, *args, **kwargs):
+        """Выполняет синхронную работу с БД в отдельном пуле потоков, не блокируя event loop.
+
+        Количество одновременно ожидающих вызовов ограничено DB_MAX_PENDING:
+        при перегрузке обработчики ждут здесь, а не копят задачи в executor.
+        """
+        if Database._pending is None:
+            Database._pending = asyncio.Semaphore(DB_MAX_PENDING)
+        started = time.monotonic() if METRICS_ENABLED else 0.0
         try:
-            await context.bot.send_message(
-                admin_id,
-                admin_message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except:
-            pass
+            async with Database._pending:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    Database.get_executor(), functools.partial(func, *args, **kwargs)
+                )
+        finally:
+            if METRICS_ENABLED:
+                Metrics.observe("bot_db_call_seconds", "func", func.__qualname__, time.monotonic() - started)
+
+    @staticmethod
+    async def execute_query_async(query: str, params: tuple = (), fetch: str = None):
+        return await Database.run(Database.execute_query, query, params, fetch)
+
+    @staticmethod
+    def init_database():
+        """Приводит схему БД к актуальной версии (без удаления данных)"""
+        try:
+            applied = SchemaMigrations.apply()
+            if applied:
+                logger.info(f"База данных обновлена до версии {SchemaMigrations.latest_version()}")
+            else:
+                logger.info(f"Схема БД актуальна (версия {SchemaMigrations.latest_version()})")
+            UserManager.backfill_city_ids()
+        except Exception as e:
+            logger.error(f"Критическая ошибка инициализации БД: {e}")
+            raise
     
-    result_text = "✅ Жалоба отправлена администрации."
-    if was_banned:
-        result_text += "\n⚠️ Пользователь заблокирован автоматически."
+    @staticmethod
+    def execute_query(query: str, params: tuple = (), fetch: str = None):
+        """Выполнение SQL запроса с безопасными параметрами"""
+        started = time.monotonic() if METRICS_ENABLED or SLOW_QUERY_MS else 0.0
+        try:
+            with Database.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    result = None
+                    if fetch == "one":
+                        result = cur.fetchone()
+                    elif fetch == "all":
+                        result = cur.fetchall()
+                    rows = cur.rowcount
+            if METRICS_ENABLED:
+                Metrics.observe_query(query, started, rows)
+            if SLOW_QUERY_MS:
+                SlowQueryLog.check(query, params, started)
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка выполнения запроса: {e}")
+            if METRICS_ENABLED:
+                Metrics.observe_query(query, started, None, failed=True)
+            if SLOW_QUERY_MS:
+                SlowQueryLog.check(query, params, started, explain=False)
+            return None
     
-    await query.edit_message_text(
-        result_text,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")]
-        ])
-    )
+    @staticmethod
+    def execute_values(query: str, rows: List[tuple], template: str = None,
+                       fetch: bool = False) -> Optional[list]:
+        """Пакетная вставка через execute_values: один запрос на страницу строк.
+        Возвращает строки RETURNING (пустой список без fetch) или None при ошибке."""
+        started = time.monotonic() if METRICS_ENABLED or SLOW_QUERY_MS else 0.0
+        try:
+            with Database.get_connection() as conn:
+                with conn.cursor() as cur:
+                    result = psycopg2.extras.execute_values(
+                        cur, query, rows, template=template, page_size=1000, fetch=fetch
+                    )
+            if METRICS_ENABLED:
+                Metrics.observe_query(query, started, len(rows))
+            if SLOW_QUERY_MS:
+                # План пакетной вставки не снимаем: текст запроса собирается execute_values
+                SlowQueryLog.check(query, (rows,), started, explain=False)
+            return result if fetch else []
+        except Exception as e:
+            logger.error(f"Ошибка пакетного запроса: {e}")
+            if METRICS_ENABLED:
+                Metrics.observe_query(query, started, None, failed=True)
+            if SLOW_QUERY_MS:
+                SlowQueryLog.check(query, (rows,), started, explain=False)
+            return None
 
-# Админские команды
-async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        return
+class CacheBackend:
+    """Хранилище кэша (интерфейс)"""
     
-    # Получаем статистику
-    total_users = Database.execute_query("SELECT COUNT(*) as count FROM users", fetch="one")
-    active_users = Database.execute_query("SELECT COUNT(*) as count FROM users WHERE is_active = TRUE AND is_banned = FALSE", fetch="one")
-    total_matches = Database.execute_query("SELECT COUNT(*) as count FROM matches", fetch="one")
-    pending_complaints = Database.execute_query("SELECT COUNT(*) as count FROM complaints WHERE status = 'pending'", fetch="one")
+    def get(self, key):
+        raise NotImplementedError
     
-    text = f"""📊 СТАТИСТИКА БОТА
-
-👥 Всего пользователей: {total_users['count'] if total_users else 0}
-✅ Активных: {active_users['count'] if active_users else 0}
-❤️ Всего матчей: {total_matches['count'] if total_matches else 0}
-⚠️ Жалоб на рассмотрении: {pending_complaints['count'] if pending_complaints else 0}"""
+    def set(self, key, value):
+        raise NotImplementedError
     
-    await update.message.reply_text(text)
+    def delete(self, key):
+        raise NotImplementedError
+    
+    def __len__(self) -> int:
+        return 0
 
-async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        return
+class LRUCacheBackend(CacheBackend):
+    """Кэш в памяти процесса: не больше max_size записей, каждая живет ttl секунд"""
     
-    if len(context.args) != 1:
-        await update.message.reply_text("Использование: /ban <user_id>")
-        return
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
     
-    try:
-        user_id = int(context.args[0])
-        Database.execute_query("UPDATE users SET is_banned = TRUE WHERE user_id = %s", (user_id,))
-        await update.message.reply_text(f"✅ Пользователь {user_id} заблокирован")
-    except ValueError:
-        await update.message.reply_text("Неверный ID пользователя")
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def __len__(self) -> int:
+        return len(self._data)
 
-async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        return
+class RedisCacheBackend(CacheBackend):
+    """Общий кэш в Redis для нескольких процессов бота"""
     
-    if len(context.args) != 1:
-        await update.message.reply_text("Использование: /unban <user_id>")
-        return
+    def __init__(self, url: str, ttl: float = 60.0, prefix: str = "profile:"):
+        if redis is None:
+            raise RuntimeError("Для PROFILE_CACHE_REDIS_URL нужен пакет redis")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
     
-    try:
-        user_id = int(context.args[0])
-        Database.execute_query("UPDATE users SET is_banned = FALSE WHERE user_id = %s", (user_id,))
-        await update.message.reply_text(f"✅ Пользователь {user_id} разблокирован")
-    except ValueError:
-        await update.message.reply_text("Неверный ID пользователя")
+    # Записи - строки users (простые словари) в JSON: pickle из общего Redis позволил бы
+    # любому, кто может туда писать, выполнить код в процессах бота
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, datetime):
+            return {"__datetime__": value.isoformat()}
+        raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+    
+    @staticmethod
+    def _decode(obj: dict):
+        if len(obj) == 1 and "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        return obj
+    
+    def get(self, key):
+        data = self.client.get(f"{self.prefix}{key}")
+        return json.loads(data, object_hook=self._decode) if data is not None else None
+    
+    def set(self, key, value):
+        data = json.dumps(value, default=self._encode, ensure_ascii=False)
+        self.client.set(f"{self.prefix}{key}", data, px=int(self.ttl * 1000))
+    
+    def delete(self, key):
+        self.client.delete(f"{self.prefix}{key}")
 
-async def admin_complaints(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        return
+class ProfileCache:
+    """Read-through кэш строк users по user_id"""
     
-    complaints = Database.execute_query(
-        """SELECT c.*, u1.name as complainant_name, u2.name as target_name 
-           FROM complaints c
-           JOIN users u1 ON c.from_user = u1.user_id
-           JOIN users u2 ON c.against_user = u2.user_id
-           WHERE c.status = 'pending'
-           ORDER BY c.created_at DESC LIMIT 10""",
-        fetch="all"
-    )
+    backend: Optional[CacheBackend] = None
+    stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+    # Поколения по user_id (полосами, чтобы не хранить счетчик на каждого): растут при
+    # инвалидации, строку, прочитанную до записи этой анкеты, в кэш не кладем
+    GENERATION_STRIPES = 4096
+    _generations = [0] * GENERATION_STRIPES
+    _generation_lock = threading.Lock()
     
-    if not complaints:
-        await update.message.reply_text("Нет жалоб для рассмотрения")
-        return
+    @staticmethod
+    def get_backend() -> CacheBackend:
+        if ProfileCache.backend is None:
+            if PROFILE_CACHE_REDIS_URL:
+                ProfileCache.backend = RedisCacheBackend(PROFILE_CACHE_REDIS_URL, PROFILE_CACHE_TTL)
+            else:
+                ProfileCache.backend = LRUCacheBackend(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+        return ProfileCache.backend
     
-    text = "🚨 ЖАЛОБЫ НА РАССМОТРЕНИИ:\n\n"
-    for complaint in complaints:
-        text += f"ID: {complaint['id']}\n"
-        text += f"От: {complaint['complainant_name']} (ID: {complaint['from_user']})\n"
-        text += f"На: {complaint['target_name']} (ID: {complaint['against_user']})\n"
-        text += f"Причина: {complaint['reason']}\n"
-        text += f"Дата: {complaint['created_at']}\n\n"
+    @staticmethod
+    def get(user_id: int) -> Optional[dict]:
+        try:
+            row = ProfileCache.get_backend().get(user_id)
+        except Exception as e:
+            ProfileCache.stats['errors'] += 1
+            logger.error(f"Ошибка чтения кэша анкет: {e}")
+            row = None
+        
+        if row is None:
+            ProfileCache.stats['misses'] += 1
+            return None
+        ProfileCache.stats['hits'] += 1
+        # Копия: вызывающий код может менять полученный словарь
+        return dict(row)
     
-    await update.message.reply_text(text)
+    @staticmethod
+    def generation(user_id: int) -> int:
+        return ProfileCache._generations[user_id % ProfileCache.GENERATION_STRIPES]
+    
+    @staticmethod
+    def put(user_id: int, row: dict, generation: int):
+        """Кладет строку в кэш, если с момента ее чтения (generation) анкету не инвалидировали"""
+        if generation != ProfileCache.generation(user_id):
+            return
+        try:
+            backend = ProfileCache.get_backend()
+            backend.set(user_id, dict(row))
+            # Инвалидация могла пройти между проверкой и записью - тогда убираем свою запись
+            if generation != ProfileCache.generation(user_id):
+                backend.delete(user_id)
+        except Exception as e:
+            ProfileCache.stats['errors'] += 1
+            logger.error(f"Ошибка записи в кэш анкет: {e}")
+    
+    @staticmethod
+    def invalidate(user_id: int):
+        ProfileCache.invalidate_local(user_id)
+        ClusterEvents.publish("profile", user_id)
+    
+    @staticmethod
+    def invalidate_local(user_id: int):
+        """Инвалидация только в этом процессе (событие от другого воркера)"""
+        with ProfileCache._generation_lock:
+            ProfileCache._generations[user_id % ProfileCache.GENERATION_STRIPES] += 1
+        ProfileCache.stats['invalidations'] += 1
+        CandidateFeed.drop_prefetched(user_id)
+        try:
+            ProfileCache.get_backend().delete(user_id)
+        except Exception as e:
+            ProfileCache.stats['errors'] += 1
+            logger.error(f"Ошибка инвалидации кэша анкет: {e}")
+    
+    @staticmethod
+    def get_stats() -> dict:
+        stats = dict(ProfileCache.stats)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        stats['size'] = len(ProfileCache.get_backend())
+        return stats
 
-# Отмена операций
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Операция отменена.")
-    return ConversationHandler.END
+class UserRegistry:
+    """Зарегистрированные и заблокированные user_id в памяти.
 
-def main():
-    """Запуск бота"""
-    # Инициализация базы данных
-    Database.init_database()
+    Зарегистрированные хранятся в отсортированном массиве int64 (8 байт на пользователя,
+    поиск бинарный) плюс небольшое множество новых ID, которое периодически вливается в массив.
+    """
     
-    # Создание приложения
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    MERGE_THRESHOLD = 1024
     
-    # Обработчик регистрации
-    registration_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start_command)],
-        states={
-            CAPTCHA: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_captcha)],
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
-            AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_age)],
-            GENDER: [CallbackQueryHandler(get_gender, pattern=r"^gender_")],
-            CURRENT_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_current_city)],
-            SEARCH_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_search_city)],
-            SEARCH_RADIUS: [CallbackQueryHandler(get_search_radius, pattern=r"^radius_")],
-            DATING_GOAL: [CallbackQueryHandler(get_dating_goal, pattern=r"^goal_")],
-            BIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_bio)],
-            PHOTO: [
-                MessageHandler(filters.PHOTO, get_photo),
-                CallbackQueryHandler(finish_photos, pattern="finish_photos")
-            ],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True,
-    )
+    _registered = array('q')
+    _added: set = set()
+    _banned: set = set()
+    _loaded = False
+    _lock = threading.Lock()
     
-    # Добавляем обработчики
-    application.add_handler(CallbackQueryHandler(show_matches, pattern="matches"))
-    application.add_handler(CallbackQueryHandler(show_profile, pattern="profile"))
-    application.add_handler(CallbackQueryHandler(main_menu, pattern="main_menu"))
-    application.add_handler(CallbackQueryHandler(handle_complaint, pattern=r"^complaint_\d+"))
-    application.add_handler(CallbackQueryHandler(process_complaint, pattern=r"^complain_"))
+    @staticmethod
+    def load():
+        rows = Database.execute_query(
+            "SELECT user_id, is_banned FROM users ORDER BY user_id", fetch="all"
+        )
+        if rows is None:
+            raise RuntimeError("Не удалось загрузить список пользователей")
+        
+        registered = array('q', (row['user_id'] for row in rows))
+        banned = {row['user_id'] for row in rows if row['is_banned']}
+        with UserRegistry._lock:
+            UserRegistry._registered = registered
+            UserRegistry._added = set()
+            UserRegistry._banned = banned
+            UserRegistry._loaded = True
+        logger.info(f"Загружено пользователей: {len(registered)}, заблокированных: {len(banned)}")
     
-    # Админские команды
-    application.add_handler(CommandHandler("stats", admin_stats))
-    application.add_handler(CommandHandler("ban", admin_ban))
-    application.add_handler(CommandHandler("unban", admin_unban))
-    application.add_handler(CommandHandler("complaints", admin_complaints))
+    @staticmethod
+    def is_loaded() -> bool:
+        return UserRegistry._loaded
     
-    # Команды
-    application.add_handler(CommandHandler("browse", browse_profiles))
-    application.add_handler(CommandHandler("matches", show_matches))
-    application.add_handler(CommandHandler("profile", show_profile))
+    @staticmethod
+    def exists(user_id: int) -> bool:
+        if user_id in UserRegistry._added:
+            return True
+        registered = UserRegistry._registered
+        i = bisect.bisect_left(registered, user_id)
+        return i < len(registered) and registered[i] == user_id
     
-    logger.info("Бот запускается...")
+    @staticmethod
+    def is_banned(user_id: int) -> bool:
+        return user_id in UserRegistry._banned
     
-    # Запуск polling
-    application.run_polling(drop_pending_updates=True)
-
-if __name__ == "__main__":
-    main()add_handler(registration_handler)
-    application.add_handler(CallbackQueryHandler(browse_profiles, pattern="browse"))
-    application.add_handler(CallbackQueryHandler(handle_like, pattern=r"^like_\d+"))
-    application.add_handler(CallbackQueryHandler(handle_skip, pattern=r"^skip_\d+"))
-    application.import os
-import logging
-import psycopg2
-import psycopg2.extras
-from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Tuple
-import random
-import string
-import asyncio
-import re
-import json
-from dotenv import load_dotenv
-
-from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, 
-    ReplyKeyboardRemove, InputMediaPhoto
-)
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters, ConversationHandler
-)
-
-# Загрузка переменных окружения
-load_dotenv()
-
-# Конфигурация
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-DATABASE_URL = os.getenv("DATABASE_URL")
-ADMIN_IDS = [8096476392]
-
-if not TELEGRAM_TOKEN or not DATABASE_URL:
-    raise ValueError("TELEGRAM_TOKEN и DATABASE_URL должны быть установлены в .env файле")
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
-# Дополнительные логи для действий пользователей
-user_logger = logging.getLogger('user_actions')
-user_logger.setLevel(logging.INFO)
-user_handler = logging.FileHandler('user_actions.log')
-user_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-user_logger.addHandler(user_handler)
-
-# Состояния для регистрации
-(NAME, AGE, GENDER, CURRENT_CITY, SEARCH_CITY, SEARCH_RADIUS, 
- DATING_GOAL, BIO, PHOTO, CAPTCHA) = range(10)
-
-# Состояния для редактирования
-(EDIT_NAME, EDIT_AGE, EDIT_BIO, EDIT_PHOTOS, EDIT_CURRENT_CITY, 
- EDIT_SEARCH_CITY, EDIT_SEARCH_RADIUS, EDIT_DATING_GOAL) = range(100, 108)
-
-# Константы
-DATING_GOALS = {
-    'relationship': 'Отношения',
-    'friendship': 'Дружба', 
-    'online_chat': 'Общение онлайн',
-    'short_romance': 'Короткий роман',
-    'gaming': 'Совместный гейминг'
-}
-
-GENDERS = {
-    'male': 'Мужчина',
-    'female': 'Женщина'
-}
+    @staticmethod
+    def add(user_id: int):
+        with UserRegistry._lock:
+            UserRegistry._added.add(user_id)
+            if len(UserRegistry._added) >= UserRegistry.MERGE_THRESHOLD:
+                UserRegistry._registered = UserRegistry._merge(UserRegistry._registered, UserRegistry._added)
+                UserRegistry._added = set()
+    
+    @staticmethod
+    def _merge(registered: array, added: set) -> array:
+        """Вливает новые ID в отсортированный массив: позиции ищутся бинарным поиском,
+        куски массива между ними копируются целиком, без промежуточного множества"""
+        merged = array('q')
+        start = 0
+        for user_id in sorted(added):
+            position = bisect.bisect_left(registered, user_id, start)
+            if position < len(registered) and registered[position] == user_id:
+                continue
+            merged.extend(registered[start:position])
+            merged.append(user_id)
+            start = position
+        merged.extend(registered[start:])
+        return merged
+    
+    @staticmethod
+    def set_banned(user_id: int, banned: bool):
+        with UserRegistry._lock:
+            if banned:
+                UserRegistry._banned.add(user_id)
+            else:
+                UserRegistry._banned.discard(user_id)
 
-class Database:
-    """Класс для работы с базой данных"""
+class ClusterEvents:
+    """События между процессами-воркерами через LISTEN/NOTIFY Postgres.
+    
+    У каждого воркера свой кэш анкет и реестр пользователей; изменения, сделанные
+    в одном процессе (регистрация, бан, правка анкеты), рассылаются остальным.
+    При одном процессе ничего не публикуется.
+    """
+    
+    CHANNEL = "bot_events"
+    
+    enabled = False
+    _thread: Optional[threading.Thread] = None
+    _stopping = threading.Event()
     
     @staticmethod
-    def get_connection():
-        return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+    def publish(kind: str, user_id: int):
+        if not ClusterEvents.enabled:
+            return
+        Database.execute_query(
+            "SELECT pg_notify(%s, %s)",
+            (ClusterEvents.CHANNEL, f"{os.getpid()}:{kind}:{user_id}")
+        )
     
     @staticmethod
-    def init_database():
-        """Инициализация всех таблиц"""
-        # Команды для удаления старых таблиц
-        drop_commands = [
-            "DROP TABLE IF EXISTS daily_limits CASCADE",
-            "DROP TABLE IF EXISTS captcha_attempts CASCADE", 
-            "DROP TABLE IF EXISTS complaints CASCADE",
-            "DROP TABLE IF EXISTS viewed_profiles CASCADE",
-            "DROP TABLE IF EXISTS matches CASCADE",
-            "DROP TABLE IF EXISTS likes CASCADE",
-            "DROP TABLE IF EXISTS user_photos CASCADE",
-            "DROP TABLE IF EXISTS users CASCADE"
-        ]
-        
-        # Команды для создания таблиц
-        create_commands = [
-            """
-            CREATE TABLE users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                name TEXT NOT NULL,
-                age INTEGER NOT NULL,
-                gender TEXT NOT NULL,
-                current_city TEXT NOT NULL,
-                current_lat FLOAT,
-                current_lon FLOAT,
-                search_city TEXT NOT NULL,
-                search_lat FLOAT,
-                search_lon FLOAT,
-                search_radius INTEGER DEFAULT 50,
-                search_all_ukraine BOOLEAN DEFAULT FALSE,
-                dating_goal TEXT NOT NULL,
-                bio TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                is_banned BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                name_changes INTEGER DEFAULT 0,
-                last_name_change TIMESTAMP,
-                age_changes INTEGER DEFAULT 0,
-                last_age_change TIMESTAMP,
-                location_changes_today INTEGER DEFAULT 0,
-                location_changes_month INTEGER DEFAULT 0,
-                last_location_change TIMESTAMP
-            )
-            """,
-            """
-            CREATE TABLE user_photos (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                photo_id TEXT NOT NULL,
-                is_main BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-            )
-            """,
-            """
-            CREATE TABLE likes (
-                from_user BIGINT NOT NULL,
-                to_user BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (from_user, to_user)
-            )
-            """,
-            """
-            CREATE TABLE matches (
-                user1 BIGINT NOT NULL,
-                user2 BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user1, user2)
-            )
-            """,
-            """
-            CREATE TABLE viewed_profiles (
-                viewer_user BIGINT NOT NULL,
-                viewed_user BIGINT NOT NULL,
-                first_view TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                can_view_again TIMESTAMP,
-                view_count INTEGER DEFAULT 1,
-                PRIMARY KEY (viewer_user, viewed_user)
-            )
-            """,
-            """
-            CREATE TABLE complaints (
-                id SERIAL PRIMARY KEY,
-                from_user BIGINT NOT NULL,
-                against_user BIGINT NOT NULL,
-                reason TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                resolved_at TIMESTAMP,
-                resolved_by BIGINT
-            )
-            """,
-            """
-            CREATE TABLE captcha_attempts (
-                user_id BIGINT PRIMARY KEY,
-                attempts INTEGER DEFAULT 0,
-                last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_verified BOOLEAN DEFAULT FALSE
-            )
-            """,
-            """
-            CREATE TABLE daily_limits (
-                user_id BIGINT PRIMARY KEY,
-                complaints_today INTEGER DEFAULT 0,
-                last_complaint_date DATE DEFAULT CURRENT_DATE
-            )
-            """
-        ]
-        
-        # Команды для создания индексов
-        index_commands = [
-            "CREATE INDEX idx_users_location ON users(current_lat, current_lon)",
-            "CREATE INDEX idx_users_search ON users(search_lat, search_lon)",
-            "CREATE INDEX idx_likes_from_user ON likes(from_user)",
-            "CREATE INDEX idx_likes_to_user ON likes(to_user)",
-            "CREATE INDEX idx_matches_users ON matches(user1, user2)",
-            "CREATE INDEX idx_viewed_profiles ON viewed_profiles(viewer_user)",
-            "CREATE INDEX idx_complaints_against ON complaints(against_user)"
-        ]
-        
-        try:
-            with Database.get_connection() as conn:
+    def _apply(payload: str):
+        pid, kind, user_id = payload.split(":")
+        if int(pid) == os.getpid():
+            return
+        user_id = int(user_id)
+        if kind == "profile":
+            ProfileCache.invalidate_local(user_id)
+        elif kind == "registered":
+            UserRegistry.add(user_id)
+        elif kind in ("banned", "unbanned"):
+            UserRegistry.set_banned(user_id, kind == "banned")
+            ProfileCache.invalidate_local(user_id)
+    
+    @staticmethod
+    def _listen():
+        resync = False
+        while not ClusterEvents._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
                 with conn.cursor() as cur:
-                    # Удаляем старые таблицы
-                    for drop_cmd in drop_commands:
-                        try:
-                            cur.execute(drop_cmd)
-                        except Exception as e:
-                            logger.debug(f"Ошибка удаления таблицы: {e}")
-                    
-                    # Создаем таблицы
-                    for create_cmd in create_commands:
-                        cur.execute(create_cmd)
-                    
-                    # Создаем индексы
-                    for index_cmd in index_commands:
-                        try:
-                            cur.execute(index_cmd)
-                        except Exception as e:
-                            logger.debug(f"Ошибка создания индекса: {e}")
+                    cur.execute(f"LISTEN {ClusterEvents.CHANNEL}")
+                if resync:
+                    # Пока соединения не было, события могли потеряться
+                    UserRegistry.load()
+                resync = True
                 
-                conn.commit()
-            logger.info("База данных успешно инициализирована")
-            
-        except Exception as e:
-            logger.error(f"Критическая ошибка инициализации БД: {e}")
-            raise
+                while not ClusterEvents._stopping.is_set():
+                    if select.select([conn], [], [], 1.0)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            ClusterEvents._apply(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Ошибка подписки на события воркеров: {e}")
+                ClusterEvents._stopping.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
     
     @staticmethod
-    def execute_query(query: str, params: tuple = (), fetch: str = None):
-        """Выполнение SQL запроса с безопасными параметрами"""
-        try:
-            with Database.get_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(query, params)
-                    if fetch == "one":
-                        return cur.fetchone()
-                    elif fetch == "all":
-                        return cur.fetchall()
-                    return None
-        except Exception as e:
-            logger.error(f"Ошибка выполнения запроса: {e}")
-            return None
+    def start():
+        ClusterEvents.enabled = True
+        ClusterEvents._stopping.clear()
+        ClusterEvents._thread = threading.Thread(target=ClusterEvents._listen, name="cluster-events", daemon=True)
+        ClusterEvents._thread.start()
+    
+    @staticmethod
+    def stop():
+        ClusterEvents.enabled = False
+        ClusterEvents._stopping.set()
+        if ClusterEvents._thread is not None:
+            ClusterEvents._thread.join()
+            ClusterEvents._thread = None
 
 class UserManager:
     """Управление пользователями"""
     
     @staticmethod
     def user_exists(user_id: int) -> bool:
+        if UserRegistry.is_loaded():
+            return UserRegistry.exists(user_id)
+        
         result = Database.execute_query(
             "SELECT 1 FROM users WHERE user_id = %s", 
             (user_id,), "one"
@@ -947,38 +1700,106 @@ class UserManager:
     
     @staticmethod
     def is_user_banned(user_id: int) -> bool:
+        if UserRegistry.is_loaded():
+            return UserRegistry.is_banned(user_id)
+        
         result = Database.execute_query(
             "SELECT is_banned FROM users WHERE user_id = %s", 
             (user_id,), "one"
         )
         return bool(result and result['is_banned'])
     
+    @staticmethod
+    def backfill_city_ids() -> int:
+        """Проставляет ID и координаты городов из справочника анкетам без ID (созданным до миграции 2).
+
+        Поиск кандидатов сравнивает города по ID, поэтому без этого старые анкеты выпадают
+        из выдачи. Идемпотентно: обновляются только строки без ID, названия, которых нет
+        в справочнике, пропускаются. Уже заданные координаты не меняются.
+        """
+        gazetteer = CityGazetteer.default()
+        updated = 0
+        for prefix in ('current', 'search'):
+            rows = Database.execute_query(
+                f"SELECT DISTINCT {prefix}_city AS city FROM users WHERE {prefix}_city_id IS NULL",
+                (), "all"
+            ) or []
+            resolved = []
+            for row in rows:
+                info = gazetteer.resolve(row['city'] or '')
+                if info:
+                    resolved.append((row['city'], info.id, info.lat, info.lon))
+            if not resolved:
+                continue
+            result = Database.execute_values(
+                f"""UPDATE users u SET
+                        {prefix}_city_id = v.city_id,
+                        {prefix}_lat = COALESCE(u.{prefix}_lat, v.lat),
+                        {prefix}_lon = COALESCE(u.{prefix}_lon, v.lon)
+                    FROM (VALUES %s) AS v(city, city_id, lat, lon)
+                    WHERE u.{prefix}_city = v.city AND u.{prefix}_city_id IS NULL
+                    RETURNING u.user_id""",
+                resolved, fetch=True
+            )
+            updated += len(result or [])
+        if updated:
+            logger.info(f"Проставлены ID городов из справочника: {updated} записей")
+        return updated
+    
     @staticmethod
     def create_user(user_data: dict) -> bool:
         query = """
-        INSERT INTO users (user_id, username, name, age, gender, current_city, 
-                          current_lat, current_lon, search_city, search_lat, search_lon,
+        INSERT INTO users (user_id, username, name, age, gender, current_city, current_city_id,
+                          current_lat, current_lon, search_city, search_city_id, search_lat, search_lon,
                           search_radius, search_all_ukraine, dating_goal, bio)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING user_id
         """
         params = (
             user_data['user_id'], user_data.get('username'), user_data['name'],
             user_data['age'], user_data['gender'], user_data['current_city'],
-            user_data.get('current_lat'), user_data.get('current_lon'),
-            user_data['search_city'], user_data.get('search_lat'), user_data.get('search_lon'),
+            user_data.get('current_city_id'), user_data.get('current_lat'), user_data.get('current_lon'),
+            user_data['search_city'], user_data.get('search_city_id'),
+            user_data.get('search_lat'), user_data.get('search_lon'),
             user_data.get('search_radius', 50), user_data.get('search_all_ukraine', False),
             user_data['dating_goal'], user_data['bio']
         )
         
-        result = Database.execute_query(query, params)
-        return result is not None
+        result = Database.execute_query(query, params, "one")
+        ProfileCache.invalidate(user_data['user_id'])
+        if result is None:
+            return False
+        UserRegistry.add(user_data['user_id'])
+        ClusterEvents.publish("registered", user_data['user_id'])
+        return True
     
     @staticmethod
     def get_user(user_id: int):
-        return Database.execute_query(
+        user = ProfileCache.get(user_id)
+        if user is not None:
+            return user
+        
+        generation = ProfileCache.generation(user_id)
+        user = Database.execute_query(
             "SELECT * FROM users WHERE user_id = %s", 
             (user_id,), "one"
         )
+        if user:
+            ProfileCache.put(user_id, user, generation)
+        return user
+    
+    @staticmethod
+    def set_banned(user_id: int, banned: bool = True) -> bool:
+        result = Database.execute_query(
+            "UPDATE users SET is_banned = %s WHERE user_id = %s RETURNING user_id",
+            (banned, user_id), "one"
+        )
+        ProfileCache.invalidate(user_id)
+        if result is None:
+            return False
+        UserRegistry.set_banned(user_id, banned)
+        ClusterEvents.publish("banned" if banned else "unbanned", user_id)
+        return True
     
     @staticmethod
     def add_photo(user_id: int, photo_id: str, is_main: bool = False):
@@ -1001,6 +1822,31 @@ class UserManager:
             (user_id,), "all"
         )
     
+    @staticmethod
+    def get_profile_cards(user_ids: List[int]) -> Dict[int, dict]:
+        """Анкеты вместе с фотографиями (ключ 'photos') одним запросом"""
+        if not user_ids:
+            return {}
+        rows = Database.execute_query(
+            """SELECT u.*, COALESCE(p.photos, '[]'::json) AS photos
+               FROM users u
+               LEFT JOIN LATERAL (
+                   SELECT json_agg(
+                              json_build_object('photo_id', ph.photo_id, 'is_main', ph.is_main)
+                              ORDER BY ph.is_main DESC, ph.created_at
+                          ) AS photos
+                   FROM user_photos ph
+                   WHERE ph.user_id = u.user_id
+               ) p ON TRUE
+               WHERE u.user_id = ANY(%s)""",
+            (list(user_ids),), "all"
+        )
+        return {row['user_id']: row for row in rows} if rows else {}
+    
+    @staticmethod
+    def get_profile_card(user_id: int) -> Optional[dict]:
+        return UserManager.get_profile_cards([user_id]).get(user_id)
+    
     @staticmethod
     def can_change_name(user_id: int) -> Tuple[bool, str]:
         user = UserManager.get_user(user_id)
@@ -1052,6 +1898,7 @@ class UserManager:
                             "UPDATE users SET age_changes = 0 WHERE user_id = %s",
                             (user_id,)
                         )
+                        ProfileCache.invalidate(user_id)
                     else:
                         return False, "Возраст можно менять максимум 3 раза в месяц"
                 except (ValueError, AttributeError):
@@ -1083,6 +1930,7 @@ class UserManager:
                         "UPDATE users SET location_changes_today = 0 WHERE user_id = %s",
                         (user_id,)
                     )
+                    ProfileCache.invalidate(user_id)
                     user['location_changes_today'] = 0
             except (ValueError, AttributeError):
                 pass
@@ -1106,6 +1954,7 @@ class UserManager:
                             "UPDATE users SET location_changes_month = 0 WHERE user_id = %s",
                             (user_id,)
                         )
+                        ProfileCache.invalidate(user_id)
                 except (ValueError, AttributeError):
                     pass
         
@@ -1118,7 +1967,8 @@ class UserManager:
         allowed_fields = [
             'name', 'age', 'gender', 'current_city', 'search_city', 'search_radius',
             'search_all_ukraine', 'dating_goal', 'bio', 'current_lat', 'current_lon',
-            'search_lat', 'search_lon', 'is_active', 'is_banned', 'last_active'
+            'search_lat', 'search_lon', 'current_city_id', 'search_city_id',
+            'is_active', 'is_banned', 'last_active'
         ]
         
         if field not in allowed_fields:
@@ -1133,80 +1983,98 @@ class UserManager:
                 query += ", name_changes = name_changes + 1, last_name_change = CURRENT_TIMESTAMP"
             elif field in ['age']:
                 query += ", age_changes = age_changes + 1, last_age_change = CURRENT_TIMESTAMP"
-            elif field in ['current_city', 'search_city', 'current_lat', 'current_lon', 'search_lat', 'search_lon']:
+            elif field in ['current_city', 'search_city', 'current_lat', 'current_lon', 'search_lat', 'search_lon',
+                           'current_city_id', 'search_city_id']:
                 query += ", location_changes_today = location_changes_today + 1, location_changes_month = location_changes_month + 1, last_location_change = CURRENT_TIMESTAMP"
         
         query += " WHERE user_id = %s"
         params.append(user_id)
         
         result = Database.execute_query(query, tuple(params))
-        
+        ProfileCache.invalidate(user_id)
+
+        # Параметры поиска изменились - старая лента больше не подходит
+        if field in ('current_city', 'search_city', 'search_radius', 'search_all_ukraine',
+                     'search_lat', 'search_lon', 'current_city_id', 'search_city_id'):
+            CandidateFeed.reset(user_id)
+
         # Логирование действия пользователя
-        user_logger.info(f"User {user_id} updated field {field} to {value}")
+        user_logger.info(
+            f"User {user_id} updated field {field} to {value}",
+            extra={"action": "update_field", "user_id": user_id, "field": field, "value": value}
+        )
         
         return result is not None
 
 class MatchManager:
     """Управление лайками и матчами"""
     
+    # Точный отсев лайкнутых и недавно просмотренных (параметры: viewer, viewer)
+    SEEN_EXCLUSION_SQL = """
+            AND u.user_id NOT IN (
+                SELECT to_user FROM likes WHERE from_user = %s
+            )
+            AND (
+                u.user_id NOT IN (
+                    SELECT viewed_user FROM viewed_profiles 
+                    WHERE viewer_user = %s AND can_view_again > CURRENT_TIMESTAMP
+                )
+            )
+            """
+    
     @staticmethod
     def add_like(from_user: int, to_user: int) -> bool:
-        # Добавляем лайк
-        Database.execute_query(
-            "INSERT INTO likes (from_user, to_user) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (from_user, to_user)
-        )
-        
-        # Проверяем взаимность
-        mutual = Database.execute_query(
-            "SELECT 1 FROM likes WHERE from_user = %s AND to_user = %s",
-            (to_user, from_user), "one"
+        """Ставит лайк и создает матч при взаимности - один вызов функции register_like в БД"""
+        result = Database.execute_query(
+            "SELECT register_like(%s, %s) AS is_match",
+            (from_user, to_user), "one"
         )
-        
-        if mutual:
-            # Создаем матч
-            user1, user2 = sorted([from_user, to_user])
-            Database.execute_query(
-                "INSERT INTO matches (user1, user2) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                (user1, user2)
-            )
-            return True
-        
-        return False
+        if result:
+            SeenFilter.add(from_user, [(to_user, None)])
+        return bool(result and result['is_match'])
     
     @staticmethod
     def mark_viewed(viewer: int, viewed: int):
-        # Получаем текущую запись о просмотре
-        current = Database.execute_query(
-            "SELECT * FROM viewed_profiles WHERE viewer_user = %s AND viewed_user = %s",
-            (viewer, viewed), "one"
-        )
+        if VIEW_FLUSH_INTERVAL > 0:
+            ViewBuffer.add(viewer, viewed)
+        else:
+            MatchManager.record_views([(viewer, viewed, 1)])
+    
+    @staticmethod
+    def record_views(views: List[Tuple[int, int, int]]) -> bool:
+        """Записывает просмотры (viewer, viewed, сколько раз) одним upsert.
         
-        now = datetime.now()
+        Когда анкету можно показать снова, зависит от итогового числа просмотров:
+        первый - через неделю, второй - через 30 дней, третий и далее - через 180 дней.
+        Пары в пакете должны быть уникальны.
+        """
+        written = Database.execute_values(
+            """INSERT INTO viewed_profiles (viewer_user, viewed_user, view_count, can_view_again)
+               VALUES %s
+               ON CONFLICT (viewer_user, viewed_user) DO UPDATE SET
+                   view_count = viewed_profiles.view_count + EXCLUDED.view_count,
+                   can_view_again = CURRENT_TIMESTAMP + CASE
+                       WHEN viewed_profiles.view_count + EXCLUDED.view_count >= 3 THEN INTERVAL '180 days'
+                       ELSE INTERVAL '30 days'
+                   END
+               RETURNING viewer_user, viewed_user, can_view_again""",
+            [(viewer, viewed, count, count) for viewer, viewed, count in views],
+            template="""(%s, %s, %s, CURRENT_TIMESTAMP + CASE %s
+                WHEN 1 THEN INTERVAL '7 days'
+                WHEN 2 THEN INTERVAL '30 days'
+                ELSE INTERVAL '180 days'
+            END)""",
+            fetch=True
+        )
+        if written is None:
+            return False
         
-        if current:
-            # Обновляем количество просмотров
-            new_count = current['view_count'] + 1
-            
-            # Определяем когда можно показать снова
-            if new_count == 1:  # Первый просмотр
-                next_view = now + timedelta(weeks=1)
-            elif new_count == 2:  # Второй просмотр
-                next_view = now + timedelta(days=30)
-            else:  # Третий и далее
-                next_view = now + timedelta(days=180)
-            
-            Database.execute_query(
-                "UPDATE viewed_profiles SET view_count = %s, can_view_again = %s WHERE viewer_user = %s AND viewed_user = %s",
-                (new_count, next_view, viewer, viewed)
-            )
-        else:
-            # Первый просмотр
-            next_view = now + timedelta(weeks=1)
-            Database.execute_query(
-                "INSERT INTO viewed_profiles (viewer_user, viewed_user, can_view_again) VALUES (%s, %s, %s)",
-                (viewer, viewed, next_view)
-            )
+        by_viewer: Dict[int, list] = {}
+        for row in written:
+            by_viewer.setdefault(row['viewer_user'], []).append((row['viewed_user'], row['can_view_again']))
+        for viewer, viewed in by_viewer.items():
+            SeenFilter.add(viewer, viewed)
+        return True
     
     @staticmethod
     def get_matches(user_id: int):
@@ -1222,29 +2090,28 @@ class MatchManager:
         )
     
     @staticmethod
-    def find_candidates(user_id: int):
+    def find_candidates(user_id: int, limit: int = 1, exclude: Optional[List[int]] = None,
+                        ids_only: bool = False):
         user = UserManager.get_user(user_id)
         if not user:
             return []
         
+        # Просмотренные и лайкнутые отсеиваются фильтром в памяти, если он доступен
+        seen = SeenFilter.get(user_id) if SEEN_FILTER_ENABLED else None
+        
         # Базовый запрос
-        query = """
-        SELECT DISTINCT u.* FROM users u
+        columns = "u.user_id" if ids_only else "u.*"
+        query = f"""
+        SELECT {columns} FROM users u
         WHERE u.user_id != %s 
         AND u.is_active = TRUE 
         AND u.is_banned = FALSE
-        AND u.user_id NOT IN (
-            SELECT to_user FROM likes WHERE from_user = %s
-        )
-        AND (
-            u.user_id NOT IN (
-                SELECT viewed_user FROM viewed_profiles 
-                WHERE viewer_user = %s AND can_view_again > CURRENT_TIMESTAMP
-            )
-        )
         """
+        params = [user_id]
         
-        params = [user_id, user_id, user_id]
+        if seen is None:
+            query += MatchManager.SEEN_EXCLUSION_SQL
+            params.extend([user_id, user_id])
         
         # Фильтр по поиску
         if user.get('search_all_ukraine', False) or (user['search_city'] and user['search_city'].lower() == 'вся украина'):
@@ -1254,59 +2121,798 @@ class MatchManager:
             # Ищем тех, кто находится в городе поиска пользователя
             # ИЛИ тех, кто ищет в текущем городе пользователя
             # Дополнительно проверяем расстояние если есть координаты
-            if user.get('search_lat') and user.get('search_lon'):
-                # Используем формулу расстояния между координатами (примерное расстояние)
-                query += """
-                AND (
-                    (u.current_city ILIKE %s)
-                    OR (u.search_city ILIKE %s)
-                    OR (
-                        u.current_lat IS NOT NULL AND u.current_lon IS NOT NULL
-                        AND (
-                            6371 * acos(
-                                cos(radians(%s)) * cos(radians(u.current_lat)) *
-                                cos(radians(u.current_lon) - radians(%s)) +
-                                sin(radians(%s)) * sin(radians(u.current_lat))
-                            )
-                        ) <= %s
-                    )
-                )
-                """
-                params.extend([
-                    f"%{user['search_city']}%", f"%{user['current_city']}%",
-                    user['search_lat'], user['search_lon'], user['search_lat'],
-                    user.get('search_radius', 50)
-                ])
+            # Города из справочника сравниваются по ID (индекс), ILIKE - только для старых анкет
+            conditions = []
+            if user.get('search_city_id'):
+                conditions.append(("u.current_city_id = %s", [user['search_city_id']]))
             else:
-                query += """
-                AND (
-                    (u.current_city ILIKE %s)
-                    OR (u.search_city ILIKE %s)
-                )
-                """
-                params.extend([f"%{user['search_city']}%", f"%{user['current_city']}%"])
+                conditions.append(("u.current_city ILIKE %s", [f"%{user['search_city']}%"]))
+            
+            if user.get('current_city_id'):
+                conditions.append(("u.search_city_id = %s", [user['current_city_id']]))
+            else:
+                conditions.append(("u.search_city ILIKE %s", [f"%{user['current_city']}%"]))
+            
+            if user.get('search_lat') and user.get('search_lon'):
+                # Прямоугольник по индексу координат, точное расстояние - только для попавших в него
+                conditions.append(geo_radius_filter(
+                    user['search_lat'], user['search_lon'], user.get('search_radius') or 50
+                ))
+            
+            query += "AND (" + " OR ".join(f"({sql})" for sql, _ in conditions) + ")"
+            for _, condition_params in conditions:
+                params.extend(condition_params)
+        
+        if seen is not None:
+            return MatchManager._find_unseen(user_id, seen, query, params, limit, exclude)
         
-        query += " ORDER BY RANDOM() LIMIT 1"
+        # Кандидаты, которые уже стоят в ленте пользователя
+        if exclude:
+            query += " AND u.user_id <> ALL(%s)"
+            params.append(list(exclude))
+        
+        query += " ORDER BY RANDOM() LIMIT %s"
+        params.append(limit)
         
         return Database.execute_query(query, tuple(params), "all")
-
-class ComplaintManager:
-    """Управление жалобами"""
     
     @staticmethod
-    def can_file_complaint(user_id: int) -> Tuple[bool, str]:
-        # Проверяем дневной лимит
-        today = datetime.now().date()
+    def _find_unseen(user_id: int, seen: "SeenSet", query: str, params: list, limit: int,
+                     exclude: Optional[List[int]]) -> list:
+        """Выбирает кандидатов с запасом и отсеивает просмотренных фильтром.
+        В БД проверяются только те, кого фильтр считает возможно просмотренными."""
+        skip = list(exclude) if exclude else []
+        result = []
+        exhausted = False
         
-        limits = Database.execute_query(
-            "SELECT * FROM daily_limits WHERE user_id = %s",
-            (user_id,), "one"
-        )
+        for _ in range(SeenFilter.MAX_ROUNDS):
+            wanted = (limit - len(result)) * SeenFilter.OVERSCAN
+            round_query, round_params = query, list(params)
+            if skip:
+                round_query += " AND u.user_id <> ALL(%s)"
+                round_params.append(skip)
+            round_query += " ORDER BY RANDOM() LIMIT %s"
+            round_params.append(wanted)
+            
+            rows = Database.execute_query(round_query, tuple(round_params), "all")
+            if not rows:
+                exhausted = rows is not None
+                break
+            
+            ids = [row['user_id'] for row in rows]
+            confirmed = MatchManager._confirm_seen(user_id, SeenFilter.check(seen, ids))
+            for row in rows:
+                if row['user_id'] not in confirmed and len(result) < limit:
+                    result.append(row)
+            skip.extend(ids)
+            exhausted = len(rows) < wanted
+            
+            if len(result) >= limit or exhausted:
+                break
         
-        if limits:
-            if limits['last_complaint_date'] == today:
-                if limits['complaints_today'] >= 5:
-                    return False, "Вы можете подавать максимум 5 жалоб в день"
+        if len(result) < limit and not exhausted:
+            # Все выборки оказались просмотренными, но кандидаты еще есть -
+            # добираем точным запросом, иначе зритель увидит "анкеты закончились"
+            exact_query = query + MatchManager.SEEN_EXCLUSION_SQL
+            exact_params = list(params) + [user_id, user_id]
+            if skip:
+                exact_query += " AND u.user_id <> ALL(%s)"
+                exact_params.append(skip)
+            exact_query += " ORDER BY RANDOM() LIMIT %s"
+            exact_params.append(limit - len(result))
+            result.extend(Database.execute_query(exact_query, tuple(exact_params), "all") or [])
+        
+        return result
+    
+    @staticmethod
+    def _confirm_seen(viewer: int, maybe_seen: List[int]) -> set:
+        """Какие из возможно просмотренных действительно скрыты: лайкнуты или просмотрены недавно"""
+        if not maybe_seen:
+            return set()
+        rows = Database.execute_query(
+            """SELECT viewed_user AS user_id FROM viewed_profiles
+               WHERE viewer_user = %s AND viewed_user = ANY(%s) AND can_view_again > CURRENT_TIMESTAMP
+               UNION
+               SELECT to_user FROM likes WHERE from_user = %s AND to_user = ANY(%s)""",
+            (viewer, maybe_seen, viewer, maybe_seen), "all"
+        )
+        if rows is None:
+            # Без подтверждения надежнее не показывать
+            return set(maybe_seen)
+        confirmed = {row['user_id'] for row in rows}
+        SeenFilter.record_false_positives(len(maybe_seen) - len(confirmed))
+        return confirmed
+    
+    @staticmethod
+    def find_candidate_ids(user_id: int, limit: int, exclude: Optional[List[int]] = None) -> List[int]:
+        rows = MatchManager.find_candidates(user_id, limit, exclude, ids_only=True)
+        return [row['user_id'] for row in rows] if rows else []
+
+class FeedBackend:
+    """Хранилище очередей кандидатов (интерфейс)"""
+    
+    def pop(self, viewer: int) -> Optional[int]:
+        raise NotImplementedError
+    
+    def extend(self, viewer: int, candidate_ids: List[int]):
+        raise NotImplementedError
+    
+    def discard(self, viewer: int, candidate_id: int):
+        raise NotImplementedError
+    
+    def peek(self, viewer: int) -> Optional[int]:
+        raise NotImplementedError
+    
+    def snapshot(self, viewer: int) -> List[int]:
+        raise NotImplementedError
+    
+    def clear(self, viewer: int):
+        raise NotImplementedError
+
+class InMemoryFeedBackend(FeedBackend):
+    """Очереди кандидатов в памяти процесса, не более max_viewers очередей (LRU)"""
+    
+    def __init__(self, max_viewers: int = 10000):
+        self.max_viewers = max_viewers
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def pop(self, viewer: int) -> Optional[int]:
+        with self._lock:
+            queue = self._queues.get(viewer)
+            if not queue:
+                return None
+            self._queues.move_to_end(viewer)
+            return queue.popleft()
+    
+    def extend(self, viewer: int, candidate_ids: List[int]):
+        with self._lock:
+            queue = self._queues.get(viewer)
+            if queue is None:
+                queue = self._queues[viewer] = deque()
+            queue.extend(candidate_ids)
+            self._queues.move_to_end(viewer)
+            while len(self._queues) > self.max_viewers:
+                self._queues.popitem(last=False)
+    
+    def discard(self, viewer: int, candidate_id: int):
+        with self._lock:
+            queue = self._queues.get(viewer)
+            if queue:
+                try:
+                    queue.remove(candidate_id)
+                except ValueError:
+                    pass
+    
+    def peek(self, viewer: int) -> Optional[int]:
+        with self._lock:
+            queue = self._queues.get(viewer)
+            return queue[0] if queue else None
+    
+    def snapshot(self, viewer: int) -> List[int]:
+        with self._lock:
+            return list(self._queues.get(viewer, ()))
+    
+    def clear(self, viewer: int):
+        with self._lock:
+            self._queues.pop(viewer, None)
+
+class ViewBuffer:
+    """Отложенная запись просмотров: события копятся в памяти и раз в
+    VIEW_FLUSH_INTERVAL секунд уходят в БД одним пакетным upsert.
+    Повторные просмотры одной пары до сброса схлопываются в счетчик."""
+    
+    _pending: Dict[int, Dict[int, int]] = {}  # viewer -> {viewed: сколько раз}
+    _flushing: Dict[int, Dict[int, int]] = {}  # снимок, который сейчас пишется в БД
+    _size = 0
+    _lock = threading.Lock()
+    _wakeup = threading.Event()
+    _stopping = threading.Event()
+    _thread: Optional[threading.Thread] = None
+    stats = {"events": 0, "flushes": 0, "rows": 0, "errors": 0}
+    
+    @staticmethod
+    def add(viewer: int, viewed: int):
+        with ViewBuffer._lock:
+            viewed_counts = ViewBuffer._pending.setdefault(viewer, {})
+            if viewed not in viewed_counts:
+                ViewBuffer._size += 1
+            viewed_counts[viewed] = viewed_counts.get(viewed, 0) + 1
+            ViewBuffer.stats["events"] += 1
+            size = ViewBuffer._size
+            if ViewBuffer._thread is None:
+                ViewBuffer.start()
+        
+        if size >= VIEW_BUFFER_MAX:
+            ViewBuffer._wakeup.set()
+    
+    @staticmethod
+    def pending_for(viewer: int) -> List[int]:
+        """Анкеты, просмотр которых зритель уже сделал, но он еще не записан в БД"""
+        with ViewBuffer._lock:
+            return list(ViewBuffer._pending.get(viewer, ())) + list(ViewBuffer._flushing.get(viewer, ()))
+    
+    @staticmethod
+    def flush() -> int:
+        """Записывает накопленные просмотры, возвращает число строк"""
+        with ViewBuffer._lock:
+            pending = ViewBuffer._pending
+            ViewBuffer._pending = {}
+            ViewBuffer._flushing = pending
+            ViewBuffer._size = 0
+        
+        rows = [
+            (viewer, viewed, count)
+            for viewer, viewed_counts in pending.items()
+            for viewed, count in viewed_counts.items()
+        ]
+        if not rows:
+            return 0
+        
+        written = MatchManager.record_views(rows)
+        with ViewBuffer._lock:
+            ViewBuffer._flushing = {}
+        
+        if not written:
+            # Возвращаем события в буфер, чтобы записать при следующем сбросе
+            with ViewBuffer._lock:
+                ViewBuffer.stats["errors"] += 1
+                for viewer, viewed, count in rows:
+                    viewed_counts = ViewBuffer._pending.setdefault(viewer, {})
+                    if viewed not in viewed_counts:
+                        ViewBuffer._size += 1
+                    viewed_counts[viewed] = viewed_counts.get(viewed, 0) + count
+            return 0
+        
+        with ViewBuffer._lock:
+            ViewBuffer.stats["flushes"] += 1
+            ViewBuffer.stats["rows"] += len(rows)
+        return len(rows)
+    
+    @staticmethod
+    def _run():
+        while not ViewBuffer._stopping.is_set():
+            ViewBuffer._wakeup.wait(VIEW_FLUSH_INTERVAL)
+            ViewBuffer._wakeup.clear()
+            try:
+                ViewBuffer.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи просмотров: {e}")
+    
+    @staticmethod
+    def start():
+        ViewBuffer._stopping.clear()
+        ViewBuffer._thread = threading.Thread(target=ViewBuffer._run, name="view-buffer", daemon=True)
+        ViewBuffer._thread.start()
+    
+    @staticmethod
+    def stop():
+        """Останавливает фоновый сброс и дописывает остаток буфера"""
+        with ViewBuffer._lock:
+            thread = ViewBuffer._thread
+            ViewBuffer._thread = None
+        if thread is not None:
+            ViewBuffer._stopping.set()
+            ViewBuffer._wakeup.set()
+            thread.join()
+        ViewBuffer.flush()
+    
+    @staticmethod
+    def get_stats() -> dict:
+        with ViewBuffer._lock:
+            return {**ViewBuffer.stats, "pending": ViewBuffer._size}
+
+class BloomFilter:
+    """Фильтр Блума для целочисленных ID: без ложноотрицательных ответов,
+    ложноположительные - с вероятностью около error_rate при заполнении до capacity"""
+    
+    __slots__ = ("capacity", "count", "num_bits", "num_hashes", "bits")
+    
+    _MASK = (1 << 64) - 1
+    
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.count = 0
+        self.num_bits = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+    
+    def _positions(self, item: int):
+        # splitmix64 дает два независимых хэша, остальные - двойным хэшированием
+        h = (item + 0x9E3779B97F4A7C15) & self._MASK
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & self._MASK
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & self._MASK
+        h ^= h >> 31
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+    
+    def add(self, item: int):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+    
+    def __contains__(self, item: int) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+    
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+    
+    # Заголовок: capacity, count, num_bits, num_hashes; за ним - массив битов
+    _HEADER = struct.Struct("<IIII")
+    
+    def to_bytes(self) -> bytes:
+        return self._HEADER.pack(self.capacity, self.count, self.num_bits, self.num_hashes) + bytes(self.bits)
+    
+    @classmethod
+    def from_buffer(cls, data: bytes, offset: int) -> Tuple["BloomFilter", int]:
+        """Фильтр, записанный to_bytes с позиции offset, и позиция после него"""
+        capacity, count, num_bits, num_hashes = cls._HEADER.unpack_from(data, offset)
+        offset += cls._HEADER.size
+        size = (num_bits + 7) // 8
+        if not capacity or not num_bits or not 1 <= num_hashes <= 64 or offset + size > len(data):
+            raise ValueError("некорректный заголовок фильтра Блума")
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.count, bloom.num_bits, bloom.num_hashes = capacity, count, num_bits, num_hashes
+        bloom.bits = bytearray(data[offset:offset + size])
+        return bloom, offset + size
+
+class SeenSet:
+    """Просмотренные зрителем анкеты: постоянный слой для лайков и слои просмотров,
+    сгруппированные по неделе истечения can_view_again. Слой заполнился -
+    к нему добавляется следующий фильтр Блума, истекший слой выбрасывается целиком."""
+    
+    def __init__(self):
+        self.permanent: List[BloomFilter] = []
+        self.buckets: Dict[int, List[BloomFilter]] = {}  # последний день слоя -> фильтры
+        self.changes = 0
+    
+    @staticmethod
+    def _day(moment: datetime) -> int:
+        return (moment - datetime(1970, 1, 1)).days
+    
+    @staticmethod
+    def _today() -> int:
+        return SeenSet._day(datetime.now())
+    
+    def add(self, item: int, expires: Optional[datetime] = None):
+        """expires=None - навсегда (лайк), иначе до момента, когда анкету можно показать снова"""
+        if expires is None:
+            layer = self.permanent
+        else:
+            # Слой живет до конца своей недели: анкета может скрываться дольше, но не меньше
+            # срока - такие лишние совпадения отсеет проверка в БД
+            end_day = (self._day(expires) // SEEN_BUCKET_DAYS + 1) * SEEN_BUCKET_DAYS
+            layer = self.buckets.setdefault(end_day, [])
+        
+        if not layer or layer[-1].is_full():
+            layer.append(BloomFilter(SEEN_FILTER_CAPACITY, SEEN_FILTER_ERROR_RATE))
+        layer[-1].add(item)
+        self.changes += 1
+    
+    def expire(self):
+        # День запаса на расхождение часовых поясов процесса и БД
+        today = self._today()
+        for end_day in [day for day in self.buckets if day + 1 <= today]:
+            del self.buckets[end_day]
+    
+    def __contains__(self, item: int) -> bool:
+        if any(item in bloom for bloom in self.permanent):
+            return True
+        today = self._today()
+        return any(
+            item in bloom
+            for end_day, layer in self.buckets.items() if end_day + 1 > today
+            for bloom in layer
+        )
+    
+    # Формат: сигнатура, версия и число слоев; у каждого слоя - последний день
+    # (PERMANENT_DAY у постоянного) и число фильтров, за ним фильтры (BloomFilter.to_bytes)
+    _MAGIC = b"SEEN"
+    _VERSION = 1
+    _HEADER = struct.Struct("<4sBI")
+    _LAYER = struct.Struct("<iI")
+    PERMANENT_DAY = -1
+    
+    def to_bytes(self) -> bytes:
+        self.expire()
+        layers = [(self.PERMANENT_DAY, self.permanent), *self.buckets.items()]
+        parts = [self._HEADER.pack(self._MAGIC, self._VERSION, len(layers))]
+        for end_day, layer in layers:
+            parts.append(self._LAYER.pack(end_day, len(layer)))
+            parts.extend(bloom.to_bytes() for bloom in layer)
+        return b"".join(parts)
+    
+    @staticmethod
+    def from_bytes(data: bytes) -> "SeenSet":
+        magic, version, layers = SeenSet._HEADER.unpack_from(data, 0)
+        if magic != SeenSet._MAGIC or version != SeenSet._VERSION:
+            raise ValueError("неизвестный формат фильтра просмотров")
+        offset = SeenSet._HEADER.size
+        seen = SeenSet()
+        for _ in range(layers):
+            end_day, filters = SeenSet._LAYER.unpack_from(data, offset)
+            offset += SeenSet._LAYER.size
+            layer = seen.permanent if end_day == SeenSet.PERMANENT_DAY else seen.buckets.setdefault(end_day, [])
+            for _ in range(filters):
+                bloom, offset = BloomFilter.from_buffer(data, offset)
+                layer.append(bloom)
+        if offset != len(data):
+            raise ValueError("лишние данные после фильтра просмотров")
+        seen.expire()
+        return seen
+
+class SeenFilter:
+    """Фильтры просмотренных анкет для зрителей: не более SEEN_FILTER_MAX_VIEWERS в памяти (LRU),
+    сохраняются в таблицу seen_filters и догружаются из БД изменениями после сохранения"""
+    
+    OVERSCAN = 2  # во сколько раз больше кандидатов выбирать под отсев
+    MAX_ROUNDS = 3  # сколько раз добирать кандидатов, если отсеялось слишком много
+    SAVE_MARGIN = timedelta(minutes=5)  # запас при догрузке изменений после сохранения
+    
+    _sets: "OrderedDict[int, SeenSet]" = OrderedDict()
+    _loading: Dict[int, list] = {}  # изменения, пришедшие во время загрузки фильтра
+    _lock = threading.Lock()
+    stats = {"checked": 0, "maybe_seen": 0, "false_positives": 0, "loads": 0, "saves": 0}
+    
+    @staticmethod
+    def get(viewer: int) -> Optional[SeenSet]:
+        """Фильтр зрителя, при необходимости загруженный из БД; None, если БД недоступна"""
+        with SeenFilter._lock:
+            seen = SeenFilter._sets.get(viewer)
+            if seen is not None:
+                SeenFilter._sets.move_to_end(viewer)
+                return seen
+            owner = viewer not in SeenFilter._loading
+            if owner:
+                SeenFilter._loading[viewer] = []
+        
+        seen = SeenFilter._load(viewer)
+        
+        evicted = []
+        with SeenFilter._lock:
+            pending = SeenFilter._loading.pop(viewer, []) if owner else []
+            if seen is None:
+                return None
+            
+            # Фильтр мог успеть загрузить параллельный запрос
+            resident = SeenFilter._sets.get(viewer)
+            for item, expires in pending:
+                (resident or seen).add(item, expires)
+            if resident is not None:
+                return resident
+            SeenFilter._sets[viewer] = seen
+            SeenFilter.stats["loads"] += 1
+            while len(SeenFilter._sets) > SEEN_FILTER_MAX_VIEWERS:
+                evicted.append(SeenFilter._sets.popitem(last=False))
+        
+        for evicted_viewer, evicted_set in evicted:
+            if evicted_set.changes:
+                SeenFilter.save(evicted_viewer, evicted_set)
+        return seen
+    
+    @staticmethod
+    def _load(viewer: int) -> Optional[SeenSet]:
+        saved = Database.execute_query(
+            "SELECT data, saved_at FROM seen_filters WHERE viewer_user = %s",
+            (viewer,), "one"
+        )
+        
+        seen = None
+        since = None
+        if saved:
+            try:
+                seen = SeenSet.from_bytes(bytes(saved['data']))
+                since = saved['saved_at'] - SeenFilter.SAVE_MARGIN
+            except Exception as e:
+                logger.error(f"Поврежден фильтр просмотров {viewer}: {e}")
+        if seen is None:
+            seen = SeenSet()
+        
+        # Догружаем то, что записано после сохранения (или все, если сохранения нет).
+        # Каждый просмотр откладывает анкету минимум на неделю, поэтому новые
+        # просмотры видны по can_view_again
+        views_query = """SELECT viewed_user, can_view_again FROM viewed_profiles
+                         WHERE viewer_user = %s AND can_view_again > CURRENT_TIMESTAMP"""
+        likes_query = "SELECT to_user FROM likes WHERE from_user = %s"
+        views_params = [viewer]
+        likes_params = [viewer]
+        if since is not None:
+            views_query += " AND can_view_again >= %s"
+            views_params.append(since + timedelta(weeks=1))
+            likes_query += " AND created_at >= %s"
+            likes_params.append(since)
+        
+        views = Database.execute_query(views_query, tuple(views_params), "all")
+        likes = Database.execute_query(likes_query, tuple(likes_params), "all")
+        if views is None or likes is None:
+            return None
+        
+        for row in views:
+            seen.add(row['viewed_user'], row['can_view_again'])
+        for row in likes:
+            seen.add(row['to_user'])
+        if since is None and not views and not likes:
+            seen.changes = 0
+        return seen
+    
+    @staticmethod
+    def add(viewer: int, items: List[Tuple[int, Optional[datetime]]]):
+        """Отмечает анкеты просмотренными (expires) или лайкнутыми (None).
+        Фильтры, которых нет в памяти, не трогаем - они догрузят изменения из БД."""
+        to_save = None
+        with SeenFilter._lock:
+            seen = SeenFilter._sets.get(viewer)
+            if seen is None:
+                pending = SeenFilter._loading.get(viewer)
+                if pending is not None:
+                    pending.extend(items)
+                return
+            for item, expires in items:
+                seen.add(item, expires)
+            if seen.changes >= SEEN_SAVE_EVERY:
+                to_save = seen
+        
+        if to_save is not None:
+            SeenFilter.save(viewer, to_save)
+    
+    @staticmethod
+    def check(seen: SeenSet, ids: List[int]) -> List[int]:
+        """ID, которые фильтр считает возможно просмотренными"""
+        with SeenFilter._lock:
+            maybe_seen = [user_id for user_id in ids if user_id in seen]
+            SeenFilter.stats["checked"] += len(ids)
+            SeenFilter.stats["maybe_seen"] += len(maybe_seen)
+        return maybe_seen
+    
+    @staticmethod
+    def record_false_positives(count: int):
+        with SeenFilter._lock:
+            SeenFilter.stats["false_positives"] += count
+    
+    @staticmethod
+    def save(viewer: int, seen: SeenSet):
+        with SeenFilter._lock:
+            data = seen.to_bytes()
+            changes = seen.changes
+            seen.changes = 0
+        
+        saved = Database.execute_query(
+            """INSERT INTO seen_filters (viewer_user, data, saved_at)
+               VALUES (%s, %s, CURRENT_TIMESTAMP)
+               ON CONFLICT (viewer_user) DO UPDATE SET data = EXCLUDED.data, saved_at = EXCLUDED.saved_at
+               RETURNING viewer_user""",
+            (viewer, psycopg2.Binary(data)), "one"
+        )
+        with SeenFilter._lock:
+            if saved:
+                SeenFilter.stats["saves"] += 1
+            else:
+                seen.changes += changes
+    
+    @staticmethod
+    def save_all():
+        """Сохраняет все измененные фильтры (при остановке бота)"""
+        with SeenFilter._lock:
+            dirty = [(viewer, seen) for viewer, seen in SeenFilter._sets.items() if seen.changes]
+        for viewer, seen in dirty:
+            SeenFilter.save(viewer, seen)
+    
+    @staticmethod
+    def get_stats() -> dict:
+        with SeenFilter._lock:
+            stats = dict(SeenFilter.stats)
+            stats["viewers"] = len(SeenFilter._sets)
+        stats["false_positive_rate"] = stats["false_positives"] / stats["checked"] if stats["checked"] else 0.0
+        return stats
+
+class CandidateFeed:
+    """Лента кандидатов: заранее перемешанная очередь ID для каждого пользователя"""
+    
+    backend: FeedBackend = InMemoryFeedBackend(FEED_MAX_VIEWERS)
+    # Последний выданный кандидат (карточка на экране) - не возвращаем его при дозаполнении
+    _on_screen: "OrderedDict[int, int]" = OrderedDict()
+    # Заготовка следующей анкеты: viewer -> (candidate_id, задача загрузки, когда начата)
+    _prefetched: "OrderedDict[int, Tuple[int, asyncio.Task, float]]" = OrderedDict()
+    _prefetched_viewers: Dict[int, set] = {}  # candidate_id -> зрители с его заготовкой
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _refilling: set = set()
+    _tasks: set = set()
+    stats = {"prefetch_hits": 0, "prefetch_misses": 0, "prefetch_dropped": 0}
+    
+    @staticmethod
+    def _refill_exclude(viewer: int) -> List[int]:
+        """Кого не возвращать при дозаполнении. Собирается в event loop до передачи в поток БД"""
+        exclude = CandidateFeed.backend.snapshot(viewer)
+        on_screen = CandidateFeed._on_screen.get(viewer)
+        if on_screen is not None:
+            exclude.append(on_screen)
+        exclude.extend(ViewBuffer.pending_for(viewer))
+        return exclude
+    
+    @staticmethod
+    def refill(viewer: int, exclude: List[int]) -> int:
+        """Дозаполняет очередь пачкой кандидатов из БД, возвращает сколько добавлено"""
+        candidate_ids = MatchManager.find_candidate_ids(viewer, FEED_BATCH_SIZE, exclude)
+        if candidate_ids:
+            CandidateFeed.backend.extend(viewer, candidate_ids)
+        return len(candidate_ids)
+    
+    @staticmethod
+    def _schedule_refill(viewer: int):
+        if viewer in CandidateFeed._refilling:
+            return
+        CandidateFeed._refilling.add(viewer)
+        
+        async def refill_task():
+            try:
+                await Database.run(CandidateFeed.refill, viewer, CandidateFeed._refill_exclude(viewer))
+            except Exception as e:
+                logger.error(f"Ошибка дозаполнения ленты {viewer}: {e}")
+            finally:
+                CandidateFeed._refilling.discard(viewer)
+        
+        task = asyncio.get_running_loop().create_task(refill_task())
+        CandidateFeed._tasks.add(task)
+        task.add_done_callback(CandidateFeed._tasks.discard)
+    
+    @staticmethod
+    async def _load_card(candidate_id: int) -> Optional[dict]:
+        """Анкета с готовым текстом карточки (ключ 'caption')"""
+        candidate = await Database.run(UserManager.get_profile_card, candidate_id)
+        if candidate:
+            candidate['caption'] = format_profile_text(candidate)
+        return candidate
+    
+    @staticmethod
+    def _schedule_prefetch(viewer: int):
+        """Пока карточка на экране, заранее грузим следующую анкету из очереди"""
+        candidate_id = CandidateFeed.backend.peek(viewer)
+        if candidate_id is None or (UserRegistry.is_loaded() and UserRegistry.is_banned(candidate_id)):
+            return
+        
+        async def prefetch_task():
+            try:
+                return await CandidateFeed._load_card(candidate_id)
+            except Exception as e:
+                logger.error(f"Ошибка предзагрузки анкеты {candidate_id}: {e}")
+                return None
+        
+        task = asyncio.get_running_loop().create_task(prefetch_task())
+        CandidateFeed._pop_prefetched(viewer)
+        prefetched = CandidateFeed._prefetched
+        prefetched[viewer] = (candidate_id, task, time.monotonic())
+        CandidateFeed._prefetched_viewers.setdefault(candidate_id, set()).add(viewer)
+        while len(prefetched) > FEED_MAX_VIEWERS:
+            CandidateFeed._pop_prefetched(next(iter(prefetched)))
+    
+    @staticmethod
+    def _pop_prefetched(viewer: int) -> Optional[Tuple[int, asyncio.Task, float]]:
+        """Убирает заготовку зрителя вместе с записью в индексе по кандидату"""
+        slot = CandidateFeed._prefetched.pop(viewer, None)
+        if slot is not None:
+            viewers = CandidateFeed._prefetched_viewers.get(slot[0])
+            if viewers is not None:
+                viewers.discard(viewer)
+                if not viewers:
+                    del CandidateFeed._prefetched_viewers[slot[0]]
+        return slot
+    
+    @staticmethod
+    def _on_loop(func: Callable, *args):
+        """Выполняет func в потоке event loop: состояние ленты меняет только он.
+        Из потоков БД и событий кластера вызов передается через call_soon_threadsafe."""
+        loop = CandidateFeed._loop
+        try:
+            in_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop or loop is None or loop.is_closed():
+            # Без работающего loop (скрипты, тесты) конкурентов нет
+            func(*args)
+        else:
+            loop.call_soon_threadsafe(func, *args)
+    
+    @staticmethod
+    async def _take_prefetched(viewer: int, candidate_id: int) -> Optional[dict]:
+        """Заготовленная анкета, если она для этого кандидата и еще свежая"""
+        slot = CandidateFeed._pop_prefetched(viewer)
+        if slot is None:
+            return None
+        prefetched_id, task, started = slot
+        if prefetched_id != candidate_id or time.monotonic() - started > FEED_PREFETCH_TTL:
+            CandidateFeed.stats["prefetch_dropped"] += 1
+            return None
+        # Если загрузка еще идет (пользователь быстро листает), дожидаемся ее, а не грузим заново
+        return await task
+    
+    @staticmethod
+    def drop_prefetched(candidate_id: int):
+        """Сбрасывает заготовки с этой анкетой (изменена, скрыта или заблокирована).
+        Вызывается и из потоков БД/событий кластера"""
+        CandidateFeed._on_loop(CandidateFeed._drop_prefetched, candidate_id)
+    
+    @staticmethod
+    def _drop_prefetched(candidate_id: int):
+        for viewer in list(CandidateFeed._prefetched_viewers.get(candidate_id, ())):
+            if CandidateFeed._pop_prefetched(viewer) is not None:
+                CandidateFeed.stats["prefetch_dropped"] += 1
+    
+    @staticmethod
+    async def next_candidate(viewer: int):
+        """Следующая анкета для показа или None, если кандидаты закончились"""
+        CandidateFeed._loop = asyncio.get_running_loop()
+        refilled = False
+        while True:
+            candidate_id = CandidateFeed.backend.pop(viewer)
+            if candidate_id is None:
+                CandidateFeed._pop_prefetched(viewer)
+                if refilled or not await Database.run(
+                    CandidateFeed.refill, viewer, CandidateFeed._refill_exclude(viewer)
+                ):
+                    CandidateFeed._on_screen.pop(viewer, None)
+                    return None
+                refilled = True
+                continue
+            
+            # Пока просмотр не записан в БД, дозаполнение не должно вернуть эту анкету
+            on_screen = CandidateFeed._on_screen
+            on_screen[viewer] = candidate_id
+            on_screen.move_to_end(viewer)
+            while len(on_screen) > FEED_MAX_VIEWERS:
+                on_screen.popitem(last=False)
+            
+            # Анкета могла быть заблокирована или скрыта после попадания в очередь
+            if UserManager.is_user_banned(candidate_id):
+                CandidateFeed._pop_prefetched(viewer)
+                continue
+            candidate = await CandidateFeed._take_prefetched(viewer, candidate_id) if FEED_PREFETCH else None
+            if candidate is not None:
+                CandidateFeed.stats["prefetch_hits"] += 1
+            else:
+                if FEED_PREFETCH:
+                    CandidateFeed.stats["prefetch_misses"] += 1
+                candidate = await CandidateFeed._load_card(candidate_id)
+            if not candidate or candidate['is_banned'] or not candidate['is_active']:
+                continue
+            
+            if len(CandidateFeed.backend.snapshot(viewer)) < FEED_REFILL_THRESHOLD:
+                CandidateFeed._schedule_refill(viewer)
+            if FEED_PREFETCH:
+                CandidateFeed._schedule_prefetch(viewer)
+            return candidate
+    
+    @staticmethod
+    def discard(viewer: int, candidate_id: int):
+        """Убирает из ленты анкету, которую пользователь уже лайкнул или просмотрел"""
+        CandidateFeed.backend.discard(viewer, candidate_id)
+    
+    @staticmethod
+    def reset(viewer: int):
+        """Сбрасывает ленту (например, после смены параметров поиска)"""
+        CandidateFeed.backend.clear(viewer)
+        # reset вызывается и из потоков БД (update_user_field)
+        CandidateFeed._on_loop(CandidateFeed._on_screen.pop, viewer, None)
+        CandidateFeed._on_loop(CandidateFeed._pop_prefetched, viewer)
+
+class ComplaintManager:
+    """Управление жалобами"""
+    
+    @staticmethod
+    def can_file_complaint(user_id: int) -> Tuple[bool, str]:
+        # Проверяем дневной лимит
+        today = datetime.now().date()
+        
+        limits = Database.execute_query(
+            "SELECT * FROM daily_limits WHERE user_id = %s",
+            (user_id,), "one"
+        )
+        
+        if limits:
+            if limits['last_complaint_date'] == today:
+                if limits['complaints_today'] >= 5:
+                    return False, "Вы можете подавать максимум 5 жалоб в день"
             else:
                 # Сбрасываем счетчик
                 Database.execute_query(
@@ -1353,21 +2959,37 @@ class ComplaintManager:
         )
         
         # Логируем жалобу
-        user_logger.info(f"Complaint filed: user {from_user} complained about user {against_user} for {reason}")
+        user_logger.info(
+            f"Complaint filed: user {from_user} complained about user {against_user} for {reason}",
+            extra={"action": "complaint", "user_id": from_user, "target_id": against_user, "reason": reason}
+        )
         
         # Автоматическая блокировка после 5 жалоб от разных пользователей
         if complaint_count and complaint_count['count'] >= 5:
-            Database.execute_query(
-                "UPDATE users SET is_banned = TRUE WHERE user_id = %s",
-                (against_user,)
+            UserManager.set_banned(against_user, True)
+            user_logger.warning(
+                f"User {against_user} automatically banned after {complaint_count['count']} complaints",
+                extra={"action": "auto_ban", "user_id": against_user, "complaints": complaint_count['count']}
             )
-            user_logger.warning(f"User {against_user} automatically banned after {complaint_count['count']} complaints")
             return True  # Пользователь заблокирован
         
         return False
 
 class CaptchaManager:
-    """Управление капчей"""
+    """Управление капчей.
+    
+    Выданные примеры и неудачные попытки живут только в памяти процесса (все
+    обновления пользователя приходят в один воркер): пример действует CAPTCHA_TTL
+    секунд, после CAPTCHA_MAX_ATTEMPTS ошибок за скользящее окно
+    CAPTCHA_LOCKOUT_WINDOW пользователь ждет, пока старые ошибки не выйдут из окна.
+    В БД пишется только факт прохождения, поэтому волна ботов не дает записей.
+    """
+    
+    _lock = threading.Lock()
+    _challenges: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()  # user_id -> (ответ, истекает)
+    _failures: "OrderedDict[int, deque]" = OrderedDict()  # user_id -> время ошибок в окне
+    _verified: "OrderedDict[int, bool]" = OrderedDict()  # прошедшие капчу (кэш is_verified)
+    stats = {"issued": 0, "passed": 0, "failed": 0, "locked": 0}
     
     @staticmethod
     def generate_captcha() -> Tuple[str, str]:
@@ -1387,45 +3009,329 @@ class CaptchaManager:
         
         return question, answer
     
+    @staticmethod
+    def _prune(now: float):
+        """Убирает истекшие записи с начала очередей (они упорядочены по времени)"""
+        challenges = CaptchaManager._challenges
+        while challenges and next(iter(challenges.values()))[1] <= now:
+            challenges.popitem(last=False)
+        while len(challenges) > CAPTCHA_MAX_PENDING:
+            challenges.popitem(last=False)
+        
+        failures = CaptchaManager._failures
+        while failures:
+            times = next(iter(failures.values()))
+            if times and times[-1] > now - CAPTCHA_LOCKOUT_WINDOW and len(failures) <= CAPTCHA_MAX_PENDING:
+                break
+            failures.popitem(last=False)
+    
+    @staticmethod
+    def _recent_failures(user_id: int, now: float) -> int:
+        times = CaptchaManager._failures.get(user_id)
+        if not times:
+            return 0
+        while times and times[0] <= now - CAPTCHA_LOCKOUT_WINDOW:
+            times.popleft()
+        return len(times)
+    
+    @staticmethod
+    def lockout_remaining(user_id: int) -> float:
+        """Сколько секунд пользователь еще заблокирован (0 - не заблокирован)"""
+        now = time.monotonic()
+        with CaptchaManager._lock:
+            if CaptchaManager._recent_failures(user_id, now) < CAPTCHA_MAX_ATTEMPTS:
+                return 0.0
+            times = CaptchaManager._failures[user_id]
+            # Разблокируется, когда в окне останется меньше CAPTCHA_MAX_ATTEMPTS ошибок
+            return times[-CAPTCHA_MAX_ATTEMPTS] + CAPTCHA_LOCKOUT_WINDOW - now
+    
+    @staticmethod
+    def issue_challenge(user_id: int) -> Optional[str]:
+        """Выдает новый пример и возвращает вопрос, или None, если пользователь заблокирован"""
+        if CaptchaManager.lockout_remaining(user_id) > 0:
+            CaptchaManager.stats["locked"] += 1
+            return None
+        question, answer = CaptchaManager.generate_captcha()
+        now = time.monotonic()
+        with CaptchaManager._lock:
+            CaptchaManager._prune(now)
+            CaptchaManager._challenges[user_id] = (answer, now + CAPTCHA_TTL)
+            CaptchaManager._challenges.move_to_end(user_id)
+        CaptchaManager.stats["issued"] += 1
+        return question
+    
+    @staticmethod
+    def check_answer(user_id: int, answer: str) -> Tuple[Optional[bool], int]:
+        """Проверяет ответ. Возвращает (верно ли, ошибок в окне);
+        None вместо результата - активного примера нет (истек или не выдавался)"""
+        now = time.monotonic()
+        with CaptchaManager._lock:
+            challenge = CaptchaManager._challenges.pop(user_id, None)
+            if challenge is None or challenge[1] <= now:
+                return None, CaptchaManager._recent_failures(user_id, now)
+            if answer == challenge[0]:
+                CaptchaManager._failures.pop(user_id, None)
+                return True, 0
+            
+            times = CaptchaManager._failures.get(user_id)
+            if times is None:
+                times = CaptchaManager._failures[user_id] = deque()
+            times.append(now)
+            CaptchaManager._failures.move_to_end(user_id)
+            CaptchaManager.stats["failed"] += 1
+            return False, CaptchaManager._recent_failures(user_id, now)
+    
     @staticmethod
     def is_verified(user_id: int) -> bool:
+        with CaptchaManager._lock:
+            if user_id in CaptchaManager._verified:
+                return True
+            # Пока у пользователя есть пример или ошибки, он точно не прошел капчу
+            if user_id in CaptchaManager._challenges or user_id in CaptchaManager._failures:
+                return False
+        
         result = Database.execute_query(
             "SELECT is_verified FROM captcha_attempts WHERE user_id = %s",
             (user_id,), "one"
         )
-        return bool(result and result['is_verified'])
+        verified = bool(result and result['is_verified'])
+        if verified:
+            CaptchaManager._remember_verified(user_id)
+        return verified
     
     @staticmethod
-    def increment_attempts(user_id: int) -> int:
-        # Получаем текущие попытки
-        current = Database.execute_query(
-            "SELECT attempts FROM captcha_attempts WHERE user_id = %s",
-            (user_id,), "one"
-        )
-        
-        if current:
-            new_attempts = current['attempts'] + 1
-            Database.execute_query(
-                "UPDATE captcha_attempts SET attempts = %s, last_attempt = CURRENT_TIMESTAMP WHERE user_id = %s",
-                (new_attempts, user_id)
-            )
-        else:
-            new_attempts = 1
-            Database.execute_query(
-                "INSERT INTO captcha_attempts (user_id, attempts) VALUES (%s, %s)",
-                (user_id, new_attempts)
-            )
-        
-        return new_attempts
+    def _remember_verified(user_id: int):
+        with CaptchaManager._lock:
+            CaptchaManager._verified[user_id] = True
+            CaptchaManager._verified.move_to_end(user_id)
+            while len(CaptchaManager._verified) > CAPTCHA_MAX_PENDING:
+                CaptchaManager._verified.popitem(last=False)
     
     @staticmethod
     def verify_user(user_id: int):
         Database.execute_query(
-            "INSERT INTO captcha_attempts (user_id, is_verified) VALUES (%s, TRUE) ON CONFLICT (user_id) DO UPDATE SET is_verified = TRUE",
+            """INSERT INTO captcha_attempts (user_id, attempts, is_verified) VALUES (%s, 0, TRUE)
+               ON CONFLICT (user_id) DO UPDATE SET is_verified = TRUE, last_attempt = CURRENT_TIMESTAMP""",
             (user_id,)
         )
+        CaptchaManager._remember_verified(user_id)
+        CaptchaManager.stats["passed"] += 1
+    
+    @staticmethod
+    def get_stats() -> dict:
+        now = time.monotonic()
+        with CaptchaManager._lock:
+            locked = sum(
+                1 for user_id in list(CaptchaManager._failures)
+                if CaptchaManager._recent_failures(user_id, now) >= CAPTCHA_MAX_ATTEMPTS
+            )
+            return {**CaptchaManager.stats, "pending": len(CaptchaManager._challenges), "locked_now": locked}
+
+class City(NamedTuple):
+    id: int
+    name_uk: str
+    name_ru: str
+    name_en: str
+    lat: float
+    lon: float
+
+# Транслитерация для сопоставления латиницы с кириллическими названиями
+TRANSLIT_UK = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie', 'ж': 'zh',
+    'з': 'z', 'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n',
+    'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ь': '', 'ю': 'iu', 'я': 'ia',
+}
+TRANSLIT_RU = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's',
+    'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+
+def normalize_city_name(name: str) -> str:
+    """Нижний регистр, без апострофов, дефисов, лишних пробелов и префиксов "г.", "м." """
+    name = name.strip().lower().replace('ё', 'е')
+    name = re.sub(r"^(г\.|м\.|город|місто|city)\s*", "", name)
+    name = re.sub(r"[’'ʼ`´]", "", name)
+    name = re.sub(r"[-‐–—_.,]+", " ", name)
+    return re.sub(r"\s+", " ", name).strip()
+
+def transliterate(name: str, table: Dict[str, str]) -> str:
+    return "".join(table.get(ch, ch) for ch in name)
+
+class CityGazetteer:
+    """Офлайн-справочник населенных пунктов Украины.
+
+    Точный поиск - по хэш-таблице нормализованных названий (укр./рус./латиница,
+    старые названия, транслитерация), поиск по префиксу и с опечатками - по префиксному дереву.
+    """
+    
+    _default: Optional['CityGazetteer'] = None
+    _default_lock = threading.Lock()
+    
+    def __init__(self):
+        # Данные города с порядковым номером i лежат в i-х элементах массивов
+        self._ids = array('i')
+        self._lats = array('d')
+        self._lons = array('d')
+        self._names: List[Tuple[str, str, str]] = []
+        self._positions: Dict[int, int] = {}
+        self._index: Dict[str, int] = {}
+        self._trie: dict = {}
+    
+    @classmethod
+    def default(cls) -> 'CityGazetteer':
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls.load(CITIES_FILE)
+        return cls._default
+    
+    @classmethod
+    def load(cls, path: str) -> 'CityGazetteer':
+        gazetteer = cls()
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    aliases = [a for a in (row.get('aliases') or '').split('|') if a]
+                    gazetteer.add(
+                        int(row['id']), row['name_uk'], row['name_ru'], row['name_en'],
+                        float(row['lat']), float(row['lon']), aliases
+                    )
+        except FileNotFoundError:
+            logger.error(f"Справочник городов не найден: {path}")
+        logger.info(f"Загружено городов: {len(gazetteer)}")
+        return gazetteer
+    
+    def __len__(self) -> int:
+        return len(self._names)
+    
+    def add(self, city_id: int, name_uk: str, name_ru: str, name_en: str,
+            lat: float, lon: float, aliases: List[str] = ()):
+        position = len(self._names)
+        self._ids.append(city_id)
+        self._lats.append(lat)
+        self._lons.append(lon)
+        self._names.append((name_uk, name_ru, name_en))
+        self._positions[city_id] = position
+        
+        keys = {normalize_city_name(n) for n in (name_uk, name_ru, name_en, *aliases)}
+        keys.add(transliterate(normalize_city_name(name_uk), TRANSLIT_UK))
+        keys.add(transliterate(normalize_city_name(name_ru), TRANSLIT_RU))
+        for key in keys:
+            if not key:
+                continue
+            self._index.setdefault(key, position)
+            node = self._trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, position)
+    
+    def _city(self, position: int) -> City:
+        return City(self._ids[position], *self._names[position], self._lats[position], self._lons[position])
+    
+    def get(self, city_id: int) -> Optional[City]:
+        position = self._positions.get(city_id)
+        return self._city(position) if position is not None else None
+    
+    def resolve(self, name: str) -> Optional[City]:
+        """Город по названию: точное совпадение, иначе единственный близкий вариант с опечаткой"""
+        key = normalize_city_name(name)
+        if not key:
+            return None
+        
+        position = self._index.get(key)
+        if position is not None:
+            return self._city(position)
+        
+        max_distance = 1 if len(key) <= 5 else 2
+        matches = self._fuzzy(key, max_distance)
+        if not matches:
+            return None
+        best = min(matches.values())
+        best_positions = [p for p, d in matches.items() if d == best]
+        if len(best_positions) != 1:
+            return None
+        return self._city(best_positions[0])
+    
+    def suggest(self, prefix: str, limit: int = 5) -> List[City]:
+        """Города, одно из названий которых начинается с prefix"""
+        node = self._trie
+        for ch in normalize_city_name(prefix):
+            node = node.get(ch)
+            if node is None:
+                return []
+        
+        found = []
+        stack = [node]
+        while stack and len(found) < limit:
+            current = stack.pop()
+            position = current.get(None)
+            if position is not None and position not in found:
+                found.append(position)
+            stack.extend(child for ch, child in current.items() if ch is not None)
+        return [self._city(p) for p in found]
+    
+    def _fuzzy(self, word: str, max_distance: int) -> Dict[int, int]:
+        """Позиции городов с расстоянием Левенштейна не больше max_distance (обход дерева)"""
+        results: Dict[int, int] = {}
+        
+        def walk(node: dict, ch: str, prev_row: List[int]):
+            row = [prev_row[0] + 1]
+            for i in range(1, len(word) + 1):
+                row.append(min(row[i - 1] + 1, prev_row[i] + 1, prev_row[i - 1] + (word[i - 1] != ch)))
+            
+            position = node.get(None)
+            if position is not None and row[-1] <= max_distance:
+                results[position] = min(row[-1], results.get(position, row[-1]))
+            
+            if min(row) <= max_distance:
+                for next_ch, child in node.items():
+                    if next_ch is not None:
+                        walk(child, next_ch, row)
+        
+        first_row = list(range(len(word) + 1))
+        for ch, child in self._trie.items():
+            if ch is not None:
+                walk(child, ch, first_row)
+        return results
+
+def resolve_city_fields(prefix: str, city: str) -> dict:
+    """Поля анкеты <prefix>_city, _city_id, _lat, _lon для введенного названия города"""
+    info = CityGazetteer.default().resolve(city)
+    return {
+        f'{prefix}_city': city,
+        f'{prefix}_city_id': info.id if info else None,
+        f'{prefix}_lat': info.lat if info else None,
+        f'{prefix}_lon': info.lon if info else None,
+    }
 
 # Утилиты
+def geo_bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """Прямоугольник (min_lat, max_lat, min_lon, max_lon), гарантированно содержащий круг радиуса radius_km"""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+def geo_radius_filter(lat: float, lon: float, radius_km: float, alias: str = "u") -> Tuple[str, list]:
+    """SQL-условие "в радиусе radius_km от точки".
+
+    Сначала диапазоны по current_lat/current_lon (используют btree idx_users_location),
+    затем точная формула гаверсинусов только для строк внутри прямоугольника.
+    """
+    min_lat, max_lat, min_lon, max_lon = geo_bounding_box(lat, lon, radius_km)
+    sql = f"""
+        {alias}.current_lat BETWEEN %s AND %s
+        AND {alias}.current_lon BETWEEN %s AND %s
+        AND 2 * {EARTH_RADIUS_KM} * asin(LEAST(1.0, sqrt(
+            power(sin(radians({alias}.current_lat - %s) / 2), 2) +
+            cos(radians(%s)) * cos(radians({alias}.current_lat)) *
+            power(sin(radians({alias}.current_lon - %s) / 2), 2)
+        ))) <= %s
+    """
+    return sql, [min_lat, max_lat, min_lon, max_lon, lat, lat, lon, radius_km]
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
@@ -1440,4 +3346,1909 @@ def create_main_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def create_browse_keyboard(target_id: int):
\ No newline at end of file
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных пользователей.
+
+    Апдейты одного пользователя выполняются строго по очереди, поэтому
+    ConversationHandler регистрации продолжает видеть их последовательно.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+            return
+
+        release_at = 0.0
+        if FLOOD_ENABLED:
+            delay = FloodGuard.admit(update)
+            if delay is None:
+                coroutine.close()
+                await FloodGuard.reject(update)
+                return
+            if delay:
+                release_at = time.monotonic() + delay
+        
+        key = user.id
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                # Задержка флуд-контроля - уже в очереди пользователя: более поздний
+                # апдейт без задержки не должен обогнать этот
+                if release_at:
+                    await asyncio.sleep(max(0.0, release_at - time.monotonic()))
+                await coroutine
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    @property
+    def pending(self) -> int:
+        """Апдейтов в обработке или в ожидании своей очереди пользователя"""
+        return sum(self._waiters.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+    
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+class FloodState:
+    __slots__ = ("buckets", "noticed_at")
+    
+    def __init__(self):
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.noticed_at = 0.0
+
+class FloodGuard:
+    """Защита от флуда до запуска обработчиков.
+    
+    Вызывается из PerUserUpdateProcessor до обработки апдейта (и до любых запросов
+    к БД, включая загрузку user_data): у каждого пользователя свое ведро токенов на
+    класс действий. Небольшое превышение задерживается (до FLOOD_MAX_DELAY секунд),
+    остальное отбрасывается. Состояние храним не более чем для FLOOD_MAX_USERS
+    пользователей (LRU): давно неактивный пользователь все равно имел бы полное ведро,
+    поэтому вытеснение его ничего не меняет.
+    """
+    
+    _users: "OrderedDict[int, FloodState]" = OrderedDict()
+    stats = {"passed": 0, "delayed": 0, "dropped": 0}
+    dropped_by_action: Counter = Counter()
+    # Команды со своим классом; остальные команды - "default"
+    COMMANDS = {"browse": "browse"}
+    
+    @staticmethod
+    def classify(update: Update) -> str:
+        """Класс действия апдейта для выбора лимита"""
+        query = update.callback_query
+        if query is not None:
+            data = query.data or ""
+            if data == "browse" or data.startswith("skip_"):
+                return "browse"
+            if data.startswith("like_"):
+                return "like"
+            if data.startswith("complain"):
+                return "complaint"
+            return "default"
+        if update.message is not None:
+            text = update.message.text or ""
+            if text.startswith("/"):
+                command = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+                return FloodGuard.COMMANDS.get(command, "default")
+            # Остальные сообщения - это ответы в диалогах регистрации и редактирования анкеты
+            return "registration"
+        return "default"
+    
+    @staticmethod
+    def admit(update: Update) -> Optional[float]:
+        """Через сколько секунд можно обработать апдейт; None - отбросить"""
+        user = update.effective_user
+        if user is None or user.id in ADMIN_IDS:
+            return 0.0
+        action = FloodGuard.classify(update)
+        
+        users = FloodGuard._users
+        state = users.get(user.id)
+        if state is None:
+            state = users[user.id] = FloodState()
+            while len(users) > FLOOD_MAX_USERS:
+                users.popitem(last=False)
+        users.move_to_end(user.id)
+        
+        bucket = state.buckets.get(action)
+        if bucket is None:
+            rate, burst = FLOOD_LIMITS.get(action, FLOOD_LIMITS["default"])
+            bucket = state.buckets[action] = TokenBucket(rate, burst)
+        
+        delay = bucket.delay()
+        if delay > FLOOD_MAX_DELAY:
+            FloodGuard.stats["dropped"] += 1
+            FloodGuard.dropped_by_action[action] += 1
+            return None
+        # Токен берем сразу, даже в долг: следующие апдейты будут ждать дольше
+        bucket.take()
+        FloodGuard.stats["delayed" if delay > 0 else "passed"] += 1
+        return delay
+    
+    @staticmethod
+    async def reject(update: Update):
+        """Отвечает на отброшенную кнопку, чтобы у пользователя не висели часики.
+        Предупреждение с текстом - не чаще раза в FLOOD_NOTICE_INTERVAL секунд"""
+        query = update.callback_query
+        if query is None:
+            return
+        state = FloodGuard._users.get(update.effective_user.id)
+        now = time.monotonic()
+        text = None
+        if state is not None and now - state.noticed_at >= FLOOD_NOTICE_INTERVAL:
+            state.noticed_at = now
+            text = "⏳ Слишком часто, подождите немного"
+        try:
+            await query.answer(text)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить на отброшенную кнопку: {e}")
+    
+    @staticmethod
+    def get_stats() -> dict:
+        return {
+            **FloodGuard.stats,
+            "users": len(FloodGuard._users),
+            "dropped_by_action": dict(FloodGuard.dropped_by_action),
+        }
+
+class OutboundMessage:
+    """Сообщение в очереди: один или несколько вызовов Bot API в один чат, по порядку.
+    fallback - вызовы вместо всего сообщения, если Telegram отклонил первый же запрос (например, фото)."""
+    
+    __slots__ = ("chat_id", "calls", "fallback", "priority", "enqueued_at", "step", "attempts")
+    
+    def __init__(self, chat_id: int, calls: List[Tuple[str, dict]], priority: int,
+                 fallback: Optional[List[Tuple[str, dict]]] = None):
+        self.chat_id = chat_id
+        self.calls = calls
+        self.fallback = fallback
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.step = 0
+        self.attempts = 0
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с ограничением скорости.
+    
+    Обработчики ставят сообщения в очередь и сразу возвращаются. Сообщения одного чата
+    уходят строго по порядку, разные чаты - параллельно (не больше SEND_CONCURRENCY),
+    с общим лимитом SEND_GLOBAL_RATE и лимитом SEND_CHAT_RATE на чат. Среди готовых
+    к отправке чатов первым идет тот, у кого выше приоритет сообщения.
+    RetryAfter откладывает чат на указанное Telegram время. Сетевые ошибки до
+    отправки запроса (нет соединения, пул занят) повторяются с экспоненциальной
+    задержкой; после таймаута ответа сообщение могло уже дойти, поэтому отправка
+    не повторяется, иначе пользователь получит его дважды.
+    """
+    
+    PRIORITY_REPLY = 0  # ответ пользователю на его действие
+    PRIORITY_MATCH = 1  # уведомление о взаимной симпатии
+    PRIORITY_ADMIN = 2  # уведомления администраторам
+    
+    _bot: Optional[Bot] = None
+    _chats: Dict[int, deque] = {}  # chat_id -> очередь сообщений
+    _ready: list = []  # куча (приоритет, seq, chat_id) - чаты, которые можно отправлять
+    _delayed: list = []  # куча (когда, seq, chat_id) - чаты, ждущие лимита или повтора
+    _chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+    _global_bucket: Optional[TokenBucket] = None
+    _seq = 0
+    _pending = 0
+    _wakeup: Optional[asyncio.Event] = None
+    _semaphore: Optional[asyncio.Semaphore] = None
+    _task: Optional[asyncio.Task] = None
+    _inflight: set = set()
+    _latencies: deque = deque(maxlen=1000)
+    stats = {"sent": 0, "failed": 0, "retries": 0, "flood_waits": 0, "uncertain": 0}
+    
+    @staticmethod
+    def send(bot: Bot, chat_id: int, calls: List[Tuple[str, dict]],
+             priority: int = PRIORITY_REPLY, fallback: Optional[List[Tuple[str, dict]]] = None):
+        """Ставит сообщение в очередь. calls - [(метод Bot, аргументы)], chat_id подставляется сам"""
+        OutboundQueue._start(bot)
+        queue = OutboundQueue._chats.get(chat_id)
+        if queue is None:
+            queue = OutboundQueue._chats[chat_id] = deque()
+            OutboundQueue._schedule(chat_id, priority, OutboundQueue._chat_bucket(chat_id).delay())
+        queue.append(OutboundMessage(chat_id, calls, priority, fallback))
+        OutboundQueue._pending += 1
+    
+    @staticmethod
+    def send_message(bot: Bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs):
+        OutboundQueue.send(bot, chat_id, [("send_message", {"text": text, **kwargs})], priority)
+    
+    @staticmethod
+    def _start(bot: Bot):
+        if OutboundQueue._task is not None and not OutboundQueue._task.done():
+            return
+        OutboundQueue._bot = bot
+        # Лимит Telegram общий на бота - делим его между воркерами
+        OutboundQueue._global_bucket = TokenBucket(
+            SEND_GLOBAL_RATE / max(1, BOT_WORKERS), max(1.0, SEND_GLOBAL_RATE / max(1, BOT_WORKERS))
+        )
+        OutboundQueue._wakeup = asyncio.Event()
+        OutboundQueue._semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        OutboundQueue._task = asyncio.get_running_loop().create_task(OutboundQueue._run())
+    
+    @staticmethod
+    def _schedule(chat_id: int, priority: int, delay: float):
+        OutboundQueue._seq += 1
+        if delay > 0:
+            heapq.heappush(OutboundQueue._delayed, (time.monotonic() + delay, OutboundQueue._seq, chat_id))
+        else:
+            heapq.heappush(OutboundQueue._ready, (priority, OutboundQueue._seq, chat_id))
+        if OutboundQueue._wakeup is not None:
+            OutboundQueue._wakeup.set()
+    
+    @staticmethod
+    def _chat_bucket(chat_id: int) -> TokenBucket:
+        buckets = OutboundQueue._chat_buckets
+        bucket = buckets.get(chat_id)
+        if bucket is None:
+            bucket = buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            # Давно молчавшие чаты снова получили бы полное ведро - их можно забыть
+            while len(buckets) > 10000:
+                buckets.popitem(last=False)
+        buckets.move_to_end(chat_id)
+        return bucket
+    
+    @staticmethod
+    async def _run():
+        while True:
+            now = time.monotonic()
+            while OutboundQueue._delayed and OutboundQueue._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(OutboundQueue._delayed)
+                queue = OutboundQueue._chats.get(chat_id)
+                if queue:
+                    OutboundQueue._seq += 1
+                    heapq.heappush(OutboundQueue._ready, (queue[0].priority, OutboundQueue._seq, chat_id))
+            
+            if not OutboundQueue._ready:
+                timeout = OutboundQueue._delayed[0][0] - now if OutboundQueue._delayed else None
+                OutboundQueue._wakeup.clear()
+                try:
+                    await asyncio.wait_for(OutboundQueue._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            # Общий токен берем здесь, а не в задаче отправки: иначе задачи с низким
+            # приоритетом, уже ждущие токен, обгоняли бы более важные сообщения
+            delay = OutboundQueue._global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            await OutboundQueue._semaphore.acquire()
+            _, _, chat_id = heapq.heappop(OutboundQueue._ready)
+            OutboundQueue._global_bucket.take()
+            task = asyncio.get_running_loop().create_task(OutboundQueue._deliver(chat_id))
+            OutboundQueue._inflight.add(task)
+            task.add_done_callback(OutboundQueue._inflight.discard)
+    
+    @staticmethod
+    async def _acquire(chat_id: int, global_paid: bool):
+        """Ждет токены чатового и, если еще не взят планировщиком, общего ведра"""
+        chat_bucket = OutboundQueue._chat_bucket(chat_id)
+        while True:
+            delay = chat_bucket.delay()
+            if not global_paid:
+                delay = max(delay, OutboundQueue._global_bucket.delay())
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if not global_paid:
+            OutboundQueue._global_bucket.take()
+        chat_bucket.take()
+    
+    @staticmethod
+    async def _deliver(chat_id: int):
+        queue = OutboundQueue._chats[chat_id]
+        message = queue[0]
+        retry_delay = 0.0
+        try:
+            retry_delay = await OutboundQueue._send(message)
+        except Exception as e:
+            logger.error(f"Ошибка отправки в чат {chat_id}: {e}")
+            OutboundQueue.stats["failed"] += 1
+            retry_delay = None
+        finally:
+            OutboundQueue._semaphore.release()
+        
+        if not retry_delay:
+            queue.popleft()
+            OutboundQueue._pending -= 1
+            if retry_delay is not None:
+                OutboundQueue._latencies.append(time.monotonic() - message.enqueued_at)
+        
+        if queue:
+            delay = max(retry_delay or 0.0, OutboundQueue._chat_bucket(chat_id).delay())
+            OutboundQueue._schedule(chat_id, queue[0].priority, delay)
+        else:
+            del OutboundQueue._chats[chat_id]
+            OutboundQueue._wakeup.set()
+    
+    @staticmethod
+    async def _send(message: OutboundMessage) -> Optional[float]:
+        """Выполняет вызовы сообщения. 0 - отправлено, None - отброшено,
+        иначе через сколько секунд повторить с того же места"""
+        bot = OutboundQueue._bot
+        global_paid = True  # первый вызов оплачен планировщиком
+        while message.step < len(message.calls):
+            method, kwargs = message.calls[message.step]
+            await OutboundQueue._acquire(message.chat_id, global_paid)
+            global_paid = False
+            try:
+                await getattr(bot, method)(chat_id=message.chat_id, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                OutboundQueue.stats["flood_waits"] += 1
+                return float(retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after)
+            except Forbidden as e:
+                # Бот заблокирован - запасной вариант тоже не дойдет
+                logger.warning(f"Сообщение в чат {message.chat_id} не доставлено: {e}")
+                OutboundQueue.stats["failed"] += 1
+                return None
+            except BadRequest as e:
+                # Запасной вариант заменяет все сообщение, поэтому подходит, только пока
+                # ничего не отправлено - иначе пользователь получил бы содержимое дважды
+                if message.fallback and message.step == 0:
+                    logger.warning(f"Telegram отклонил {method} в чат {message.chat_id}: {e}, отправляем запасной вариант")
+                    message.calls, message.fallback, message.step = message.fallback, None, 0
+                    continue
+                logger.warning(f"Сообщение в чат {message.chat_id} не доставлено: {e}")
+                OutboundQueue.stats["failed"] += 1
+                return None
+            except NetworkError as e:
+                if not OutboundQueue._not_sent(e):
+                    # Запрос ушел, но ответа нет: считаем доставленным и идем дальше
+                    logger.warning(f"Нет ответа на {method} в чат {message.chat_id}, повторять не будем: {e}")
+                    OutboundQueue.stats["uncertain"] += 1
+                    message.step += 1
+                    continue
+                message.attempts += 1
+                if message.attempts > SEND_MAX_RETRIES:
+                    logger.error(f"Сообщение в чат {message.chat_id} не доставлено после {SEND_MAX_RETRIES} повторов: {e}")
+                    OutboundQueue.stats["failed"] += 1
+                    return None
+                OutboundQueue.stats["retries"] += 1
+                return min(30.0, 0.5 * 2 ** message.attempts)
+            message.step += 1
+        
+        OutboundQueue.stats["sent"] += 1
+        return 0.0
+    
+    @staticmethod
+    def _not_sent(error: NetworkError) -> bool:
+        """Ошибка случилась до отправки запроса в Telegram - повтор не создаст дубликат"""
+        return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+    
+    @staticmethod
+    async def drain(timeout: float = SEND_DRAIN_TIMEOUT):
+        """Досылает очередь при остановке, но не дольше timeout"""
+        if OutboundQueue._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while OutboundQueue._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if OutboundQueue._pending:
+            logger.warning(f"Не отправлено при остановке: {OutboundQueue._pending} сообщений")
+        OutboundQueue._task.cancel()
+        for task in list(OutboundQueue._inflight):
+            task.cancel()
+        OutboundQueue._task = None
+    
+    @staticmethod
+    def get_stats() -> dict:
+        latencies = sorted(OutboundQueue._latencies)
+        by_priority = Counter(queue[0].priority for queue in OutboundQueue._chats.values() if queue)
+        return {
+            **OutboundQueue.stats,
+            "pending": OutboundQueue._pending,
+            "chats": len(OutboundQueue._chats),
+            "chats_by_priority": dict(by_priority),
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+        }
+
+class AdminNotifier:
+    """Уведомления администраторов о жалобах.
+    
+    Пока жалоб мало, каждая уходит отдельным сообщением с кнопками. Если за
+    ADMIN_DIGEST_WINDOW секунд набралось больше ADMIN_DIGEST_THRESHOLD жалоб,
+    следующие копятся и раз в окно уходят каждому админу одной сводкой,
+    сгруппированной по анкетам. Отправка идет через OutboundQueue.
+    """
+    
+    MAX_DIGEST_TARGETS = 30  # анкет в одной сводке, остальное - строкой "и еще"
+    MAX_BAN_BUTTONS = 5
+    
+    _bot: Optional[Bot] = None
+    _recent: deque = deque()  # время последних жалоб
+    _pending: List[dict] = []  # жалобы, ждущие сводки
+    _task: Optional[asyncio.Task] = None
+    stats = {"single": 0, "digests": 0, "batched": 0}
+    
+    @staticmethod
+    def notify(bot: Bot, complaint: dict):
+        """complaint - {target_id, target, complainer_id, complainer, reason, was_banned}"""
+        AdminNotifier._bot = bot
+        now = time.monotonic()
+        recent = AdminNotifier._recent
+        while recent and recent[0] < now - ADMIN_DIGEST_WINDOW:
+            recent.popleft()
+        recent.append(now)
+        
+        if not AdminNotifier._pending and len(recent) <= ADMIN_DIGEST_THRESHOLD:
+            AdminNotifier._send_single(bot, complaint)
+            return
+        
+        AdminNotifier._pending.append(complaint)
+        if AdminNotifier._task is None or AdminNotifier._task.done():
+            AdminNotifier._task = asyncio.get_running_loop().create_task(AdminNotifier._flush_later())
+    
+    @staticmethod
+    def _user_line(user: Optional[dict], user_id: int) -> str:
+        if not user:
+            return f"ID: {user_id}"
+        return f"{user['name']} (@{user['username']}, ID: {user_id})"
+    
+    @staticmethod
+    def _send_single(bot: Bot, complaint: dict):
+        target_id = complaint["target_id"]
+        admin_message = f"🚨 ЖАЛОБА\n\n"
+        admin_message += f"От: {AdminNotifier._user_line(complaint['complainer'], complaint['complainer_id'])}\n"
+        admin_message += f"На: {AdminNotifier._user_line(complaint['target'], target_id)}\n"
+        admin_message += f"Причина: {complaint['reason']}\n"
+        if complaint["was_banned"]:
+            admin_message += f"⚠️ ПОЛЬЗОВАТЕЛЬ АВТОМАТИЧЕСКИ ЗАБЛОКИРОВАН (много жалоб)"
+        
+        keyboard = [
+            [InlineKeyboardButton("Связаться", url=f"tg://user?id={target_id}")],
+            [InlineKeyboardButton("Заблокировать", callback_data=f"admin_ban_{target_id}")]
+        ]
+        
+        for admin_id in ADMIN_IDS:
+            OutboundQueue.send_message(
+                bot, admin_id, admin_message,
+                priority=OutboundQueue.PRIORITY_ADMIN,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        AdminNotifier.stats["single"] += 1
+    
+    @staticmethod
+    async def _flush_later():
+        await asyncio.sleep(ADMIN_DIGEST_WINDOW)
+        AdminNotifier._flush()
+    
+    @staticmethod
+    def _flush():
+        complaints, AdminNotifier._pending = AdminNotifier._pending, []
+        if not complaints:
+            return
+        
+        # Группируем по анкете: на одну и ту же анкету при всплеске жалуются пачкой
+        by_target: Dict[int, dict] = {}
+        for complaint in complaints:
+            entry = by_target.setdefault(complaint["target_id"], {
+                "target": complaint["target"], "reasons": Counter(), "was_banned": False
+            })
+            entry["reasons"][complaint["reason"]] += 1
+            entry["was_banned"] = entry["was_banned"] or complaint["was_banned"]
+        targets = sorted(by_target.items(), key=lambda item: -sum(item[1]["reasons"].values()))
+        
+        text = f"🚨 СВОДКА ЖАЛОБ: {len(complaints)} на {len(targets)} анкет\n"
+        for target_id, entry in targets[:AdminNotifier.MAX_DIGEST_TARGETS]:
+            reasons = ", ".join(f"{reason} ×{count}" for reason, count in entry["reasons"].most_common())
+            text += f"\n• {AdminNotifier._user_line(entry['target'], target_id)}: {reasons}"
+            if entry["was_banned"]:
+                text += " ⚠️ заблокирован автоматически"
+        if len(targets) > AdminNotifier.MAX_DIGEST_TARGETS:
+            text += f"\n\n...и еще {len(targets) - AdminNotifier.MAX_DIGEST_TARGETS} анкет"
+        
+        keyboard = [
+            [InlineKeyboardButton(
+                f"Заблокировать {entry['target']['name'] if entry['target'] else target_id}",
+                callback_data=f"admin_ban_{target_id}"
+            )]
+            for target_id, entry in targets if not entry["was_banned"]
+        ][:AdminNotifier.MAX_BAN_BUTTONS]
+        
+        for admin_id in ADMIN_IDS:
+            OutboundQueue.send_message(
+                AdminNotifier._bot, admin_id, text,
+                priority=OutboundQueue.PRIORITY_ADMIN,
+                reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+            )
+        AdminNotifier.stats["digests"] += 1
+        AdminNotifier.stats["batched"] += len(complaints)
+    
+    @staticmethod
+    async def drain():
+        """При остановке отправляет накопленную сводку, не дожидаясь конца окна"""
+        if AdminNotifier._task is not None:
+            AdminNotifier._task.cancel()
+            AdminNotifier._task = None
+        AdminNotifier._flush()
+
+class WebhookServer:
+    """Минимальный HTTP/1.1 сервер на asyncio для приема обновлений от Telegram.
+    
+    Обновление только кладется в update_queue (ограниченная очередь) - приложения
+    или диспетчера воркеров. Если очередь заполнена, отвечаем 503 - Telegram
+    повторит доставку позже.
+    """
+    
+    MAX_BODY_SIZE = 1024 * 1024
+    
+    def __init__(self, bot: Bot, update_queue: asyncio.Queue, host: str, port: int, path: str,
+                 secret_token: Optional[str] = None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers = set()
+        self._closing = False
+        self.stats = {"accepted": 0, "rejected": 0, "bad_requests": 0}
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Webhook сервер слушает {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        """Перестает принимать обновления; принятые остаются в очереди приложения"""
+        self._closing = True
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+    
+    def _accept(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> int:
+        """Разбирает запрос и ставит обновление в очередь, возвращает HTTP статус"""
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token and not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", ""), self.secret_token
+        ):
+            return 403
+        
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            return 400
+        if update is None:
+            return 400
+        
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return 503
+        self.stats["accepted"] += 1
+        return 200
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while not self._closing:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                
+                request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                
+                try:
+                    method, target, version = request_line.split(" ")
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    self.stats["bad_requests"] += 1
+                    await self._respond(writer, 400, keep_alive=False)
+                    break
+                if length > self.MAX_BODY_SIZE:
+                    self.stats["bad_requests"] += 1
+                    await self._respond(writer, 413, keep_alive=False)
+                    break
+                
+                try:
+                    body = await reader.readexactly(length) if length else b""
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                
+                status = self._accept(method, target, headers, body)
+                if status in (400, 403, 404, 405):
+                    self.stats["bad_requests"] += 1
+                keep_alive = (
+                    not self._closing and version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except Exception as e:
+            logger.error(f"Ошибка webhook соединения: {e}")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+    
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+        reasons = {
+            200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable",
+        }
+        head = [f"HTTP/1.1 {status} {reasons[status]}", "Content-Length: 0"]
+        if status == 503:
+            head.append("Retry-After: 1")
+        head.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+def stop_on_signals() -> asyncio.Event:
+    """Событие, которое выставляется по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def set_webhook(bot: Bot):
+    if WEBHOOK_URL:
+        # Необработанные обновления не сбрасываем: Telegram доставит их после перезапуска
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+async def run_webhook(application: Application):
+    """Режим webhook: HTTP сервер принимает обновления, при SIGINT/SIGTERM
+    прием прекращается и уже принятые обновления дообрабатываются"""
+    server = WebhookServer(
+        application.bot, application.update_queue,
+        WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+    )
+    application.bot_data["webhook_server"] = server
+    stop_event = stop_on_signals()
+    
+    async with application:
+        await application.start()
+        await start_metrics(application)
+        await server.start()
+        await set_webhook(application.bot)
+        
+        await stop_event.wait()
+        logger.info("Остановка webhook: дообрабатываем очередь")
+        await server.stop()
+        await application.stop()
+        await drain_outbound(application)
+
+class PostgresPersistence(BasePersistence):
+    """user_data и состояния ConversationHandler в Postgres, общие для всех воркеров.
+    
+    user_data загружается лениво, при первом обращении пользователя (refresh_user_data),
+    а не целиком при старте. Состояния диалогов хранятся только для незавершенных
+    регистраций, поэтому грузятся при старте, кроме брошенных дольше
+    PERSISTENCE_CONVERSATION_TTL дней. Изменения за цикл сохранения PTB
+    (PERSISTENCE_UPDATE_INTERVAL) копятся и пишутся пакетом - по запросу на таблицу.
+    
+    Воркер работает только со своими пользователями: user_id % workers == worker_index.
+    bot_data, chat_data и callback_data боту не нужны и не сохраняются.
+    Пустой user_data и состояние капчи (TRANSIENT_STATES) в БД не пишутся, пока
+    у пользователя нет сохраненной строки - поток ботов на /start не дает записей.
+    """
+    
+    TRANSIENT_STATES = (CAPTCHA,)  # пример капчи хранится в памяти, сохранять состояние нет смысла
+    
+    def __init__(self, worker_index: int = 0, workers: int = 1,
+                 update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.worker_index = worker_index
+        self.workers = workers
+        self._loaded_users: set = set()
+        # Что есть (или будет после записи накопленного) в БД - только их стоит перезаписывать или удалять
+        self._stored_users: set = set()
+        self._stored_conversations: set = set()
+        self._dirty_users: Dict[int, dict] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Tuple[int, Optional[object]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats = {"loads": 0, "flushes": 0, "rows": 0, "errors": 0}
+    
+    def _shard(self, column: str) -> Tuple[str, tuple]:
+        if self.workers <= 1:
+            return "", ()
+        return f" AND {column} %% %s = %s", (self.workers, self.worker_index)
+    
+    async def get_user_data(self) -> Dict[int, dict]:
+        # Загружается по одному пользователю в refresh_user_data
+        return {}
+    
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._loaded_users:
+            return
+        rows = await Database.execute_query_async(
+            "SELECT data FROM bot_user_data WHERE user_id = %s", (user_id,), "all"
+        )
+        if rows is None:
+            # Не загрузили - не сохраняем, иначе затрем данные в БД пустыми
+            return
+        self._loaded_users.add(user_id)
+        self.stats["loads"] += 1
+        if rows:
+            self._stored_users.add(user_id)
+            for key, value in rows[0]['data'].items():
+                user_data.setdefault(key, value)
+    
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+    
+    async def get_bot_data(self) -> dict:
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name: str) -> dict:
+        shard_sql, shard_params = self._shard("user_id")
+        rows = await Database.execute_query_async(
+            """SELECT key, state FROM bot_conversations
+               WHERE name = %s AND updated_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 day'""" + shard_sql,
+            (name, PERSISTENCE_CONVERSATION_TTL, *shard_params), "all"
+        )
+        if rows is None:
+            raise RuntimeError(f"Не удалось загрузить диалоги {name}")
+        self._stored_conversations.update((name, row['key']) for row in rows)
+        return {tuple(json.loads(row['key'])): row['state'] for row in rows}
+    
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        # Ключ диалога - (chat_id, user_id), для личных чатов совпадают
+        conversation = (name, json.dumps(key))
+        if new_state in self.TRANSIENT_STATES:
+            new_state = None
+        if new_state is None:
+            if conversation not in self._stored_conversations:
+                self._dirty_conversations.pop(conversation, None)
+                return
+            self._stored_conversations.discard(conversation)
+        else:
+            self._stored_conversations.add(conversation)
+        self._dirty_conversations[conversation] = (key[-1], new_state)
+        self._schedule_flush()
+    
+    async def update_user_data(self, user_id: int, data: dict):
+        if user_id not in self._loaded_users:
+            return
+        if not data and user_id not in self._stored_users:
+            return
+        self._stored_users.add(user_id)
+        self._dirty_users[user_id] = data
+        self._schedule_flush()
+    
+    async def drop_user_data(self, user_id: int):
+        self._dirty_users.pop(user_id, None)
+        self._loaded_users.discard(user_id)
+        self._stored_users.discard(user_id)
+        await Database.execute_query_async("DELETE FROM bot_user_data WHERE user_id = %s", (user_id,))
+    
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+    
+    async def update_bot_data(self, data: dict):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id: int):
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+    
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+    
+    def _schedule_flush(self):
+        # PTB вызывает update_* для всех измененных ключей разом; запись уходит
+        # следующей итерацией цикла событий, когда весь цикл сохранения уже накоплен
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_dirty())
+    
+    async def _flush_dirty(self):
+        await asyncio.sleep(0)
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not conversations:
+            return
+        
+        user_rows = [(user_id, json.dumps(data)) for user_id, data in users.items()]
+        upserts = [
+            (name, key, user_id, json.dumps(state))
+            for (name, key), (user_id, state) in conversations.items() if state is not None
+        ]
+        deletes = [(name, key) for (name, key), (_, state) in conversations.items() if state is None]
+        
+        written = await Database.run(PostgresPersistence._write, user_rows, upserts, deletes)
+        if not written:
+            # Вернем несохраненное, не затирая более свежие изменения
+            self.stats["errors"] += 1
+            for user_id, data in users.items():
+                self._dirty_users.setdefault(user_id, data)
+            for key, value in conversations.items():
+                self._dirty_conversations.setdefault(key, value)
+            return
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(user_rows) + len(upserts) + len(deletes)
+        
+        # Пока шла запись, могли накопиться новые изменения
+        if self._dirty_users or self._dirty_conversations:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_dirty())
+    
+    @staticmethod
+    def _write(user_rows: list, upserts: list, deletes: list) -> bool:
+        """Пакетная запись в одной транзакции"""
+        try:
+            with Database.get_connection() as conn:
+                with conn.cursor() as cur:
+                    if user_rows:
+                        psycopg2.extras.execute_values(
+                            cur,
+                            """INSERT INTO bot_user_data (user_id, data) VALUES %s
+                               ON CONFLICT (user_id) DO UPDATE
+                               SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP""",
+                            user_rows, template="(%s, %s::jsonb)"
+                        )
+                    if upserts:
+                        psycopg2.extras.execute_values(
+                            cur,
+                            """INSERT INTO bot_conversations (name, key, user_id, state) VALUES %s
+                               ON CONFLICT (name, key) DO UPDATE
+                               SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP""",
+                            upserts, template="(%s, %s, %s, %s::jsonb)"
+                        )
+                    if deletes:
+                        psycopg2.extras.execute_values(
+                            cur,
+                            """DELETE FROM bot_conversations c USING (VALUES %s) AS d(name, key)
+                               WHERE c.name = d.name AND c.key = d.key""",
+                            deletes
+                        )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния диалогов: {e}")
+            return False
+    
+    async def flush(self):
+        """Вызывается PTB при остановке: дописываем все накопленное"""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+
+def shard_for(update: Update, workers: int) -> int:
+    """Номер воркера для обновления: все обновления пользователя идут в один процесс"""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % workers
+
+def run_worker(worker_index: int, workers: int, queue):
+    """Процесс-воркер: обрабатывает обновления своей доли пользователей"""
+    # Ctrl+C получает вся группа процессов; воркер останавливает диспетчер
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # У каждого воркера свои файлы логов: ротировать общий файл из нескольких процессов нельзя
+    LogPipeline.setup(f"-w{worker_index + 1}")
+    logger.info(f"Воркер {worker_index + 1}/{workers} запускается (pid {os.getpid()})")
+    
+    UserRegistry.load()
+    ClusterEvents.start()
+    application = build_application(PostgresPersistence(worker_index, workers), BOT_WORKER_QUEUE_SIZE)
+    
+    async def consume():
+        loop = asyncio.get_running_loop()
+        async with application:
+            await application.start()
+            await start_metrics(application)
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            await application.stop()
+            await drain_outbound(application)
+    
+    try:
+        asyncio.run(consume())
+    finally:
+        ViewBuffer.stop()
+        SeenFilter.save_all()
+        ClusterEvents.stop()
+        Database.shutdown_executor()
+        Database.close_pool()
+    logger.info(f"Воркер {worker_index + 1}/{workers} остановлен")
+    # atexit в дочерних процессах multiprocessing не вызывается
+    LogPipeline.stop()
+
+async def run_dispatcher(workers: int):
+    """Диспетчер: получает обновления (polling или webhook) и раздает их воркерам по user_id.
+    Порядок обновлений одного пользователя сохраняется: у каждого воркера своя очередь."""
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue(BOT_WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes: List[multiprocessing.Process] = [None] * workers
+    
+    def spawn(index: int):
+        processes[index] = mp.Process(
+            target=run_worker, args=(index, workers, queues[index]), name=f"bot-worker-{index}"
+        )
+        processes[index].start()
+    
+    for index in range(workers):
+        spawn(index)
+    
+    loop = asyncio.get_running_loop()
+    incoming: asyncio.Queue = asyncio.Queue(BOT_WORKER_QUEUE_SIZE)
+    lanes = [asyncio.Queue(BOT_WORKER_QUEUE_SIZE) for _ in range(workers)]
+    stop_event = stop_on_signals()
+    
+    async def route():
+        while True:
+            update = await incoming.get()
+            if update is None:
+                for lane in lanes:
+                    await lane.put(None)
+                return
+            await lanes[shard_for(update, workers)].put(update.to_dict())
+    
+    async def forward(index: int):
+        # Очередь процесса блокирующая - put уходит в поток, чтобы не стопорить остальных
+        while True:
+            data = await lanes[index].get()
+            await loop.run_in_executor(None, queues[index].put, data)
+            if data is None:
+                return
+    
+    async def supervise():
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Воркер {index + 1} завершился с кодом {process.exitcode}, перезапуск")
+                    spawn(index)
+    
+    bot = Bot(TELEGRAM_TOKEN, **telegram_api_urls())
+    async with bot:
+        router = asyncio.create_task(route())
+        forwarders = [asyncio.create_task(forward(index)) for index in range(workers)]
+        supervisor = asyncio.create_task(supervise())
+        
+        if BOT_MODE == "webhook":
+            server = WebhookServer(bot, incoming, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+            await server.start()
+            await set_webhook(bot)
+        else:
+            updater = Updater(bot, incoming)
+            await updater.initialize()
+            await updater.start_polling(drop_pending_updates=True)
+        logger.info(f"Диспетчер запущен, воркеров: {workers}")
+        
+        await stop_event.wait()
+        logger.info("Остановка диспетчера: дообрабатываем очереди воркеров")
+        if BOT_MODE == "webhook":
+            await server.stop()
+        else:
+            await updater.stop()
+            await updater.shutdown()
+        
+        supervisor.cancel()
+        await incoming.put(None)
+        await router
+        await asyncio.gather(*forwarders)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+
+def create_browse_keyboard(target_id: int):
+    keyboard = [
+        [
+            InlineKeyboardButton("❤️", callback_data=f"like_{target_id}"),
+            InlineKeyboardButton("👎", callback_data=f"skip_{target_id}")
+        ],
+        [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f"complaint_{target_id}")],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def format_profile_text(user_data) -> str:
+    """Текст карточки анкеты. Без обращений к БД: фото берутся из user_data['photos']"""
+    photo_count = len(user_data.get('photos') or [])
+    
+    search_location = "🌍 Вся Украина" if user_data.get('search_all_ukraine') or user_data['search_city'].lower() == 'вся украина' else f"📍 {user_data['search_city']} ({user_data['search_radius']} км)"
+    
+    return f"""👤 {user_data['name']}, {user_data['age']} лет
+🚻 {GENDERS.get(user_data['gender'], user_data['gender'])}
+📍 {user_data['current_city']}
+🔍 Ищет: {search_location}
+💕 Цель: {DATING_GOALS.get(user_data['dating_goal'], user_data['dating_goal'])}
+📸 Фото: {photo_count}
+
+📝 О себе:
+{user_data['bio']}"""
+
+# Команда /start
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if await Database.run(UserManager.is_user_banned, user_id):
+        await update.message.reply_text("❌ Ваш аккаунт заблокирован.")
+        return ConversationHandler.END
+    
+    if await Database.run(UserManager.user_exists, user_id):
+        await update.message.reply_text(
+            "Добро пожаловать обратно! Выберите действие:",
+            reply_markup=create_main_menu()
+        )
+        return ConversationHandler.END
+    
+    # Проверка капчи
+    if not await Database.run(CaptchaManager.is_verified, user_id):
+        question = CaptchaManager.issue_challenge(user_id)
+        if question is None:
+            await update.message.reply_text(captcha_lockout_text(user_id))
+            return ConversationHandler.END
+        
+        await update.message.reply_text(
+            f"🤖 Подтвердите, что вы человек.\n\nРешите пример: {question}",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return CAPTCHA
+    
+    await update.message.reply_text(
+        "Привет! Давайте создадим вашу анкету для знакомств.\n\nКак вас зовут?",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return NAME
+
+def captcha_lockout_text(user_id: int) -> str:
+    minutes = max(1, math.ceil(CaptchaManager.lockout_remaining(user_id) / 60))
+    return f"❌ Слишком много неверных попыток. Попробуйте через {minutes} мин. командой /start"
+
+# Обработка капчи
+async def handle_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_answer = update.message.text.strip()
+    user_id = update.effective_user.id
+    
+    passed, attempts = CaptchaManager.check_answer(user_id, user_answer)
+    
+    if passed:
+        await Database.run(CaptchaManager.verify_user, user_id)
+        await update.message.reply_text(
+            "✅ Отлично! Теперь давайте создадим вашу анкету.\n\nКак вас зовут?"
+        )
+        return NAME
+    
+    if attempts >= CAPTCHA_MAX_ATTEMPTS:
+        await update.message.reply_text(captcha_lockout_text(user_id))
+        return ConversationHandler.END
+    
+    question = CaptchaManager.issue_challenge(user_id)
+    if question is None:
+        await update.message.reply_text(captcha_lockout_text(user_id))
+        return ConversationHandler.END
+    
+    if passed is None:
+        # Пример истек или потерян при перезапуске
+        await update.message.reply_text(f"⌛ Время на ответ истекло. Решите новый пример: {question}")
+    else:
+        await update.message.reply_text(
+            f"❌ Неверно. Попытка {attempts}/{CAPTCHA_MAX_ATTEMPTS}\n\nПопробуйте еще раз: {question}"
+        )
+    return CAPTCHA
+
+# Регистрация - имя
+async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    name = update.message.text.strip()
+    if len(name) < 2 or len(name) > 50:
+        await update.message.reply_text("Имя должно быть от 2 до 50 символов. Попробуйте еще раз:")
+        return NAME
+    
+    context.user_data['name'] = name
+    await update.message.reply_text("Сколько вам лет? (от 16 до 100)")
+    return AGE
+
+# Регистрация - возраст
+async def get_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        age = int(update.message.text)
+        if 16 <= age <= 100:
+            context.user_data['age'] = age
+            
+            keyboard = [
+                [InlineKeyboardButton("👨 Мужчина", callback_data="gender_male")],
+                [InlineKeyboardButton("👩 Женщина", callback_data="gender_female")]
+            ]
+            
+            await update.message.reply_text(
+                "Выберите ваш пол:", 
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return GENDER
+        else:
+            await update.message.reply_text("Возраст должен быть от 16 до 100 лет:")
+            return AGE
+    except ValueError:
+        await update.message.reply_text("Введите возраст числом:")
+        return AGE
+
+# Регистрация - пол
+async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    gender = "male" if query.data == "gender_male" else "female"
+    context.user_data['gender'] = gender
+    
+    await query.edit_message_text("В каком городе вы находитесь сейчас? (напишите название)")
+    return CURRENT_CITY
+
+# Регистрация - текущий город
+async def get_current_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    city = update.message.text.strip()
+    if len(city) < 2:
+        await update.message.reply_text("Введите корректное название города:")
+        return CURRENT_CITY
+    
+    # Координаты и ID города из локального справочника
+    context.user_data.update(resolve_city_fields('current', city))
+    
+    await update.message.reply_text("В каком городе вы хотите искать знакомства? (или напишите 'вся украина')")
+    return SEARCH_CITY
+
+# Регистрация - город поиска
+async def get_search_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    city = update.message.text.strip()
+    if len(city) < 2:
+        await update.message.reply_text("Введите корректное название города:")
+        return SEARCH_CITY
+    
+    if city.lower() == 'вся украина':
+        context.user_data.update({
+            'search_city': city, 'search_city_id': None, 'search_lat': None, 'search_lon': None
+        })
+        context.user_data['search_radius'] = 0
+        context.user_data['search_all_ukraine'] = True
+        
+        # Переходим сразу к целям знакомства
+        keyboard = []
+        for key, value in DATING_GOALS.items():
+            keyboard.append([InlineKeyboardButton(value, callback_data=f"goal_{key}")])
+        
+        await update.message.reply_text(
+            "Выберите цель знакомства:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return DATING_GOAL
+    else:
+        context.user_data.update(resolve_city_fields('search', city))
+        context.user_data['search_all_ukraine'] = False
+        keyboard = [
+            [InlineKeyboardButton("10 км", callback_data="radius_10")],
+            [InlineKeyboardButton("25 км", callback_data="radius_25")],
+            [InlineKeyboardButton("50 км", callback_data="radius_50")],
+            [InlineKeyboardButton("100 км", callback_data="radius_100")]
+        ]
+        
+        await update.message.reply_text(
+            "Выберите радиус поиска:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return SEARCH_RADIUS
+
+# Регистрация - радиус поиска
+async def get_search_radius(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    radius = int(query.data.split("_")[1])
+    context.user_data['search_radius'] = radius
+    
+    keyboard = []
+    for key, value in DATING_GOALS.items():
+        keyboard.append([InlineKeyboardButton(value, callback_data=f"goal_{key}")])
+    
+    await query.edit_message_text(
+        "Выберите цель знакомства:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return DATING_GOAL
+
+# Регистрация - цель знакомства
+async def get_dating_goal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    goal = query.data.split("_")[1]
+    context.user_data['dating_goal'] = goal
+    
+    await query.edit_message_text("Напишите немного о себе (до 500 символов):")
+    return BIO
+
+# Регистрация - био
+async def get_bio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    bio = update.message.text.strip()[:500]
+    if len(bio) < 10:
+        await update.message.reply_text("Описание должно быть минимум 10 символов. Расскажите о себе подробнее:")
+        return BIO
+    
+    context.user_data['bio'] = bio
+    await update.message.reply_text(
+        "Теперь загрузите ваши фотографии (от 1 до 5 фото). Отправьте первое фото:"
+    )
+    context.user_data['photos'] = []
+    return PHOTO
+
+# Регистрация - фотографии
+async def get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message.photo:
+        await update.message.reply_text("Пожалуйста, отправьте фотографию:")
+        return PHOTO
+    
+    photo_id = update.message.photo[-1].file_id
+    photos = context.user_data.get('photos', [])
+    photos.append(photo_id)
+    context.user_data['photos'] = photos
+    
+    if len(photos) < 5:
+        keyboard = [
+            [InlineKeyboardButton("✅ Закончить", callback_data="finish_photos")]
+        ]
+        await update.message.reply_text(
+            f"Фото {len(photos)}/5 загружено. Загрузите еще одно фото или нажмите 'Закончить':",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return PHOTO
+    else:
+        return await finish_registration(update, context)
+
+# Завершение добавления фото
+async def finish_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    return await finish_registration(update, context)
+
+# Завершение регистрации
+async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_data = {
+        'user_id': update.effective_user.id,
+        'username': update.effective_user.username,
+        **context.user_data
+    }
+    
+    if await Database.run(UserManager.create_user, user_data):
+        # Сохраняем фотографии
+        for i, photo_id in enumerate(context.user_data.get('photos', [])):
+            await Database.run(UserManager.add_photo, user_data['user_id'], photo_id, i == 0)  # Первое фото - главное
+        
+        message_text = "Профиль успешно создан! Добро пожаловать в бот знакомств."
+        
+        if hasattr(update, 'callback_query') and update.callback_query:
+            await update.callback_query.edit_message_text(
+                message_text,
+                reply_markup=create_main_menu()
+            )
+        else:
+            await update.message.reply_text(
+                message_text,
+                reply_markup=create_main_menu()
+            )
+    else:
+        await update.message.reply_text("Ошибка создания профиля. Попробуйте еще раз с /start")
+    
+    return ConversationHandler.END
+
+# Просмотр анкет
+async def browse_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query:
+        await query.answer()
+        user_id = query.from_user.id
+    else:
+        user_id = update.effective_user.id
+    
+    if await Database.run(UserManager.is_user_banned, user_id):
+        text = "Ваш аккаунт заблокирован."
+        if query:
+            await query.edit_message_text(text)
+        else:
+            await update.message.reply_text(text)
+        return
+    
+    candidate = await CandidateFeed.next_candidate(user_id)
+    
+    if not candidate:
+        text = "Анкеты закончились! Попробуйте позже или измените параметры поиска."
+        keyboard = create_main_menu()
+        if query:
+            await query.edit_message_text(text, reply_markup=keyboard)
+        else:
+            await update.message.reply_text(text, reply_markup=keyboard)
+        return
+    
+    text = candidate['caption']
+    keyboard = create_browse_keyboard(candidate['user_id'])
+    photos = candidate['photos']
+    
+    if query:
+        await query.message.delete()
+    
+    if photos:
+        if len(photos) == 1:
+            # Одно фото
+            calls = [("send_photo", {"photo": photos[0]['photo_id'], "caption": text, "reply_markup": keyboard})]
+        else:
+            # Несколько фото - отправляем медиа-группу
+            media = []
+            for i, photo in enumerate(photos[:5]):  # Максимум 5 фото в группе
+                if i == 0:
+                    media.append(InputMediaPhoto(photo['photo_id'], caption=text))
+                else:
+                    media.append(InputMediaPhoto(photo['photo_id']))
+            calls = [
+                ("send_media_group", {"media": media}),
+                ("send_message", {"text": "Выберите действие:", "reply_markup": keyboard}),
+            ]
+        # Если Telegram не принял фото, показываем анкету текстом
+        OutboundQueue.send(
+            context.bot, user_id, calls,
+            fallback=[("send_message", {"text": text, "reply_markup": keyboard})]
+        )
+    else:
+        OutboundQueue.send_message(context.bot, user_id, text, reply_markup=keyboard)
+
+# Обработка лайка
+async def handle_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    target_id = int(query.data.split('_')[1])
+    
+    # Отмечаем как просмотренный
+    CandidateFeed.discard(user_id, target_id)
+    await Database.run(MatchManager.mark_viewed, user_id, target_id)
+    
+    # Ставим лайк
+    is_match = await Database.run(MatchManager.add_like, user_id, target_id)
+    
+    if is_match:
+        target_user = await Database.run(UserManager.get_user, target_id)
+        current_user = await Database.run(UserManager.get_user, user_id)
+        
+        # Логируем матч
+        user_logger.info(
+            f"Match created between users {user_id} and {target_id}",
+            extra={"action": "match", "user_id": user_id, "target_id": target_id}
+        )
+        
+        # Уведомляем о матче
+        await query.message.delete()
+        OutboundQueue.send_message(
+            context.bot, user_id,
+            f"🎉 Взаимная симпатия с {target_user['name']}!\n\n"
+            f"Контакт: @{target_user['username'] or 'скрыт'}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")],
+                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+            ])
+        )
+        
+        # Уведомляем второго пользователя
+        OutboundQueue.send_message(
+            context.bot, target_id,
+            f"🎉 Взаимная симпатия с {current_user['name']}!\n\n"
+            f"Контакт: @{current_user['username'] or 'скрыт'}",
+            priority=OutboundQueue.PRIORITY_MATCH,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("👀 Посмотреть профиль", callback_data="browse")],
+                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+            ])
+        )
+    else:
+        await query.message.delete()
+        OutboundQueue.send_message(
+            context.bot, user_id,
+            "❤️ Лайк отправлен!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")]
+            ])
+        )
+
+# Обработка пропуска
+async def handle_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    target_id = int(query.data.split('_')[1])
+    
+    # Отмечаем как просмотренный
+    CandidateFeed.discard(user_id, target_id)
+    await Database.run(MatchManager.mark_viewed, user_id, target_id)
+    
+    # Показываем следующую анкету
+    await query.message.delete()
+    await browse_profiles(update, context)
+
+# Показ матчей
+async def show_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    matches = await Database.run(MatchManager.get_matches, query.from_user.id)
+    
+    if not matches:
+        await query.edit_message_text(
+            "У вас пока нет матчей. Ставьте больше лайков!",
+            reply_markup=create_main_menu()
+        )
+        return
+    
+    text = "❤️ Ваши матчи:\n\n"
+    for match in matches[:10]:
+        username = f"@{match['username']}" if match['username'] else "контакт скрыт"
+        text += f"• {match['name']}, {match['age']} — {username}\n"
+    
+    await query.edit_message_text(text, reply_markup=create_main_menu())
+
+# Показ профиля
+async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user = await Database.run(UserManager.get_profile_card, query.from_user.id)
+    if not user:
+        await query.edit_message_text("Профиль не найден")
+        return
+    
+    text = format_profile_text(user)
+    await query.edit_message_text(text, reply_markup=create_main_menu())
+
+# Главное меню
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(
+        "Главное меню:",
+        reply_markup=create_main_menu()
+    )
+
+# Жалоба на пользователя
+async def handle_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    target_id = int(query.data.split('_')[1])
+    user_id = query.from_user.id
+    
+    can_complain, message = await Database.run(ComplaintManager.can_file_complaint, user_id)
+    if not can_complain:
+        await query.answer(message, show_alert=True)
+        return
+    
+    keyboard = [
+        [InlineKeyboardButton("🔞 Неподходящий контент", callback_data=f"complain_inappropriate_{target_id}")],
+        [InlineKeyboardButton("🤖 Бот/фейк", callback_data=f"complain_fake_{target_id}")],
+        [InlineKeyboardButton("😠 Оскорбления", callback_data=f"complain_abuse_{target_id}")],
+        [InlineKeyboardButton("💰 Спам/реклама", callback_data=f"complain_spam_{target_id}")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="browse")]
+    ]
+    
+    await query.edit_message_text(
+        "Выберите причину жалобы:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Обработка жалобы
+async def process_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    data_parts = query.data.split('_')
+    reason = data_parts[1]
+    target_id = int(data_parts[2])
+    user_id = query.from_user.id
+    
+    reason_text = {
+        'inappropriate': 'Неподходящий контент',
+        'fake': 'Бот/фейк аккаунт',
+        'abuse': 'Оскорбления',
+        'spam': 'Спам/реклама'
+    }.get(reason, reason)
+    
+    was_banned = await Database.run(ComplaintManager.file_complaint, user_id, target_id, reason_text)
+    
+    result_text = "✅ Жалоба отправлена администрации."
+    if was_banned:
+        result_text += "\n⚠️ Пользователь заблокирован автоматически."
+    
+    await query.edit_message_text(
+        result_text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("👀 Смотреть дальше", callback_data="browse")]
+        ])
+    )
+    
+    # Уведомляем админов в фоне: ответ пользователю не ждет загрузки анкет
+    context.application.create_task(
+        notify_admins_about_complaint(context.bot, user_id, target_id, reason_text, was_banned),
+        update=update
+    )
+
+async def notify_admins_about_complaint(bot: Bot, user_id: int, target_id: int,
+                                        reason_text: str, was_banned: bool):
+    target_user, complainer = await asyncio.gather(
+        Database.run(UserManager.get_user, target_id),
+        Database.run(UserManager.get_user, user_id)
+    )
+    AdminNotifier.notify(bot, {
+        "target_id": target_id,
+        "target": target_user,
+        "complainer_id": user_id,
+        "complainer": complainer,
+        "reason": reason_text,
+        "was_banned": was_banned,
+    })
+
+# Админские команды
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    # Получаем статистику
+    total_users, active_users, total_matches, pending_complaints = await asyncio.gather(
+        Database.execute_query_async("SELECT COUNT(*) as count FROM users", fetch="one"),
+        Database.execute_query_async("SELECT COUNT(*) as count FROM users WHERE is_active = TRUE AND is_banned = FALSE", fetch="one"),
+        Database.execute_query_async("SELECT COUNT(*) as count FROM matches", fetch="one"),
+        Database.execute_query_async("SELECT COUNT(*) as count FROM complaints WHERE status = 'pending'", fetch="one"),
+    )
+    
+    text = f"""📊 СТАТИСТИКА БОТА
+
+👥 Всего пользователей: {total_users['count'] if total_users else 0}
+✅ Активных: {active_users['count'] if active_users else 0}
+❤️ Всего матчей: {total_matches['count'] if total_matches else 0}
+⚠️ Жалоб на рассмотрении: {pending_complaints['count'] if pending_complaints else 0}"""
+    
+    pool = Database.pool_stats()
+    if pool:
+        text += (
+            f"\n\n🔌 Пул БД: {pool['in_use']}/{pool['max_size']} занято, {pool['idle']} свободно"
+            f"\n⏳ Исчерпан: {pool['exhausted']} раз, таймаутов: {pool['timeouts']}"
+        )
+    
+    cache = ProfileCache.get_stats()
+    text += (
+        f"\n🗂 Кэш анкет: {cache['size']} записей, попаданий {cache['hits']}, "
+        f"промахов {cache['misses']} ({cache['hit_rate']:.0%})"
+    )
+    
+    outbound = OutboundQueue.get_stats()
+    text += (
+        f"\n📤 Исходящие: в очереди {outbound['pending']}, отправлено {outbound['sent']}, "
+        f"ошибок {outbound['failed']}, без ответа {outbound['uncertain']}, flood wait {outbound['flood_waits']}, "
+        f"задержка p50 {outbound['latency_p50'] * 1000:.0f} мс / p95 {outbound['latency_p95'] * 1000:.0f} мс"
+    )
+    
+    alerts = AdminNotifier.stats
+    text += (
+        f"\n🚨 Жалобы админам: отдельно {alerts['single']}, "
+        f"сводками {alerts['batched']} в {alerts['digests']} сообщениях"
+    )
+    
+    if SLOW_QUERY_MS:
+        slow = SlowQueryLog.get_stats()
+        text += f"\n🐢 Медленных запросов (> {SLOW_QUERY_MS:.0f} мс): {slow['slow_queries']}, форм {slow['shapes']}"
+        for fingerprint, shape in SlowQueryLog.top(3):
+            text += (
+                f"\n  {fingerprint}: {shape['count']} раз, макс. {shape['max_ms']:.0f} мс - "
+                f"{shape['query'][:80]}"
+            )
+    
+    log_stats = LogPipeline.get_stats()
+    if log_stats['dropped']:
+        text += f"\n📝 Логи: отброшено записей {log_stats['dropped']}, в очереди {log_stats['queued']}"
+    
+    flood = FloodGuard.get_stats()
+    dropped = ", ".join(f"{action} {count}" for action, count in flood['dropped_by_action'].items())
+    text += (
+        f"\n🛡 Флуд: пропущено {flood['passed']}, задержано {flood['delayed']}, "
+        f"отброшено {flood['dropped']}" + (f" ({dropped})" if dropped else "")
+    )
+    
+    captcha = CaptchaManager.get_stats()
+    text += (
+        f"\n🤖 Капча: выдано {captcha['issued']}, пройдено {captcha['passed']}, "
+        f"ошибок {captcha['failed']}, ждут ответа {captcha['pending']}, заблокировано {captcha['locked_now']}"
+    )
+    
+    feed = CandidateFeed.stats
+    text += (
+        f"\n🔮 Предзагрузка анкет: попаданий {feed['prefetch_hits']}, "
+        f"промахов {feed['prefetch_misses']}, сброшено {feed['prefetch_dropped']}"
+    )
+    
+    persistence = context.application.persistence
+    if isinstance(persistence, PostgresPersistence):
+        text += (
+            f"\n💾 Состояние диалогов: загружено {persistence.stats['loads']}, "
+            f"записано {persistence.stats['rows']} за {persistence.stats['flushes']} пакетов, "
+            f"ошибок {persistence.stats['errors']}"
+        )
+    
+    webhook = context.application.bot_data.get("webhook_server")
+    if webhook:
+        text += (
+            f"\n🌐 Webhook: принято {webhook.stats['accepted']}, отклонено {webhook.stats['rejected']}, "
+            f"в очереди {context.application.update_queue.qsize()}"
+        )
+    
+    if SEEN_FILTER_ENABLED:
+        seen = SeenFilter.get_stats()
+        text += (
+            f"\n🧮 Фильтр просмотров: {seen['viewers']} зрителей, проверено {seen['checked']}, "
+            f"ложных совпадений {seen['false_positives']} ({seen['false_positive_rate']:.2%})"
+        )
+    
+    if VIEW_FLUSH_INTERVAL > 0:
+        views = ViewBuffer.get_stats()
+        text += (
+            f"\n👁 Просмотры: в буфере {views['pending']}, записано {views['rows']} "
+            f"за {views['flushes']} сбросов, ошибок {views['errors']}"
+        )
+    
+    await update.message.reply_text(text)
+
+async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    if len(context.args) != 1:
+        await update.message.reply_text("Использование: /ban <user_id>")
+        return
+    
+    try:
+        user_id = int(context.args[0])
+        await Database.run(UserManager.set_banned, user_id, True)
+        await update.message.reply_text(f"✅ Пользователь {user_id} заблокирован")
+    except ValueError:
+        await update.message.reply_text("Неверный ID пользователя")
+
+async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    if len(context.args) != 1:
+        await update.message.reply_text("Использование: /unban <user_id>")
+        return
+    
+    try:
+        user_id = int(context.args[0])
+        await Database.run(UserManager.set_banned, user_id, False)
+        await update.message.reply_text(f"✅ Пользователь {user_id} разблокирован")
+    except ValueError:
+        await update.message.reply_text("Неверный ID пользователя")
+
+async def admin_complaints(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    complaints = await Database.execute_query_async(
+        """SELECT c.*, u1.name as complainant_name, u2.name as target_name 
+           FROM complaints c
+           JOIN users u1 ON c.from_user = u1.user_id
+           JOIN users u2 ON c.against_user = u2.user_id
+           WHERE c.status = 'pending'
+           ORDER BY c.created_at DESC LIMIT 10""",
+        fetch="all"
+    )
+    
+    if not complaints:
+        await update.message.reply_text("Нет жалоб для рассмотрения")
+        return
+    
+    text = "🚨 ЖАЛОБЫ НА РАССМОТРЕНИИ:\n\n"
+    for complaint in complaints:
+        text += f"ID: {complaint['id']}\n"
+        text += f"От: {complaint['complainant_name']} (ID: {complaint['from_user']})\n"
+        text += f"На: {complaint['target_name']} (ID: {complaint['against_user']})\n"
+        text += f"Причина: {complaint['reason']}\n"
+        text += f"Дата: {complaint['created_at']}\n\n"
+    
+    await update.message.reply_text(text)
+
+# Отмена операций
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Операция отменена.")
+    return ConversationHandler.END
+
+def telegram_api_urls() -> dict:
+    """Адреса Bot API для Bot и ApplicationBuilder, если задан TELEGRAM_API_URL"""
+    if not TELEGRAM_API_URL:
+        return {}
+    return {"base_url": f"{TELEGRAM_API_URL}/bot", "base_file_url": f"{TELEGRAM_API_URL}/file/bot"}
+
+async def start_metrics(application: Application):
+    if METRICS_ENABLED:
+        await Metrics.start(getattr(application.persistence, "worker_index", 0))
+
+async def drain_outbound(application: Application):
+    await AdminNotifier.drain()
+    await OutboundQueue.drain()
+    if METRICS_ENABLED:
+        await Metrics.stop(getattr(application.persistence, "worker_index", 0))
+
+def build_application(persistence: Optional[BasePersistence] = None,
+                      update_queue_size: Optional[int] = None) -> Application:
+    """Приложение со всеми обработчиками. update_queue_size - ограниченная очередь
+    без встроенного polling (обновления кладет webhook сервер или диспетчер)"""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+    )
+    urls = telegram_api_urls()
+    if urls:
+        builder = builder.base_url(urls["base_url"]).base_file_url(urls["base_file_url"])
+    if update_queue_size:
+        builder = builder.update_queue(asyncio.Queue(update_queue_size)).updater(None)
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    # run_polling вызывает post_init после инициализации и post_stop после обработки последних обновлений
+    builder = builder.post_init(start_metrics).post_stop(drain_outbound)
+    application = builder.build()
+    
+    # Справочник городов читается из CSV синхронно - загружаем до старта, а не
+    # в первом обработчике ввода города, блокируя цикл событий
+    CityGazetteer.default()
+    
+    # Обработчик регистрации
+    registration_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start_command)],
+        states={
+            CAPTCHA: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_captcha)],
+            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
+            AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_age)],
+            GENDER: [CallbackQueryHandler(get_gender, pattern=r"^gender_")],
+            CURRENT_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_current_city)],
+            SEARCH_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_search_city)],
+            SEARCH_RADIUS: [CallbackQueryHandler(get_search_radius, pattern=r"^radius_")],
+            DATING_GOAL: [CallbackQueryHandler(get_dating_goal, pattern=r"^goal_")],
+            BIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_bio)],
+            PHOTO: [
+                MessageHandler(filters.PHOTO, get_photo),
+                CallbackQueryHandler(finish_photos, pattern="finish_photos")
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        allow_reentry=True,
+        name="registration",
+        persistent=persistence is not None,
+    )
+    
+    # Добавляем обработчики
+    application.add_handler(registration_handler)
+    application.add_handler(CallbackQueryHandler(browse_profiles, pattern="browse"))
+    application.add_handler(CallbackQueryHandler(handle_like, pattern=r"^like_\d+"))
+    application.add_handler(CallbackQueryHandler(handle_skip, pattern=r"^skip_\d+"))
+    application.add_handler(CallbackQueryHandler(show_matches, pattern="matches"))
+    application.add_handler(CallbackQueryHandler(show_profile, pattern="profile"))
+    application.add_handler(CallbackQueryHandler(main_menu, pattern="main_menu"))
+    application.add_handler(CallbackQueryHandler(handle_complaint, pattern=r"^complaint_\d+"))
+    application.add_handler(CallbackQueryHandler(process_complaint, pattern=r"^complain_"))
+    
+    # Админские команды
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("ban", admin_ban))
+    application.add_handler(CommandHandler("unban", admin_unban))
+    application.add_handler(CommandHandler("complaints", admin_complaints))
+    
+    # Команды
+    application.add_handler(CommandHandler("browse", browse_profiles))
+    application.add_handler(CommandHandler("matches", show_matches))
+    application.add_handler(CommandHandler("profile", show_profile))
+    
+    if METRICS_ENABLED:
+        Metrics.instrument(application)
+    return application
+
+def main():
+    """Запуск бота"""
+    # Инициализация базы данных
+    Database.init_database()
+    
+    if BOT_WORKERS > 1:
+        # Воркеры открывают свои соединения, диспетчеру БД не нужна
+        Database.close_pool()
+        logger.info(f"Бот запускается в {BOT_WORKERS} процессах...")
+        asyncio.run(run_dispatcher(BOT_WORKERS))
+        return
+    
+    UserRegistry.load()
+    application = build_application(
+        PostgresPersistence(),
+        update_queue_size=WEBHOOK_QUEUE_SIZE if BOT_MODE == "webhook" else None
+    )
+    
+    logger.info("Бот запускается...")
+    
+    # Запуск polling или webhook
+    try:
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(drop_pending_updates=True)
+    finally:
+        ViewBuffer.stop()
+        SeenFilter.save_all()
+        Database.shutdown_executor()
+        Database.close_pool()
+
+if __name__ == "__main__":
+    main()